@@ -0,0 +1,109 @@
+"""
+    Command line entry point, installed as "musk".
+
+    musk run runs a sweep on this machine, without SQS or MySQL:
+
+        musk run --simulation square_2d --sizes 64 128 \\
+            --p-min 0.55 --p-max 0.65 --p-steps 11 --repeat 128 --seed 1 \\
+            --stats has_percolated mean_cluster_size --workers 8 \\
+            --store sweep.sqlite
+
+    A sweep can also be read from a JSON file with the SweepSpec
+    fields (and p_min, p_max, p_steps), command line options taking
+    precedence: musk run --spec sweep.json --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from musk.misc.logging import setup_logging
+
+
+def get_parser() -> argparse.ArgumentParser:
+    from musk.percolation.sweep import SWEEP_SIMULATIONS
+
+    parser = argparse.ArgumentParser(prog="musk")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Run a sweep on local processes.")
+    run.add_argument("--spec", help="JSON file with the sweep spec.")
+    run.add_argument("--simulation", choices=sorted(SWEEP_SIMULATIONS))
+    run.add_argument("--sizes", type=int, nargs="+")
+    run.add_argument("--probabilities", type=float, nargs="+")
+    run.add_argument("--p-min", type=float)
+    run.add_argument("--p-max", type=float)
+    run.add_argument("--p-steps", type=int)
+    run.add_argument("--repeat", type=int)
+    run.add_argument("--seed", type=int)
+    run.add_argument("--stats", nargs="+")
+    run.add_argument(
+        "--parameter",
+        dest="parameters",
+        action="append",
+        metavar="NAME=VALUE",
+        help="Extra integer simulation parameter, e.g. n_divisions=7.",
+    )
+    run.add_argument("--chunk-size", type=int)
+    run.add_argument("--workers", type=int, default=os.cpu_count())
+    run.add_argument("--store", default="musk.sqlite", help="SQLite file.")
+    return parser
+
+
+def get_sweep_spec(arguments: argparse.Namespace):
+    from musk.percolation.sweep import SweepSpec, get_probability_range
+
+    spec = {}
+    if arguments.spec:
+        with open(arguments.spec) as spec_file:
+            spec = json.load(spec_file)
+
+    for name in ["simulation", "sizes", "probabilities", "repeat", "seed"]:
+        if getattr(arguments, name) is not None:
+            spec[name] = getattr(arguments, name)
+    for name in ["p_min", "p_max", "p_steps", "stats", "chunk_size"]:
+        if getattr(arguments, name) is not None:
+            spec[name] = getattr(arguments, name)
+    if arguments.parameters:
+        spec.setdefault("parameters", {})
+        for parameter in arguments.parameters:
+            name, value = parameter.split("=", 1)
+            spec["parameters"][name] = int(value)
+
+    p_range = [spec.pop(name, None) for name in ["p_min", "p_max", "p_steps"]]
+    if all(value is not None for value in p_range):
+        spec["probabilities"] = get_probability_range(*p_range)
+    elif any(value is not None for value in p_range):
+        raise ValueError("p_min, p_max and p_steps must be given together.")
+
+    return SweepSpec(**spec)
+
+
+def run(arguments: argparse.Namespace):
+    from musk.core.sqlite import SQLiteStore
+    from musk.percolation.sweep import SweepRunner
+
+    logger = logging.getLogger(__name__)
+    spec = get_sweep_spec(arguments)
+
+    start = time.perf_counter()
+    with SQLiteStore(arguments.store) as store:
+        number_of_rows = SweepRunner(spec, store, arguments.workers).run()
+    took = round(time.perf_counter() - start, 3)
+    logger.info(
+        f"Stored {number_of_rows} simulation rows in {arguments.store}, took {took}s"
+    )
+
+
+COMMANDS = {"run": run}
+
+
+def main(args=None):
+    setup_logging()
+    arguments = get_parser().parse_args(args)
+    COMMANDS[arguments.command](arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-from .config import Config, DequeuerConfig, LoggingConfig, MySQLConfig
+from .config import Config, DequeuerConfig, LoggingConfig, MySQLConfig, SQSConfig
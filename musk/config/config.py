@@ -16,6 +16,25 @@ class MySQLConfig(Config):
         PASSWORD: str = env("PASSWORD", None)
         DATABASE: str = env("DATABASE", "musk")
         CONNECTION_TIMEOUT: int = env.int("CONNECTION_TIMEOUT", 30)
+        # Connections kept by the process wide pool, see MySQLConnectionPool
+        POOL_SIZE: int = env.int("POOL_SIZE", 4)
+        # Seconds to wait for a free connection before giving up
+        POOL_TIMEOUT: float = env.float("POOL_TIMEOUT", 60)
+        # Idle connections older than this many seconds are pinged on checkout
+        POOL_PING_INTERVAL: float = env.float("POOL_PING_INTERVAL", 30)
+        # BulkWriter flushes after this many rows or seconds, see BulkWriter
+        BULK_MAX_ROWS: int = env.int("BULK_MAX_ROWS", 256)
+        BULK_MAX_DELAY: float = env.float("BULK_MAX_DELAY", 60)
+        # Rows MySQL.stream fetches and decodes ahead of the consumer
+        STREAM_PREFETCH: int = env.int("STREAM_PREFETCH", 4)
+
+
+class SQSConfig(Config):
+    with env.prefixed("SQS_"):
+        # Set to use a local SQS stand-in, e.g. http://localhost:5000 for moto
+        ENDPOINT_URL: str = env("ENDPOINT_URL", None)
+        # Long polling wait for receive calls (0 to 20 seconds, 0 disables it)
+        WAIT_TIME_SECONDS: int = env.int("WAIT_TIME_SECONDS", 20)
 
 
 class DequeuerConfig(Config):
@@ -23,6 +42,15 @@ class DequeuerConfig(Config):
     with env.prefixed("DEQUEUER_"):
         MESSAGES_PER_READ: int = env.int("MESSAGES_PER_READ", 1)
         PROCESS_COUNT: int = env.int("PROCESS_COUNT", 1)
+        # Worker processes are replaced after this many messages (0: never)
+        MAX_MESSAGES_PER_CHILD: int = env.int("MAX_MESSAGES_PER_CHILD", 1000)
+        # Seconds a worker waits after a pass over empty queues
+        IDLE_SLEEP: float = env.float("IDLE_SLEEP", 2)
+        # Keep extending the visibility timeout of messages being processed
+        VISIBILITY_HEARTBEAT: bool = env.bool("VISIBILITY_HEARTBEAT", True)
+        # Messages a Dequeuer processes at once, in threads or processes
+        # depending on Processor.concurrency (1: one after the other)
+        CONCURRENCY_WORKERS: int = env.int("CONCURRENCY_WORKERS", 1)
         ENV: str = env("ENV", "dev")
 
 
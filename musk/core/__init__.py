@@ -1,6 +1,8 @@
-from .sqs import Message, Queue, SQSMessage, SQSQueue
+from .sqs import DetachedMessage, Message, Queue, SQSMessage, SQSQueue
 from .processor import Processor
 from .simulation import Simulation
 from .dequeuer import Dequeuer
+from .runner import DequeuerRunner, GracefulKiller
+from .local_queue import LocalMessage, LocalQueue, MultiprocessingQueue, SQLiteQueue
 
-from .sql import MySQL
+from .sql import BulkWriter, MySQL
@@ -1,11 +1,130 @@
+import concurrent.futures
+import contextlib
 import logging
-from datetime import datetime
+import math
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
 
 from musk.config import Config, DequeuerConfig
-from musk.core import Processor, Queue
+from musk.core import DetachedMessage, Message, Processor, Queue
+from musk.core.processor import PROCESS_CONCURRENCY, SERIAL_CONCURRENCY
+from musk.core.sql import MySQLConnectionPool
+
+
+class VisibilityHeartbeat:
+    """
+        While active, a background thread keeps extending the
+        visibility timeout of messages, every half timeout, so that
+        no other reader picks them up while they are being processed:
+
+            with VisibilityHeartbeat(queue, [message]):
+                processor.process(message)
+
+        Does nothing for queues without a visibility timeout.
+    """
+
+    INTERVAL_FRACTION = 0.5
+
+    def __init__(self, queue: Queue, messages: list):
+        self._queue = queue
+        self._messages = messages
+        self._visibility_timeout = queue.get_visibility_timeout()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    def __enter__(self) -> "VisibilityHeartbeat":
+        if self._visibility_timeout:
+            self._thread = threading.Thread(target=self._beat, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _beat(self):
+        interval = self._visibility_timeout * self.INTERVAL_FRACTION
+        while not self._stopped.wait(interval):
+            try:
+                self._queue.change_messages_visibility(
+                    self._messages, self._visibility_timeout
+                )
+            except Exception:
+                self._logger.exception("Exception extending message visibility: ")
+
+
+class ProcessingTimeStats:
+    """
+        Processing times of the messages of a queue, keeping the
+        latest max_samples of them for quantiles.
+    """
+
+    def __init__(self, max_samples: int = 1000):
+        self._samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def get_mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def get_quantile(self, quantile: float) -> float:
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[min(int(quantile * len(samples)), len(samples) - 1)]
+
+    def get_suggested_visibility_timeout(
+        self, quantile: float = 0.95, margin: float = 1.5
+    ) -> int:
+        """
+            A visibility timeout covering most messages without a
+            heartbeat, margin times the quantile of recent timings.
+        """
+        return math.ceil(self.get_quantile(quantile) * margin)
+
+    def __str__(self):
+        return (
+            f"n={self.count}, mean={self.get_mean():.3f}s, "
+            f"p50={self.get_quantile(0.5):.3f}s, p95={self.get_quantile(0.95):.3f}s, "
+            f"max={self.max:.3f}s, "
+            f"suggested visibility timeout={self.get_suggested_visibility_timeout()}s"
+        )
+
+
+def process_message(processor: Processor, message: Message) -> float:
+    """
+        Run processor on message, returning how long it took in seconds.
+        Module level, so it can run in a worker process.
+    """
+    start = time.perf_counter()
+    processor.process(message)
+    return time.perf_counter() - start
 
 
 class Dequeuer:
+    """
+        Reads messages from a queue and hands them to a processor.
+        With CONCURRENCY_WORKERS above 1, the messages of a read are
+        processed at once, in a thread or process pool depending on
+        the processor concurrency attribute. Reads are then limited
+        to the messages the pool can finish within the queue
+        visibility timeout, judging from past processing times.
+    """
+
+    MP_CONTEXT = "spawn"
+
     def __init__(
         self, queue: Queue, processor: Processor, config: Config = DequeuerConfig
     ):
@@ -13,6 +132,67 @@ class Dequeuer:
         self._processor = processor
         self._config = config
         self._logger = logging.getLogger(__name__)
+        self._processing_time_stats = ProcessingTimeStats()
+        # Created on first use, in the process doing the dequeuing
+        self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def get_processing_time_stats(self) -> ProcessingTimeStats:
+        return self._processing_time_stats
+
+    def close(self):
+        """
+            Shut down the worker pool, if any.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _get_max_workers(self) -> int:
+        return max(1, self._config.CONCURRENCY_WORKERS)
+
+    def _get_concurrency(self) -> str:
+        if self._get_max_workers() == 1:
+            return SERIAL_CONCURRENCY
+        return self._processor.concurrency
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self._get_concurrency() == PROCESS_CONCURRENCY:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self._get_max_workers(),
+                    mp_context=multiprocessing.get_context(self.MP_CONTEXT),
+                )
+            else:
+                self._reserve_mysql_connections()
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self._get_max_workers()
+                )
+        return self._executor
+
+    def _reserve_mysql_connections(self):
+        # Worker threads share the MySQL pool of the process
+        connections = self._processor.mysql_connections * self._get_max_workers()
+        if connections:
+            MySQLConnectionPool.get_instance().reserve(connections)
+
+    def _get_read_size(self) -> int:
+        """
+            Number of messages to read, at most what the workers can
+            process within the visibility timeout at the observed
+            (95th percentile) processing time.
+        """
+        read_size = self._config.MESSAGES_PER_READ
+        visibility_timeout = self._queue.get_visibility_timeout()
+        processing_time = self._processing_time_stats.get_quantile(0.95)
+        if visibility_timeout and processing_time:
+            messages_per_worker = max(1, int(visibility_timeout // processing_time))
+            read_size = min(read_size, messages_per_worker * self._get_max_workers())
+        return read_size
 
     def _log_message_start(self, message):
         message_id = message.id
@@ -25,28 +205,113 @@ class Dequeuer:
 
         self._logger.info(f"Processing message ({message_id}): {message_body}")
 
-    def _send_message_to_processor(self, message):
+    def _log_message_success(self, message, took: float):
+        self._processing_time_stats.add(took)
+        took = round(took, 3)
+        self._logger.info(f"Success processing message ({message.id}), took {took}s")
+        # Formatted only when logged, it sorts the recent timings
+        self._logger.info(
+            "Processing times for %s: %s",
+            self._queue.get_queue_name(),
+            self._processing_time_stats,
+        )
+
+    def _get_heartbeat(self, messages: list):
+        if self._config.VISIBILITY_HEARTBEAT:
+            return VisibilityHeartbeat(self._queue, messages)
+        return contextlib.nullcontext()
 
+    def _send_message_to_processor(self, message, unacknowledged: list = ()) -> bool:
+        """
+            Process message, returning whether it succeeded.
+            Acknowledging the message is left to the caller, so the
+            visibility of the unacknowledged messages that were
+            processed before it is extended along with its own.
+        """
         self._log_message_start(message)
 
-        start = datetime.now()
         try:
-            self._processor.process(message)
-            message.delete()
-            end = datetime.now()
-            took = (end - start).total_seconds()
-            took = round(took, 3)
-            self._logger.info(
-                f"Success processing message ({message.id}), took {took}s"
-            )
+            with self._get_heartbeat([*unacknowledged, message]):
+                took = process_message(self._processor, message)
+            self._log_message_success(message, took)
+            return True
         except BaseException:
             self._logger.exception("Exception in processor: ")
-            message.requeue()
+            return False
+
+    def _acknowledge(self, processed: list, failed: list):
+        """
+            Delete processed messages and requeue failed ones,
+            each group in as few queue calls as possible.
+        """
+        if processed:
+            self._queue.delete_messages(processed)
+        if failed:
+            self._queue.requeue_messages(failed)
+
+    def _send_messages_to_executor(self, messages: list):
+        """
+            Process messages in the worker pool, returning
+            the messages that succeeded and those that failed.
+        """
+        executor = self._get_executor()
+        detach = self._get_concurrency() == PROCESS_CONCURRENCY
+
+        processed, failed = [], []
+        broken = False
+        futures = {}
+        for index, message in enumerate(messages):
+            self._log_message_start(message)
+            sent_message = DetachedMessage.from_message(message) if detach else message
+            try:
+                future = executor.submit(process_message, self._processor, sent_message)
+            except BrokenProcessPool:
+                self._logger.exception("Worker pool is broken: ")
+                broken = True
+                failed.extend(messages[index:])
+                break
+            futures[future] = message
 
-    def dequeue(self):
+        with self._get_heartbeat(messages):
+            for future in concurrent.futures.as_completed(futures):
+                message = futures[future]
+                try:
+                    self._log_message_success(message, future.result())
+                    processed.append(message)
+                except BrokenProcessPool:
+                    self._logger.exception("Worker process died: ")
+                    broken = True
+                    failed.append(message)
+                except BaseException:
+                    self._logger.exception("Exception in processor: ")
+                    failed.append(message)
 
+        if broken:
+            # A dead worker breaks the pool for good, start a new one
+            self.close()
+        return processed, failed
+
+    def dequeue(self) -> int:
+        """
+            Read one batch of messages, process them and acknowledge
+            the whole batch at once. Return the number of messages read.
+        """
         self._logger.info(f"Reading queue {self._queue.get_queue_name()}...")
-        number_of_messages_per_read = self._config.MESSAGES_PER_READ
-        messages = self._queue.read(number_of_messages_per_read)
-        for message in messages:
-            self._send_message_to_processor(message)
+        messages = self._queue.read(self._get_read_size())
+
+        if self._get_concurrency() != SERIAL_CONCURRENCY:
+            messages = list(messages)
+            processed, failed = self._send_messages_to_executor(messages)
+            self._acknowledge(processed, failed)
+            return len(messages)
+
+        processed, failed = [], []
+        try:
+            for message in messages:
+                if self._send_message_to_processor(message, processed):
+                    processed.append(message)
+                else:
+                    failed.append(message)
+        finally:
+            self._acknowledge(processed, failed)
+        return len(processed) + len(failed)
@@ -0,0 +1,398 @@
+import contextlib
+import heapq
+import json
+import logging
+import multiprocessing
+import multiprocessing.managers
+import sqlite3
+import threading
+import time
+import uuid
+
+from typing import Iterator, List, Optional, Tuple
+
+from musk.core.sqs import Message, Queue
+
+logger = logging.getLogger(__name__)
+
+# (message id, JSON body, receipt handle) of a received message
+ReceivedMessage = Tuple[str, str, str]
+# (message id, receipt handle) of a message to acknowledge
+MessageHandle = Tuple[str, str]
+
+
+class LocalMessage(Message):
+    """
+        A message read from a LocalQueue. Like SQS messages, it is
+        identified towards the queue by the receipt handle of the read
+        that returned it, so acknowledging a message that was read
+        again by someone else after its visibility timeout expired
+        has no effect.
+    """
+
+    def __init__(self, queue: "LocalQueue", id: str, body: str, receipt_handle: str):
+        self._queue = queue
+        self.id = id
+        self.receipt_handle = receipt_handle
+        self._body = body
+
+    @property
+    def body(self):
+        return json.loads(self._body)
+
+    def delete(self):
+        self._queue.delete_messages([self])
+
+    def requeue(self):
+        self.change_visibility(0)
+
+    def change_visibility(self, visibility_timeout: float):
+        self._queue.change_messages_visibility([self], visibility_timeout)
+
+
+class LocalQueue(Queue):
+    """
+        Base class of queues living on this machine, with the same
+        read, read_forever and write semantics as SQSQueue: read
+        messages are hidden from other readers for the visibility
+        timeout, unless deleted or requeued before then.
+    """
+
+    # Seconds between checks for new messages while waiting
+    POLL_INTERVAL = 0.05
+
+    def __init__(
+        self,
+        name: str,
+        visibility_timeout: float = 60,
+        wait_time_seconds: float = 0,
+        sleep_interval: float = 2,
+    ):
+        self.name = name
+        self._visibility_timeout = visibility_timeout
+        self._wait_time_seconds = wait_time_seconds
+        self._sleep_interval = sleep_interval
+
+    def get_queue_name(self) -> str:
+        return self.name
+
+    def get_visibility_timeout(self) -> float:
+        return self._visibility_timeout
+
+    def write(self, messages: list):
+        if type(messages) is not list:
+            raise TypeError("Argument to write should be a list.")
+        self._write([json.dumps(message) for message in messages])
+
+    def read(self, max_number_of_messages: int = 1) -> Iterator[LocalMessage]:
+        """
+            Reads the messages present in the queue, waiting up to
+            wait_time_seconds for messages to arrive when it is empty
+        """
+        deadline = time.monotonic() + self._wait_time_seconds
+        while True:
+            received = self._receive(max_number_of_messages, self._visibility_timeout)
+            if received or time.monotonic() >= deadline:
+                break
+            time.sleep(self.POLL_INTERVAL)
+
+        for id, body, receipt_handle in received:
+            yield LocalMessage(self, id, body, receipt_handle)
+
+    def read_forever(self, max_number_of_messages_per_read: int = 1):
+        while True:
+            for message in self.read(max_number_of_messages_per_read):
+                yield message
+            if not self._wait_time_seconds:
+                time.sleep(self._sleep_interval)
+
+    def delete_messages(self, messages: List[LocalMessage]):
+        self._delete([(message.id, message.receipt_handle) for message in messages])
+
+    def change_messages_visibility(
+        self, messages: List[LocalMessage], visibility_timeout: float
+    ):
+        self._change_visibility(
+            [(message.id, message.receipt_handle) for message in messages],
+            visibility_timeout,
+        )
+
+    def requeue_messages(self, messages: List[LocalMessage]):
+        self.change_messages_visibility(messages, 0)
+
+    def count(self) -> int:
+        """
+            Number of messages in the queue, visible or not.
+        """
+        raise NotImplementedError
+
+    def _write(self, bodies: List[str]):
+        raise NotImplementedError
+
+    def _receive(
+        self, max_number_of_messages: int, visibility_timeout: float
+    ) -> List[ReceivedMessage]:
+        raise NotImplementedError
+
+    def _delete(self, handles: List[MessageHandle]):
+        raise NotImplementedError
+
+    def _change_visibility(
+        self, handles: List[MessageHandle], visibility_timeout: float
+    ):
+        raise NotImplementedError
+
+
+class LocalQueueState:
+    """
+        Messages of a MultiprocessingQueue, living in a manager process
+        and shared with every process through proxies. Messages become
+        visible in the order of a heap keyed by visibility time;
+        outdated heap entries are skipped.
+    """
+
+    def __init__(self):
+        # id -> [body, visible at, receipt handle]
+        self._messages = {}
+        self._heap = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _push(self, id: str, visible_at: float):
+        self._sequence += 1
+        heapq.heappush(self._heap, (visible_at, self._sequence, id))
+
+    def count(self) -> int:
+        return len(self._messages)
+
+    def write(self, bodies: List[str]):
+        now = time.time()
+        with self._lock:
+            for body in bodies:
+                id = str(uuid.uuid4())
+                self._messages[id] = [body, now, None]
+                self._push(id, now)
+
+    def receive(
+        self, max_number_of_messages: int, visibility_timeout: float
+    ) -> List[ReceivedMessage]:
+        now = time.time()
+        received = []
+        with self._lock:
+            while self._heap and len(received) < max_number_of_messages:
+                visible_at, _, id = self._heap[0]
+                if visible_at > now:
+                    break
+                heapq.heappop(self._heap)
+                message = self._messages.get(id)
+                if message is None or message[1] != visible_at:
+                    continue  # Deleted, or visibility changed since
+                receipt_handle = str(uuid.uuid4())
+                message[1:] = [now + visibility_timeout, receipt_handle]
+                self._push(id, message[1])
+                received.append((id, message[0], receipt_handle))
+        return received
+
+    def delete(self, handles: List[MessageHandle]):
+        with self._lock:
+            for id, receipt_handle in handles:
+                message = self._messages.get(id)
+                if message is not None and message[2] == receipt_handle:
+                    del self._messages[id]
+
+    def change_visibility(
+        self, handles: List[MessageHandle], visibility_timeout: float
+    ):
+        visible_at = time.time() + visibility_timeout
+        with self._lock:
+            for id, receipt_handle in handles:
+                message = self._messages.get(id)
+                if message is not None and message[2] == receipt_handle:
+                    message[1] = visible_at
+                    self._push(id, visible_at)
+
+
+class LocalQueueManager(multiprocessing.managers.BaseManager):
+    pass
+
+
+LocalQueueManager.register("LocalQueueState", LocalQueueState)
+
+
+class MultiprocessingQueue(LocalQueue):
+    """
+        In memory queue shared by the processes of this machine,
+        e.g. the workers of a DequeuerRunner. Messages live in a
+        manager process, started with the queue unless one is given;
+        they are lost when the manager stops.
+    """
+
+    MP_CONTEXT = "spawn"
+
+    def __init__(
+        self,
+        name: str,
+        manager: Optional[LocalQueueManager] = None,
+        **kwargs,
+    ):
+        super().__init__(name, **kwargs)
+        if manager is None:
+            manager = LocalQueueManager(
+                ctx=multiprocessing.get_context(self.MP_CONTEXT)
+            )
+            manager.start()
+        self._manager = manager
+        self._state = manager.LocalQueueState()
+
+    def __getstate__(self):
+        # The manager stays with the process that started it,
+        # other processes only need the proxy to its state
+        state = self.__dict__.copy()
+        state["_manager"] = None
+        return state
+
+    def count(self) -> int:
+        return self._state.count()
+
+    def _write(self, bodies: List[str]):
+        self._state.write(bodies)
+
+    def _receive(
+        self, max_number_of_messages: int, visibility_timeout: float
+    ) -> List[ReceivedMessage]:
+        return self._state.receive(max_number_of_messages, visibility_timeout)
+
+    def _delete(self, handles: List[MessageHandle]):
+        self._state.delete(handles)
+
+    def _change_visibility(
+        self, handles: List[MessageHandle], visibility_timeout: float
+    ):
+        self._state.change_visibility(handles, visibility_timeout)
+
+
+class SQLiteQueue(LocalQueue):
+    """
+        Durable queue in an SQLite file, which any process on this
+        machine can open. Reads claim messages in an immediate
+        transaction, so concurrent readers never get the same message
+        while it is hidden. Several queues can share a file.
+    """
+
+    def __init__(self, name: str, path: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self._path = path
+        # Opened on first use, in the process using the queue, and
+        # shared with the Dequeuer heartbeat thread under _lock
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _transaction(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            connection = self._get_connection()
+            with connection:
+                if immediate:
+                    connection.execute("BEGIN IMMEDIATE")
+                yield connection
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self._path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS queue_messages (
+                    sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue TEXT NOT NULL,
+                    id TEXT NOT NULL UNIQUE,
+                    body TEXT NOT NULL,
+                    visible_at REAL NOT NULL,
+                    receipt_handle TEXT
+                )
+                """
+            )
+            self._connection.execute(
+                """
+                CREATE INDEX IF NOT EXISTS queue_messages_visible_at
+                ON queue_messages (queue, visible_at)
+                """
+            )
+        return self._connection
+
+    def count(self) -> int:
+        with self._transaction() as connection:
+            (count,) = connection.execute(
+                "SELECT COUNT(*) FROM queue_messages WHERE queue = ?", (self.name,)
+            ).fetchone()
+        return count
+
+    def _write(self, bodies: List[str]):
+        now = time.time()
+        with self._transaction(immediate=True) as connection:
+            connection.executemany(
+                """
+                INSERT INTO queue_messages (queue, id, body, visible_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                [(self.name, str(uuid.uuid4()), body, now) for body in bodies],
+            )
+
+    def _receive(
+        self, max_number_of_messages: int, visibility_timeout: float
+    ) -> List[ReceivedMessage]:
+        now = time.time()
+        with self._transaction(immediate=True) as connection:
+            rows = connection.execute(
+                """
+                SELECT id, body FROM queue_messages
+                WHERE queue = ? AND visible_at <= ?
+                ORDER BY visible_at, sequence
+                LIMIT ?
+                """,
+                (self.name, now, max_number_of_messages),
+            ).fetchall()
+            received = [(id, body, str(uuid.uuid4())) for id, body in rows]
+            connection.executemany(
+                """
+                UPDATE queue_messages SET visible_at = ?, receipt_handle = ?
+                WHERE id = ?
+                """,
+                [
+                    (now + visibility_timeout, receipt_handle, id)
+                    for id, _, receipt_handle in received
+                ],
+            )
+        return received
+
+    def _delete(self, handles: List[MessageHandle]):
+        with self._transaction(immediate=True) as connection:
+            connection.executemany(
+                "DELETE FROM queue_messages WHERE id = ? AND receipt_handle = ?",
+                handles,
+            )
+
+    def _change_visibility(
+        self, handles: List[MessageHandle], visibility_timeout: float
+    ):
+        visible_at = time.time() + visibility_timeout
+        with self._transaction(immediate=True) as connection:
+            connection.executemany(
+                """
+                UPDATE queue_messages SET visible_at = ?
+                WHERE id = ? AND receipt_handle = ?
+                """,
+                [(visible_at, id, receipt_handle) for id, receipt_handle in handles],
+            )
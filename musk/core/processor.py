@@ -1,8 +1,24 @@
 import logging
 from musk.core import Message
 
+# How a Dequeuer runs a processor on the messages of one read,
+# see Dequeuer.dequeue
+SERIAL_CONCURRENCY = "serial"
+# Worker threads, for processors mostly waiting on I/O
+THREAD_CONCURRENCY = "thread"
+# Worker processes, for CPU bound processors. Messages are sent to them
+# detached from the queue, as DetachedMessage
+PROCESS_CONCURRENCY = "process"
+
 
 class Processor:
+
+    concurrency: str = SERIAL_CONCURRENCY
+
+    # Pooled MySQL connections held at once while processing a message,
+    # so that worker threads sharing the process pool can't exhaust it
+    mysql_connections: int = 0
+
     def __init__(self):
         self._logger = logging.getLogger(__name__)
 
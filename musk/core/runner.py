@@ -0,0 +1,157 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+from typing import List
+
+from musk.config import Config, DequeuerConfig
+from musk.core.dequeuer import Dequeuer
+
+
+class GracefulKiller:
+    kill_now = False
+
+    def __init__(self):
+        self._logger = logging.getLogger(__name__)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+
+    def exit_gracefully(self, signum, frame):
+        self._logger.info("Received signal to exit gracefully.")
+        self.kill_now = True
+
+
+class DequeuerWorker:
+    """
+        Body of a long lived worker process. It keeps looping over its
+        dequeuers, so imported modules, pooled connections and cached
+        neighbour tables survive from one message to the next, until
+        it is asked to stop or has processed max_messages messages
+        (0 meaning no limit), after which the runner replaces it.
+    """
+
+    def __init__(
+        self,
+        dequeuers: List[Dequeuer],
+        stop_event,
+        max_messages: int = 0,
+        idle_sleep: float = 2,
+    ):
+        self._dequeuers = dequeuers
+        self._stop_event = stop_event
+        self._max_messages = max_messages
+        self._idle_sleep = idle_sleep
+        self._logger = logging.getLogger(__name__)
+
+    def _should_stop(self, killer: GracefulKiller) -> bool:
+        return killer.kill_now or self._stop_event.is_set()
+
+    def run(self) -> int:
+        """
+            Dequeue until stopped, returning the number of messages
+            processed. A message being processed when SIGTERM arrives
+            is finished first.
+        """
+        killer = GracefulKiller()
+        processed = 0
+
+        while not self._should_stop(killer):
+            processed_now = 0
+            for dequeuer in self._dequeuers:
+                try:
+                    processed_now += dequeuer.dequeue()
+                except:
+                    self._logger.exception("Exception in worker: ")
+                if self._should_stop(killer):
+                    break
+
+            processed += processed_now
+            if self._max_messages and processed >= self._max_messages:
+                self._logger.info(
+                    f"Worker processed {processed} messages, recycling."
+                )
+                break
+
+            if processed_now == 0:
+                self._stop_event.wait(self._idle_sleep)
+
+        for dequeuer in self._dequeuers:
+            dequeuer.close()
+        return processed
+
+
+def run_worker(
+    dequeuers: List[Dequeuer], stop_event, max_messages: int, idle_sleep: float
+):
+    DequeuerWorker(dequeuers, stop_event, max_messages, idle_sleep).run()
+
+
+class DequeuerRunner:
+    """
+        Keeps PROCESS_COUNT worker processes alive, each running a
+        DequeuerWorker over all dequeuers. Workers exiting after
+        MAX_MESSAGES_PER_CHILD messages are replaced. On SIGTERM the
+        workers are asked to stop after their current message and
+        the runner waits for them before returning.
+    """
+
+    MP_CONTEXT = "spawn"
+
+    def __init__(self, dequeuers: List[Dequeuer], config: Config = DequeuerConfig):
+        self._logger = logging.getLogger(__name__)
+
+        self._dequeuers = dequeuers
+        self._config = config
+
+        self._process_count = self._config.PROCESS_COUNT
+        self._processes = []
+
+        self._killer = GracefulKiller()
+
+        self._context = multiprocessing.get_context(self.MP_CONTEXT)
+        self._stop_event = self._context.Event()
+
+    def dequeue(self) -> None:
+
+        while True:
+
+            alive_processes = []
+            for process in self._processes:
+                if process.is_alive():
+                    alive_processes.append(process)
+                else:
+                    self._logger.debug(
+                        "Process %s exited with code %s.", process.pid, process.exitcode
+                    )
+                    process.close()
+
+            self._processes = alive_processes
+
+            # If we received a SIGTERM, wait on child processes and then quit
+            if self._killer.kill_now:
+                self._stop_event.set()
+                for process in self._processes:
+                    self._logger.debug("Waiting on PID %s", process.pid)
+                    process.join()
+
+                break
+
+            # Replace workers that exited (recycled or crashed)
+            while len(self._processes) < self._process_count:
+                self._processes.append(self._spawn_process())
+                self._logger.debug("Spawning new process")
+
+            time.sleep(2)
+
+    def _spawn_process(self) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                self._dequeuers,
+                self._stop_event,
+                self._config.MAX_MESSAGES_PER_CHILD,
+                self._config.IDLE_SLEEP,
+            ),
+        )
+        process.start()
+        return process
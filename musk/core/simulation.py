@@ -1,2 +1,6 @@
 class Simulation:
-    pass
+    def get_models(self) -> list:
+        """
+            Models produced by the simulation, once it has run.
+        """
+        return [self.model]
@@ -1,58 +1,429 @@
+import contextlib
 import logging
+import os
+import queue
+import threading
+import time
 
 import mysql.connector
 import pymysql
 from musk.config.config import MySQLConfig
 
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
 MySQLConnection = mysql.connector.connection.MySQLConnection
 
 logging.captureWarnings(True)
 
+# Client errors meaning the connection to the server is gone
+# (2006: server has gone away, 2013: lost connection during query)
+DISCONNECT_ERROR_CODES = {2006, 2013}
 
-class MySQL:
 
-    _config: MySQLConfig
-    _connection: MySQLConnection
+# Kinds of items passed from the MySQL.stream producer thread
+_STREAM_ROW, _STREAM_ERROR, _STREAM_END = range(3)
 
-    def __init__(self):
-        self._config = MySQLConfig
-        self._connection = self._get_new_connection()
-        self._logger = logging.getLogger(__file__)
 
-    def _get_connection_config(self) -> dict:
+class ConnectionPoolTimeout(Exception):
+    pass
+
+
+def is_disconnect_error(exception: Exception) -> bool:
+    if isinstance(exception, pymysql.err.InterfaceError):
+        return True
+    if isinstance(exception, pymysql.err.OperationalError):
+        return bool(exception.args) and exception.args[0] in DISCONNECT_ERROR_CODES
+    return False
+
+
+class MySQLConnectionPool:
+    """
+        Thread safe pool of at most size connections. Idle connections
+        are reused last in, first out, and pinged before being handed
+        out when idle for longer than ping_interval seconds, so a
+        connection dropped by the server is replaced instead of failing
+        the next query.
+
+        There is one pool per process (see get_instance), since pymysql
+        connections must not be shared across forks. Code running
+        several threads that each hold connections grows it with reserve.
+    """
+
+    _instances: Dict[int, "MySQLConnectionPool"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        connection_factory: Callable[[], MySQLConnection],
+        size: int,
+        timeout: float,
+        ping_interval: float,
+    ):
+        self._connection_factory = connection_factory
+        self._size = size
+        self._timeout = timeout
+        self._ping_interval = ping_interval
+        # Idle connections, with the time they were returned
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+        self._size_lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @classmethod
+    def get_instance(cls) -> "MySQLConnectionPool":
+        pid = os.getpid()
+        with cls._instances_lock:
+            if pid not in cls._instances:
+                cls._instances[pid] = cls(
+                    connection_factory=cls._get_new_connection,
+                    size=MySQLConfig.POOL_SIZE,
+                    timeout=MySQLConfig.POOL_TIMEOUT,
+                    ping_interval=MySQLConfig.POOL_PING_INTERVAL,
+                )
+            return cls._instances[pid]
+
+    @staticmethod
+    def _get_connection_config() -> dict:
         return dict(
-            host=self._config.HOST,
-            port=self._config.PORT,
-            user=self._config.USER,
-            password=self._config.PASSWORD,
-            database=self._config.DATABASE,
-            connect_timeout=self._config.CONNECTION_TIMEOUT,
+            host=MySQLConfig.HOST,
+            port=MySQLConfig.PORT,
+            user=MySQLConfig.USER,
+            password=MySQLConfig.PASSWORD,
+            database=MySQLConfig.DATABASE,
+            connect_timeout=MySQLConfig.CONNECTION_TIMEOUT,
             autocommit=True,
             binary_prefix=True,
         )
 
-    def _get_new_connection(self) -> MySQLConnection:
-        config = self._get_connection_config()
+    @classmethod
+    def _get_new_connection(cls) -> MySQLConnection:
+        return pymysql.connect(**cls._get_connection_config())
+
+    def get_size(self) -> int:
+        return self._size
+
+    def reserve(self, size: int):
+        """
+            Grow the pool to at least size connections. Pools never shrink.
+        """
+        with self._size_lock:
+            for _ in range(size - self._size):
+                self._slots.release()
+            self._size = max(self._size, size)
 
-        connection = pymysql.connect(**config)
-        return connection
+    def get_idle_count(self) -> int:
+        return self._idle.qsize()
 
-    def fetch(self, query: str, parameters: tuple = ()):
-        cursor = self._connection.cursor(pymysql.cursors.SSDictCursor)
-        cursor.execute(query, parameters)
-        results = list(cursor.fetchall_unbuffered())
-        cursor.close()
-        return results
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[MySQLConnection]:
+        """
+            Borrow a connection for the duration of the with block.
+            Connections that failed with a disconnect error are closed
+            instead of going back to the pool.
+        """
+        if not self._slots.acquire(timeout=self._timeout):
+            raise ConnectionPoolTimeout(
+                f"No MySQL connection available after {self._timeout}s "
+                f"(pool size {self._size})."
+            )
 
-    def execute(self, query: str, parameters: dict):
-        cursor = self._connection.cursor()
+        connection = None
         try:
-            cursor.execute(query, parameters)
-            self._connection.commit()
-        except:
-            self._logger.debug(cursor._last_executed)
-            self._logger.debug(parameters)
-            self._connection.rollback()
+            connection = self._checkout()
+            yield connection
+        except Exception as exception:
+            if connection is not None and is_disconnect_error(exception):
+                self._discard(connection)
+                connection = None
             raise
         finally:
-            cursor.close()
+            if connection is not None:
+                self._idle.put((connection, time.monotonic()))
+            self._slots.release()
+
+    def _checkout(self) -> MySQLConnection:
+        while True:
+            try:
+                connection, returned_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connection_factory()
+
+            if time.monotonic() - returned_at < self._ping_interval:
+                return connection
+            try:
+                connection.ping(reconnect=False)
+                return connection
+            except Exception:
+                self._logger.info("Dropping stale MySQL connection.")
+                self._discard(connection)
+
+    def _discard(self, connection: MySQLConnection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+
+class _Attempt:
+    """
+        Tracks whether an operation run by MySQL._run already sent
+        a statement that changes data.
+    """
+
+    def __init__(self):
+        self.sent = False
+
+
+class MySQL:
+    """
+        Runs queries on connections borrowed from the process wide
+        MySQLConnectionPool, so creating instances is cheap. Queries
+        failing because the connection was lost are retried once on
+        a fresh connection.
+
+        Writes are only retried when the connection was lost before
+        they were sent, or when they are idempotent (e.g. upserts):
+        a connection lost during COMMIT may hide a write that was
+        applied, and running a plain INSERT again would duplicate it.
+    """
+
+    _config: MySQLConfig
+    _pool: MySQLConnectionPool
+
+    def __init__(self, pool: Optional[MySQLConnectionPool] = None):
+        self._config = MySQLConfig
+        self._pool = pool or MySQLConnectionPool.get_instance()
+        self._logger = logging.getLogger(__file__)
+
+    def _run(
+        self,
+        operation: Callable[[MySQLConnection, _Attempt], object],
+        idempotent: bool = True,
+    ):
+        attempt = _Attempt()
+        try:
+            with self._pool.connection() as connection:
+                return operation(connection, attempt)
+        except Exception as exception:
+            if not is_disconnect_error(exception):
+                raise
+            if attempt.sent and not idempotent:
+                self._logger.warning(
+                    f"MySQL connection lost ({exception}) after a write was "
+                    "sent, not retrying."
+                )
+                raise
+            self._logger.warning(f"MySQL connection lost ({exception}), retrying.")
+
+        with self._pool.connection() as connection:
+            return operation(connection, _Attempt())
+
+    def fetch(self, query: str, parameters: tuple = ()) -> List[dict]:
+        def fetch(connection, attempt):
+            cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+            try:
+                cursor.execute(query, parameters)
+                return list(cursor.fetchall_unbuffered())
+            finally:
+                cursor.close()
+
+        return self._run(fetch)
+
+    def stream(
+        self,
+        query: str,
+        parameters: tuple = (),
+        prefetch: Optional[int] = None,
+        transform: Optional[Callable[[dict], Any]] = None,
+    ) -> Iterator[Any]:
+        """
+            Yield the rows of query one at a time. A background thread
+            reads rows from an unbuffered cursor and applies transform
+            (e.g. decompressing and decoding a model) to them, keeping
+            at most prefetch results ahead of the consumer, so rows are
+            fetched while earlier ones are processed and memory does
+            not grow with the number of rows.
+
+            The stream holds its own pooled connection until it is
+            exhausted or closed, so other queries can run meanwhile.
+        """
+        prefetch = prefetch or self._config.STREAM_PREFETCH
+        transform = transform or (lambda row: row)
+        results: queue.Queue = queue.Queue(maxsize=prefetch)
+        stopped = threading.Event()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                with self._pool.connection() as connection:
+                    cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+                    try:
+                        cursor.execute(query, parameters)
+                        for row in cursor.fetchall_unbuffered():
+                            if not put((_STREAM_ROW, transform(row))):
+                                break
+                    finally:
+                        cursor.close()
+            except Exception as exception:
+                put((_STREAM_ERROR, exception))
+            else:
+                put((_STREAM_END, None))
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                kind, item = results.get()
+                if kind == _STREAM_END:
+                    return
+                if kind == _STREAM_ERROR:
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            producer.join()
+
+    def execute(self, query: str, parameters: dict, idempotent: bool = False):
+        """
+            Run a single write. Pass idempotent=True for queries that
+            can safely run twice, so they are retried on a lost connection.
+        """
+
+        def execute(connection, attempt):
+            cursor = connection.cursor()
+            try:
+                attempt.sent = True
+                cursor.execute(query, parameters)
+                connection.commit()
+            except:
+                self._logger.debug(cursor._last_executed)
+                self._logger.debug(parameters)
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        self._run(execute, idempotent)
+
+    def execute_many(
+        self, query: str, rows: Sequence[dict], idempotent: bool = False
+    ):
+        """
+            Run query once per row in a single transaction. INSERT
+            queries are sent as multi-row INSERTs by pymysql; their
+            ON DUPLICATE KEY UPDATE clause is not formatted, so it must
+            refer to VALUES(column) instead of row parameters.
+        """
+        self.execute_batches([(query, rows)], idempotent)
+
+    def execute_batches(
+        self,
+        batches: Sequence[Tuple[str, Sequence[dict]]],
+        idempotent: bool = False,
+    ):
+        """
+            Run several (query, rows) batches in a single transaction.
+        """
+
+        def execute_batches(connection, attempt):
+            cursor = connection.cursor()
+            try:
+                connection.begin()
+                attempt.sent = True
+                for query, rows in batches:
+                    cursor.executemany(query, rows)
+                connection.commit()
+            except:
+                self._logger.debug(cursor._last_executed)
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        self._run(execute_batches, idempotent)
+
+
+class BulkWriter:
+    """
+        Buffers rows and writes them with MySQL.execute_batches, all
+        buffered queries in one transaction. Rows are flushed once
+        max_rows are buffered or the oldest buffered row is max_delay
+        seconds old (checked when rows are added), and when leaving
+        the with block without an exception:
+
+            with BulkWriter() as writer:
+                for model in models:
+                    writer.add(query, model.to_db())
+
+        Rows still buffered when the block raises are dropped.
+        Pass idempotent=True when every query is an upsert, so that
+        flushes are retried on a lost connection (see MySQL).
+    """
+
+    def __init__(
+        self,
+        mysql: Optional[MySQL] = None,
+        max_rows: Optional[int] = None,
+        max_delay: Optional[float] = None,
+        idempotent: bool = False,
+    ):
+        self._mysql = mysql or MySQL()
+        self._idempotent = idempotent
+        self._max_rows = max_rows or MySQLConfig.BULK_MAX_ROWS
+        self._max_delay = max_delay or MySQLConfig.BULK_MAX_DELAY
+        self._rows: Dict[str, List[dict]] = defaultdict(list)
+        self._row_count = 0
+        self._first_added_at = None
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.flush()
+        else:
+            self.clear()
+
+    def add(self, query: str, row: dict):
+        if self._first_added_at is None:
+            self._first_added_at = time.monotonic()
+        self._rows[query].append(row)
+        self._row_count += 1
+
+        if (
+            self._row_count >= self._max_rows
+            or time.monotonic() - self._first_added_at >= self._max_delay
+        ):
+            self.flush()
+
+    def get_buffered_count(self) -> int:
+        return self._row_count
+
+    def flush(self):
+        if self._row_count:
+            self._mysql.execute_batches(
+                list(self._rows.items()), idempotent=self._idempotent
+            )
+        self.clear()
+
+    def clear(self):
+        self._rows = defaultdict(list)
+        self._row_count = 0
+        self._first_added_at = None
@@ -0,0 +1,98 @@
+import json
+import logging
+import sqlite3
+import threading
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Sequence, Set
+
+import numpy
+
+
+class SQLiteStore:
+    """
+        Local stand-in for the MySQL tables, in a single SQLite file.
+        Tables get an integer id primary key and are created, or get
+        new columns, as rows with new keys are inserted, since SQLite
+        columns need no declared type.
+
+        Values SQLite can't store (datetimes, numpy scalars, dicts)
+        are converted on insert.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._columns: Dict[str, Set[str]] = {}
+        self._logger = logging.getLogger(__name__)
+
+    def __enter__(self) -> "SQLiteStore":
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _to_sqlite(value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, timedelta):
+            return value.total_seconds()
+        if isinstance(value, numpy.generic):
+            return value.item()
+        if isinstance(value, (dict, list, tuple)):
+            return json.dumps(value)
+        return value
+
+    def _get_columns(self, table: str) -> Set[str]:
+        if table not in self._columns:
+            cursor = self._connection.execute(f'PRAGMA table_info("{table}")')
+            self._columns[table] = {row["name"] for row in cursor}
+        return self._columns[table]
+
+    def _ensure_columns(self, table: str, names: Sequence[str]):
+        columns = self._get_columns(table)
+        if not columns:
+            self._connection.execute(
+                f'CREATE TABLE "{table}" (id INTEGER PRIMARY KEY AUTOINCREMENT)'
+            )
+            columns.add("id")
+        for name in names:
+            if name not in columns:
+                self._connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}"')
+                columns.add(name)
+
+    def insert_many(self, table: str, rows: Sequence[dict]) -> List[int]:
+        """
+            Insert rows in a single transaction, returning their ids.
+            A row "id" of None is left for SQLite to assign.
+        """
+        ids = []
+        with self._lock, self._connection:
+            for row in rows:
+                row = {
+                    key: self._to_sqlite(value)
+                    for key, value in row.items()
+                    if not (key == "id" and value is None)
+                }
+                self._ensure_columns(table, list(row))
+                column_names = ", ".join(f'"{key}"' for key in row)
+                placeholders = ", ".join(f":{key}" for key in row)
+                cursor = self._connection.execute(
+                    f'INSERT INTO "{table}" ({column_names}) VALUES ({placeholders})',
+                    row,
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def insert(self, table: str, row: dict) -> int:
+        return self.insert_many(table, [row])[0]
+
+    def fetch(self, query: str, parameters: Sequence = ()) -> List[dict]:
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(query, parameters)]
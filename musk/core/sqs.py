@@ -5,17 +5,70 @@ import uuid
 
 import boto3
 
+from typing import Iterator, List
+
+from musk.config import SQSConfig
+
 logger = logging.getLogger(__file__)
 
+# Largest number of entries SQS accepts in a single batch call
+SQS_MAX_BATCH_SIZE = 10
+
+
+def get_batches(items: list, batch_size: int = SQS_MAX_BATCH_SIZE) -> Iterator[list]:
+    for start in range(0, len(items), batch_size):
+        yield items[start : start + batch_size]
+
 
 class Queue:
-    pass
+    def delete_messages(self, messages: list):
+        """
+            Delete messages that were processed. Queues supporting
+            batch calls override this, by default messages are
+            deleted one by one.
+        """
+        for message in messages:
+            message.delete()
+
+    def requeue_messages(self, messages: list):
+        """
+            Make messages visible to other readers again right away.
+        """
+        for message in messages:
+            message.requeue()
+
+    def change_messages_visibility(self, messages: list, visibility_timeout: int):
+        for message in messages:
+            message.change_visibility(visibility_timeout)
+
+    def get_visibility_timeout(self):
+        """
+            Seconds a read message stays hidden from other readers,
+            None when messages never become visible again by themselves.
+        """
+        return None
 
 
 class Message:
     pass
 
 
+class DetachedMessage(Message):
+    """
+        A copy of the id and body of a message, which can be sent to
+        other processes. It can't be acknowledged, that is left to
+        whoever holds the original message.
+    """
+
+    def __init__(self, id: str, body: dict):
+        self.id = id
+        self.body = body
+
+    @classmethod
+    def from_message(cls, message: Message) -> "DetachedMessage":
+        return cls(message.id, message.body)
+
+
 class SQSMessage:
     """
         This class is a simple wrapper around
@@ -34,7 +87,7 @@ class SQSMessage:
             using credentials present in ~/.aws
             or in env vars.
         """
-        sqs = boto3.resource("sqs")
+        sqs = boto3.resource("sqs", endpoint_url=SQSConfig.ENDPOINT_URL)
         return sqs
 
     @property
@@ -50,11 +103,22 @@ class SQSMessage:
     def attributes(self):
         return self._messsage.attributes
 
+    @property
+    def receipt_handle(self):
+        return self._message.receipt_handle
+
     def delete(self):
         return self._message.delete()
 
     def requeue(self):
-        self._message.change_visibility(VisibilityTimeout=0)
+        self.change_visibility(0)
+
+    def change_visibility(self, visibility_timeout: int):
+        """
+            Hide the message from other readers for visibility_timeout
+            seconds, counting from now.
+        """
+        self._message.change_visibility(VisibilityTimeout=visibility_timeout)
 
     def __init__(self, message):
         # This represents the internal boto3 message object
@@ -76,6 +140,7 @@ class SQSQueue(Queue):
     # These are all SQS queue properties
     sqs_message_retention_period: int = 60 * 60 * 24 * 4  # 4 Days
     sqs_visibility_timeout: int = 60
+    sqs_receive_wait_time_seconds: int = SQSConfig.WAIT_TIME_SECONDS
 
     # These are internal properties, used only by this code
     _sleep_interval: int
@@ -90,17 +155,23 @@ class SQSQueue(Queue):
     QUEUE_PROPERTIES_MAPPING = {
         "VisibilityTimeout": "sqs_visibility_timeout",
         "MessageRetentionPeriod": "sqs_message_retention_period",
+        "ReceiveMessageWaitTimeSeconds": "sqs_receive_wait_time_seconds",
     }
     # This is the error code present in the factory exceptions.
     # We need to check this error code string to know which exception occured.
     NONEXISTANT_QUEUE_ERROR_CODE = "AWS.SimpleQueueService.NonExistentQueue"
 
     def __init__(
-        self, queue_environment: str, sleep_interval: int = 2,
+        self,
+        queue_environment: str,
+        sleep_interval: int = 2,
+        wait_time_seconds: int = SQSConfig.WAIT_TIME_SECONDS,
     ):
 
         self.queue_environment = queue_environment
         self._sleep_interval = sleep_interval
+        # Long polling: receive calls wait up to this long for messages
+        self._wait_time_seconds = wait_time_seconds
 
         self._sqs = None
         self._queue = None
@@ -117,7 +188,7 @@ class SQSQueue(Queue):
             using credentials present in ~/.aws
             or in env vars.
         """
-        sqs = boto3.resource("sqs")
+        sqs = boto3.resource("sqs", endpoint_url=SQSConfig.ENDPOINT_URL)
         return sqs
 
     def get_queue_resource(self):
@@ -190,7 +261,8 @@ class SQSQueue(Queue):
 
     def write(self, messages):
         """
-            Writes multiple messages to the queue
+            Writes multiple messages to the queue,
+            in batches of at most 10 messages
         """
         queue = self.get_queue_resource()
         if type(messages) is not list:
@@ -200,8 +272,9 @@ class SQSQueue(Queue):
             {"MessageBody": json.dumps(message), "Id": str(uuid.uuid4())}
             for message in messages
         ]
-        response = queue.send_messages(Entries=messages)
-        self._assert_write_succesfull(response)
+        for batch in get_batches(messages):
+            response = queue.send_messages(Entries=batch)
+            self._assert_write_succesfull(response)
 
     def _assert_write_succesfull(self, response):
         if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
@@ -217,26 +290,74 @@ class SQSQueue(Queue):
 
     def read(self, max_number_of_messages: int = 1):
         """
-            Reads the messages present in the queue *right now*
-            and returns as soon as the queue is empty
+            Reads the messages present in the queue, waiting up to
+            wait_time_seconds for messages to arrive when it is empty
         """
         queue = self.get_queue_resource()
         for message in queue.receive_messages(
-            MaxNumberOfMessages=max_number_of_messages
+            MaxNumberOfMessages=min(max_number_of_messages, SQS_MAX_BATCH_SIZE),
+            WaitTimeSeconds=self._wait_time_seconds,
         ):
 
             yield SQSMessage(message)
 
     def read_forever(self, max_number_of_messages_per_read: int = 1):
         """
-            Keeps reading and yielding messages forever,
-            with a small interval between successive reads
+            Keeps reading and yielding messages forever. Without
+            long polling, there is a small interval between reads
         """
         while True:
             for message in self.read(max_number_of_messages_per_read):
                 yield message
-            logger.info("Sleeping...")
-            time.sleep(self._sleep_interval)
+            if not self._wait_time_seconds:
+                logger.info("Sleeping...")
+                time.sleep(self._sleep_interval)
+
+    def delete_messages(self, messages: List[SQSMessage]):
+        """
+            Deletes messages with one API call per 10 messages
+        """
+        queue = self.get_queue_resource()
+        for batch in get_batches(messages):
+            entries = [
+                {"Id": str(index), "ReceiptHandle": message.receipt_handle}
+                for index, message in enumerate(batch)
+            ]
+            response = queue.delete_messages(Entries=entries)
+            self._assert_batch_succesfull("delete", response)
+
+    def change_messages_visibility(
+        self, messages: List[SQSMessage], visibility_timeout: int
+    ):
+        """
+            Changes the visibility timeout of messages,
+            with one API call per 10 messages
+        """
+        queue = self.get_queue_resource()
+        for batch in get_batches(messages):
+            entries = [
+                {
+                    "Id": str(index),
+                    "ReceiptHandle": message.receipt_handle,
+                    "VisibilityTimeout": visibility_timeout,
+                }
+                for index, message in enumerate(batch)
+            ]
+            response = queue.change_message_visibility_batch(Entries=entries)
+            self._assert_batch_succesfull("change visibility", response)
+
+    def requeue_messages(self, messages: List[SQSMessage]):
+        self.change_messages_visibility(messages, 0)
+
+    def get_visibility_timeout(self) -> int:
+        return self.sqs_visibility_timeout
+
+    def _assert_batch_succesfull(self, action: str, response: dict):
+        if response.get("Failed"):
+            logger.error(
+                f"Batch {action} failed for some messages: "
+                f"{json.dumps(response['Failed'], indent=4)}"
+            )
 
     def get_queue_name(self):
         name = f"{self.name}_{self.queue_environment}"
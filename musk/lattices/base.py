@@ -1,33 +1,81 @@
 import logging
-import random
 import functools
 
-from ..exceptions import InvalidStateException
+import numpy
 
+from ..exceptions import InvalidStateException
+from ..misc.observables import get_clusters_from_labels
+from .labeling import ClusterSizes, IncrementalLabeler, Labeler, Labels, get_labeler
+from .neighbours import Offset, build_neighbour_table
 
-from typing import Dict, Tuple, Generator, List, FrozenSet, Set
 
-from typing import Generator
+from typing import Tuple, Generator, List, FrozenSet, Set, Union
 
 Node1DIndex = int
 NodeIndex = Tuple[Node1DIndex, ...]
 State = int
 Cluster = FrozenSet[NodeIndex]
+# Anything numpy.random.default_rng accepts
+Seed = Union[None, int, numpy.random.SeedSequence, numpy.random.Generator]
+
+
+# Number of neighbour tables kept per process. A Mandelbrot simulation
+# needs one table per division level, each lattice doubling the side of
+# the previous one, so the smaller levels together take about a third of
+# the memory of the largest. Tables are (N, k) int32 arrays, so the cache
+# is bounded rather than keeping every size seen by the process.
+NEIGHBOUR_TABLE_CACHE_SIZE = 16
+
+
+@functools.lru_cache(maxsize=NEIGHBOUR_TABLE_CACHE_SIZE)
+def _get_cached_neighbour_table(
+    shape: Tuple[int, ...], offsets: Tuple[Offset, ...], periodic: bool
+) -> numpy.ndarray:
+    return build_neighbour_table(shape, offsets, periodic)
 
 
 class Lattice:
 
+    # Node states are stored in a dense array, one entry per node.
+    # Entries equal to UNINITIALIZED_STATE were never set.
+    STATE_DTYPE = numpy.uint8
+    UNINITIALIZED_STATE = numpy.iinfo(STATE_DTYPE).max
+
+    # Whether opposite edges of the lattice are connected
+    _periodic = False
+
+    # Offsets to the neighbours of a node, one per neighbour table column
+    _neighbour_offsets: Tuple[Offset, ...] = ()
+
+    DEFAULT_LABELING_BACKEND = "python"
+
     _size: int
-    _state: Dict
+    _state: numpy.ndarray
+    _labeler: Labeler
+
+    def __init__(
+        self,
+        size,
+        labeling_backend: str = DEFAULT_LABELING_BACKEND,
+        incremental_labeling: bool = False,
+    ):
+        self._size = size
+        self._state = numpy.full(
+            self._get_shape(), self.UNINITIALIZED_STATE, dtype=self.STATE_DTYPE
+        )
+        self._labeler = get_labeler(labeling_backend)
+        if incremental_labeling:
+            # Reuse labels across divisions, see IncrementalLabeler
+            self._labeler = IncrementalLabeler(self._labeler)
 
-    def __init__(self, size):
-        self._state = {}
+    def _get_shape(self) -> Tuple[int, ...]:
+        raise NotImplementedError
 
     def get_all_nodes(self) -> List[NodeIndex]:
         raise NotImplemented
 
     def get_number_of_nodes(self) -> int:
-        raise NotImplemented
+        return self._state.size
 
     def get_neighbour_nodes(self, *node: Node1DIndex) -> Set[NodeIndex]:
         raise NotImplemented
@@ -35,84 +83,127 @@ class Lattice:
     def get_size(self) -> int:
         return self._size
 
-    def _get_node_key(self, *indexes) -> str:
+    def get_neighbour_table(self) -> numpy.ndarray:
+        """
+            Return a read-only (N, k) int32 array where row n holds the
+            flat indexes of the neighbours of node n (nodes numbered in
+            as_array().ravel() order), -1 meaning no neighbour.
+            Column c is the neighbour at get_neighbour_offsets()[c].
 
-        if len(indexes) == 0:
-            raise ValueError("Empty indexes received")
+            Tables are shared by lattices with the same shape and
+            neighbours, see _get_cached_neighbour_table.
+        """
+        return _get_cached_neighbour_table(
+            self._get_shape(), tuple(self._neighbour_offsets), self._periodic
+        )
+
+    def get_neighbour_offsets(self) -> Tuple[Offset, ...]:
+        return self._neighbour_offsets
+
+    @classmethod
+    def is_periodic(cls) -> bool:
+        """
+            Whether opposite edges of the lattice are connected.
+        """
+        return cls._periodic
 
-        return "_".join(map(str, indexes))
+    def as_array(self) -> numpy.ndarray:
+        """
+            Return the array holding the state of every node.
+            This is the lattice storage itself, not a copy, so
+            changes made to it are reflected in the lattice.
+        """
+        return self._state
 
     def get_nodes_with_state(self, state: State) -> Generator:
-        for index in self.get_all_nodes():
-            if self.get_state_at_node(*index) == state:
-                yield index
+        for index in zip(*numpy.nonzero(self._state == state)):
+            yield tuple(map(int, index))
 
     def get_state_at_node(self, *indexes: Node1DIndex) -> State:
 
-        node_key = self._get_node_key(*indexes)
+        if len(indexes) == 0:
+            raise ValueError("Empty indexes received")
 
         try:
-            return self._state[node_key]
-        except KeyError:
+            if min(indexes) < 0:
+                raise IndexError
+            state = self._state[indexes]
+        except IndexError:
+            state = self.UNINITIALIZED_STATE
+
+        if state == self.UNINITIALIZED_STATE:
+            node_key = "_".join(map(str, indexes))
             raise InvalidStateException(
                 f"Node at position ({node_key}) is not initialized."
             )
 
+        return int(state)
+
     def set_state_at_node(self, state: State, *indexes: Node1DIndex):
 
-        node_key = self._get_node_key(*indexes)
-        self._state[node_key] = state
+        if len(indexes) == 0:
+            raise ValueError("Empty indexes received")
+
+        self._state[indexes] = state
+
+    def fill_randomly(
+        self, state_choices: List[State], state_weights: list = [], seed: Seed = None
+    ):
+        """
+            Set every node to one of state_choices, drawn with
+            probabilities proportional to state_weights (uniform when
+            no weights are given), all in a single draw.
+            seed is passed to numpy.random.default_rng, so it can be an
+            int, a SeedSequence, or a Generator to draw from.
+        """
+        random_generator = numpy.random.default_rng(seed)
 
-    def fill_randomly(self, state_choices: List[State], state_weights: list = []):
+        if state_weights:
+            weights = numpy.asarray(state_weights, dtype=float)
+            weights = weights / weights.sum()
+        else:
+            weights = None
 
-        states = random.choices(
-            state_choices, weights=state_weights, k=self.get_number_of_nodes()
+        choice_indexes = random_generator.choice(
+            len(state_choices), size=self._state.shape, p=weights
         )
-        node_indexes = self.get_all_nodes()
+        states = numpy.asarray(state_choices, dtype=self.STATE_DTYPE)
+        self._state[...] = states[choice_indexes]
 
-        for node_index, state in zip(node_indexes, states):
-            self.set_state_at_node(state, *node_index)
+    def get_cluster_labels(self, state: State) -> Tuple[Labels, ClusterSizes]:
+        """
+            Label all clusters whose state equals state.
+            Return an integer array with the lattice shape, where
+            nodes in the same cluster share a label (starting at 1)
+            and every other node is 0, together with the size of
+            each label.
+        """
+        # Only build the neighbour table for labelers that walk it
+        neighbour_table = None
+        if self._labeler.uses_neighbour_table:
+            neighbour_table = self.get_neighbour_table()
+        return self._labeler.label(
+            self._state == state,
+            periodic=self._periodic,
+            neighbour_table=neighbour_table,
+        )
 
     def get_clusters_with_state(self, state: State) -> FrozenSet[Cluster]:
         """
             Return all clusters present in the lattice
             whose state equals state.
         """
-
-        clusters: set = set()
-        for node in self.get_all_nodes():
-            if self.get_state_at_node(*node) != state:
-                continue
-
-            cluster = []  # otherwise outer if breaks
-            for cluster in clusters:
-                if node in cluster:
-                    break
-            if node in cluster:
-                continue
-
-            clusters.add(self.get_cluster(node))
-
-        return frozenset(clusters)
+        labels, _ = self.get_cluster_labels(state)
+        return self._get_clusters_from_labels(labels)
 
     def get_cluster(self, start_node: NodeIndex) -> Cluster:
         """
             Return the cluster start_node belongs to.
         """
         start_node_state = self.get_state_at_node(*start_node)
-        visited, stack = set(), set([start_node])
-        while stack:
-            node = stack.pop()
-            if node in visited:
-                continue
-            visited.add(node)
-            neighbors = self.get_neighbour_nodes(*node)
-            stack.update(
-                filter(
-                    lambda neighbor: self.get_state_at_node(*neighbor)
-                    == start_node_state,
-                    neighbors,
-                )
-            )
+        labels, _ = self.get_cluster_labels(start_node_state)
+        nodes = numpy.argwhere(labels == labels[tuple(start_node)]).tolist()
+        return frozenset(map(tuple, nodes))
 
-        return frozenset(visited)
+    def _get_clusters_from_labels(self, labels: Labels) -> FrozenSet[Cluster]:
+        return get_clusters_from_labels(labels)
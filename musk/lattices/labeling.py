@@ -0,0 +1,528 @@
+import numpy
+import scipy.ndimage
+
+from typing import Dict, List, Optional, Tuple, Type
+
+from .neighbours import build_neighbour_table, get_axis_offsets
+
+Labels = numpy.ndarray
+ClusterSizes = numpy.ndarray
+
+
+class UnionFind:
+    """
+        Disjoint sets over the integers 0..n-1, using union
+        by size and path halving.
+    """
+
+    def __init__(self, number_of_elements: int = 0):
+        self._parents: List[int] = list(range(number_of_elements))
+        self._sizes: List[int] = [1] * number_of_elements
+
+    def __len__(self) -> int:
+        return len(self._parents)
+
+    def add(self) -> int:
+        """
+            Add a new singleton set and return its element.
+        """
+        element = len(self._parents)
+        self._parents.append(element)
+        self._sizes.append(1)
+        return element
+
+    def find(self, element: int) -> int:
+        parents = self._parents
+        while parents[element] != element:
+            parents[element] = parents[parents[element]]
+            element = parents[element]
+        return element
+
+    def union(self, first: int, second: int) -> int:
+        """
+            Merge the sets containing first and second,
+            and return the root of the merged set.
+        """
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return first
+
+        if self._sizes[first] < self._sizes[second]:
+            first, second = second, first
+
+        self._parents[second] = first
+        self._sizes[first] += self._sizes[second]
+        return first
+
+    def get_size(self, element: int) -> int:
+        return self._sizes[self.find(element)]
+
+    def get_roots(self) -> numpy.ndarray:
+        """
+            Return an array with the root of every element.
+        """
+        return numpy.array(
+            [self.find(element) for element in range(len(self))], dtype=numpy.int64
+        )
+
+
+class DisplacementUnionFind(UnionFind):
+    """
+        Union-find that also keeps the displacement of every element
+        to the root of its set, in unwrapped lattice coordinates.
+        Merging two elements of the same set whose displacements
+        disagree means the set wraps around a periodic lattice,
+        which is recorded per axis.
+    """
+
+    def __init__(self, number_of_elements: int = 0, dimensions: int = 2):
+        super().__init__(number_of_elements)
+        self._dimensions = dimensions
+        self._origin = (0,) * dimensions
+        self._displacements: List[tuple] = [self._origin] * number_of_elements
+        self._wrapping: List[tuple] = [(False,) * dimensions] * number_of_elements
+
+    def add(self) -> int:
+        self._displacements.append(self._origin)
+        self._wrapping.append((False,) * self._dimensions)
+        return super().add()
+
+    def find(self, element: int) -> int:
+        parents, displacements = self._parents, self._displacements
+
+        path = []
+        while parents[element] != element:
+            path.append(element)
+            element = parents[element]
+        root = element
+
+        # Walk back from the root, so each parent already points to it
+        for node in reversed(path):
+            parent = parents[node]
+            if parent != root:
+                displacements[node] = tuple(
+                    map(sum, zip(displacements[node], displacements[parent]))
+                )
+                parents[node] = root
+
+        return root
+
+    def get_displacement(self, element: int) -> tuple:
+        """
+            Return the position of element relative to the root of its set.
+        """
+        self.find(element)
+        return self._displacements[element]
+
+    def get_wrapping(self, element: int) -> tuple:
+        """
+            Return, for each axis, whether the set containing
+            element wraps around the lattice along that axis.
+        """
+        return self._wrapping[self.find(element)]
+
+    def union(self, first: int, second: int, displacement: tuple = None) -> int:
+        """
+            Merge the sets containing first and second, where
+            displacement is the position of second relative to first.
+        """
+        if displacement is None:
+            displacement = self._origin
+
+        first_root, second_root = self.find(first), self.find(second)
+        first_displacement = self._displacements[first]
+        second_displacement = self._displacements[second]
+
+        # Position of second_root relative to first_root
+        root_displacement = tuple(
+            first_offset + offset - second_offset
+            for first_offset, offset, second_offset in zip(
+                first_displacement, displacement, second_displacement
+            )
+        )
+
+        if first_root == second_root:
+            if any(root_displacement):
+                self._wrapping[first_root] = tuple(
+                    wraps or bool(offset)
+                    for wraps, offset in zip(
+                        self._wrapping[first_root], root_displacement
+                    )
+                )
+            return first_root
+
+        if self._sizes[first_root] < self._sizes[second_root]:
+            first_root, second_root = second_root, first_root
+            root_displacement = tuple(-offset for offset in root_displacement)
+
+        self._parents[second_root] = first_root
+        self._sizes[first_root] += self._sizes[second_root]
+        self._displacements[second_root] = root_displacement
+        self._wrapping[first_root] = tuple(
+            map(any, zip(self._wrapping[first_root], self._wrapping[second_root]))
+        )
+        return first_root
+
+
+class Labeler:
+    """
+        Label the clusters of a boolean occupation array.
+        Labels are consecutive integers starting at 1; unoccupied
+        nodes get label 0.
+
+        Labelers that walk the lattice node by node can use the
+        lattice neighbour table, when one is given.
+    """
+
+    LABEL_DTYPE = numpy.int32
+
+    # Whether label() walks the neighbour table, so callers only
+    # build one when it is used
+    uses_neighbour_table = False
+
+    def label(
+        self,
+        occupied: numpy.ndarray,
+        periodic: bool = False,
+        neighbour_table: numpy.ndarray = None,
+    ) -> Tuple[Labels, ClusterSizes]:
+        raise NotImplementedError
+
+    def _get_compact_labels(
+        self, provisional_labels: numpy.ndarray, union_find: UnionFind
+    ) -> Tuple[Labels, ClusterSizes]:
+
+        # Root 0 is always the smallest root, so it maps to label 0
+        roots = union_find.get_roots()
+        _, compact_labels = numpy.unique(roots, return_inverse=True)
+        compact_labels = compact_labels.astype(self.LABEL_DTYPE)
+
+        labels = compact_labels[provisional_labels]
+
+        sizes = numpy.bincount(labels.ravel(), minlength=compact_labels.max() + 1)
+        sizes[0] = 0
+        return labels, sizes
+
+
+class HoshenKopelmanLabeler(Labeler):
+    """
+        Pure Python labeler. Makes a single pass over the nodes in
+        flat index order, merging each occupied node with its already
+        visited occupied neighbours, as given by a neighbour table.
+        Every edge is seen exactly once, from its larger endpoint, so
+        periodic edges need no special treatment.
+    """
+
+    uses_neighbour_table = True
+
+    def label(
+        self,
+        occupied: numpy.ndarray,
+        periodic: bool = False,
+        neighbour_table: numpy.ndarray = None,
+    ) -> Tuple[Labels, ClusterSizes]:
+
+        if neighbour_table is None:
+            neighbour_table = build_neighbour_table(
+                occupied.shape, get_axis_offsets(occupied.ndim), periodic
+            )
+
+        flat_occupied = occupied.ravel()
+        occupied_nodes = numpy.flatnonzero(flat_occupied)
+
+        # Keep only neighbours that are occupied and visited before each node
+        neighbours = neighbour_table[occupied_nodes]
+        visited = (neighbours >= 0) & (neighbours < occupied_nodes[:, numpy.newaxis])
+        visited &= flat_occupied[numpy.where(visited, neighbours, 0)]
+
+        # Nodes without visited neighbours start a new provisional label
+        provisional_labels = numpy.zeros(flat_occupied.size, dtype=numpy.int64)
+        new_label_nodes = occupied_nodes[~visited.any(axis=1)]
+        provisional_labels[new_label_nodes] = numpy.arange(1, new_label_nodes.size + 1)
+        union_find = UnionFind(new_label_nodes.size + 1)
+
+        rows, columns = numpy.nonzero(visited)
+        provisional_labels = self._label_edges(
+            occupied_nodes[rows].tolist(),
+            neighbours[rows, columns].tolist(),
+            provisional_labels.tolist(),
+            union_find,
+        )
+
+        provisional_labels = numpy.array(provisional_labels, dtype=numpy.int64)
+        return self._get_compact_labels(
+            provisional_labels.reshape(occupied.shape), union_find
+        )
+
+    def _label_edges(
+        self,
+        nodes: List[int],
+        neighbours: List[int],
+        labels: List[int],
+        union_find: UnionFind,
+    ) -> List[int]:
+        """
+            Walk the edges (node, visited neighbour) in node order.
+            A node takes the label of its first visited neighbour, and
+            further neighbours have their labels merged into it.
+        """
+        union = union_find.union
+        for node, neighbour in zip(nodes, neighbours):
+            label, neighbour_label = labels[node], labels[neighbour]
+            if not label:
+                labels[node] = neighbour_label
+            elif label != neighbour_label:
+                union(label, neighbour_label)
+
+        return labels
+
+
+class ScipyLabeler(Labeler):
+    """
+        Labeler backed by scipy.ndimage.label, which runs in C.
+        scipy knows nothing about periodic boundaries, so for periodic
+        lattices the labels touching opposite edges are merged
+        afterwards with a small union-find over labels.
+    """
+
+    def label(
+        self,
+        occupied: numpy.ndarray,
+        periodic: bool = False,
+        neighbour_table: numpy.ndarray = None,
+    ) -> Tuple[Labels, ClusterSizes]:
+
+        if occupied.ndim not in (1, 2):
+            raise ValueError(f"Unsupported number of dimensions: {occupied.ndim}")
+
+        provisional_labels, number_of_labels = scipy.ndimage.label(occupied)
+        union_find = UnionFind(number_of_labels + 1)
+
+        if periodic:
+            self._merge_periodic_edges(provisional_labels, union_find)
+
+        return self._get_compact_labels(provisional_labels, union_find)
+
+    def _merge_periodic_edges(self, labels: numpy.ndarray, union_find: UnionFind):
+
+        for axis in range(labels.ndim):
+            first_edge = labels.take(0, axis=axis).ravel()
+            last_edge = labels.take(-1, axis=axis).ravel()
+            both_occupied = (first_edge > 0) & (last_edge > 0)
+
+            edge_pairs = numpy.stack(
+                [first_edge[both_occupied], last_edge[both_occupied]], axis=1
+            )
+            for first, second in numpy.unique(edge_pairs, axis=0).tolist():
+                union_find.union(first, second)
+
+
+class IncrementalLabeler(Labeler):
+    """
+        Wraps another labeler and reuses the previous labels when the
+        lattice was divided since the last call (see
+        Square2DLattice.divide). Each previously occupied node becomes a
+        block of occupied nodes, and blocks of neighbouring nodes are
+        still neighbours, so upsampled labels remain valid clusters;
+        only newly occupied nodes and the merges they cause need work.
+
+        Any other change to the occupation falls back to a full
+        labeling with the wrapped labeler.
+    """
+
+    # New nodes are merged with their neighbours from the table
+    uses_neighbour_table = True
+
+    def __init__(self, labeler: Labeler):
+        self._labeler = labeler
+        self._previous_labels = None
+
+    def label(
+        self,
+        occupied: numpy.ndarray,
+        periodic: bool = False,
+        neighbour_table: numpy.ndarray = None,
+    ) -> Tuple[Labels, ClusterSizes]:
+
+        previous_labels = self._get_upsampled_previous_labels(occupied)
+        if previous_labels is None:
+            labels, sizes = self._labeler.label(occupied, periodic, neighbour_table)
+        else:
+            if neighbour_table is None:
+                neighbour_table = build_neighbour_table(
+                    occupied.shape, get_axis_offsets(occupied.ndim), periodic
+                )
+            labels, sizes = self._label_new_nodes(
+                occupied, previous_labels, neighbour_table
+            )
+
+        self._previous_labels = labels
+        return labels, sizes
+
+    def _get_upsampled_previous_labels(self, occupied: numpy.ndarray):
+        """
+            Return the previous labels upsampled to the shape of occupied,
+            or None if occupied is not a division of the previously
+            labeled lattice with every previously occupied node kept.
+        """
+        previous_labels = self._previous_labels
+        if previous_labels is None or previous_labels.ndim != occupied.ndim:
+            return None
+
+        factors = []
+        for size, previous_size in zip(occupied.shape, previous_labels.shape):
+            if size < previous_size or size % previous_size:
+                return None
+            factors.append(size // previous_size)
+
+        for axis, factor in enumerate(factors):
+            previous_labels = previous_labels.repeat(factor, axis=axis)
+
+        if not occupied[previous_labels > 0].all():
+            return None
+
+        return previous_labels
+
+    def _label_new_nodes(
+        self,
+        occupied: numpy.ndarray,
+        previous_labels: numpy.ndarray,
+        neighbour_table: numpy.ndarray,
+    ) -> Tuple[Labels, ClusterSizes]:
+
+        flat_occupied = occupied.ravel()
+        provisional_labels = previous_labels.ravel().astype(numpy.int64)
+        number_of_previous_labels = int(provisional_labels.max(initial=0))
+
+        # Every newly occupied node starts with a label of its own
+        new_nodes = numpy.flatnonzero(flat_occupied & (provisional_labels == 0))
+        provisional_labels[new_nodes] = numpy.arange(
+            number_of_previous_labels + 1,
+            number_of_previous_labels + 1 + new_nodes.size,
+        )
+        union_find = UnionFind(number_of_previous_labels + 1 + new_nodes.size)
+
+        # Edges from new nodes to occupied neighbours, as distinct label pairs
+        neighbours = neighbour_table[new_nodes]
+        connected = neighbours >= 0
+        connected &= flat_occupied[numpy.where(connected, neighbours, 0)]
+        rows, columns = numpy.nonzero(connected)
+        label_pairs = numpy.stack(
+            [
+                provisional_labels[new_nodes[rows]],
+                provisional_labels[neighbours[rows, columns]],
+            ],
+            axis=1,
+        )
+        label_pairs.sort(axis=1)
+        label_pairs = numpy.unique(label_pairs, axis=0)
+
+        for first, second in label_pairs.tolist():
+            union_find.union(first, second)
+
+        return self._get_compact_labels(
+            provisional_labels.reshape(occupied.shape), union_find
+        )
+
+
+# Open sub-cluster labels, the union-find merging them across the lattice
+# edges and the merged sub-clusters, see merge_open_sub_clusters
+SubClusterMerge = Tuple[numpy.ndarray, DisplacementUnionFind, List[int]]
+
+
+def merge_open_sub_clusters(labels: Labels) -> SubClusterMerge:
+    """
+        Cut the clusters of a periodic lattice at the lattice edges into
+        open sub-clusters, whose nodes all sit at their own coordinates,
+        and merge the sub-clusters joined across an edge with a
+        DisplacementUnionFind, the sub-cluster across being displaced by
+        the lattice size along that axis.
+
+        Return the sub-cluster labels, the union-find over them and the
+        sub-clusters that were merged (all others have no displacement).
+        get_wrapping and get_unwrapped_coordinates both start from this
+        full-lattice pass, so callers needing both compute it once.
+    """
+    dimensions = labels.ndim
+    open_labels, number_of_open_labels = scipy.ndimage.label(labels > 0)
+    union_find = DisplacementUnionFind(number_of_open_labels + 1, dimensions)
+
+    merged = set()
+    for axis, extent in enumerate(labels.shape):
+        first_edge = open_labels.take(0, axis=axis).ravel()
+        last_edge = open_labels.take(-1, axis=axis).ravel()
+        both_occupied = (first_edge > 0) & (last_edge > 0)
+        edge_pairs = numpy.stack(
+            [last_edge[both_occupied], first_edge[both_occupied]], axis=1
+        )
+
+        displacement = [0] * dimensions
+        displacement[axis] = extent
+        for last, first in numpy.unique(edge_pairs, axis=0).tolist():
+            union_find.union(last, first, tuple(displacement))
+            merged.update((last, first))
+
+    return open_labels, union_find, sorted(merged)
+
+
+def get_wrapping(
+    labels: Labels, sub_clusters: Optional[SubClusterMerge] = None
+) -> numpy.ndarray:
+    """
+        Return a (labels, dimensions) boolean array telling, for every
+        label of a periodic lattice, whether its cluster wraps around the
+        lattice along each axis (row 0 is for label 0 and always False).
+
+        A cluster wraps along an axis when two of its open sub-clusters
+        (see merge_open_sub_clusters) meet again at displacements that
+        differ along it, as in the Newman-Ziff algorithm.
+    """
+    wrapping = numpy.zeros((int(labels.max(initial=0)) + 1, labels.ndim), dtype=bool)
+    if sub_clusters is None:
+        sub_clusters = merge_open_sub_clusters(labels)
+    open_labels, union_find, merged = sub_clusters
+
+    # Only sub-clusters merged across an edge can wrap
+    open_to_labels = numpy.zeros(int(open_labels.max(initial=0)) + 1, dtype=numpy.int64)
+    open_to_labels[open_labels.ravel()] = labels.ravel()
+    for open_label in merged:
+        wrapping[open_to_labels[open_label]] |= union_find.get_wrapping(open_label)
+
+    return wrapping
+
+
+def get_unwrapped_coordinates(
+    labels: Labels, sub_clusters: Optional[SubClusterMerge] = None
+) -> numpy.ndarray:
+    """
+        Return a (dimensions, nodes) array with the coordinates of every
+        node of a periodic lattice (in ravel order), shifted by whole
+        lattice sizes so that each cluster is contiguous, i.e. as it
+        would lie on an infinite lattice. This is exact for clusters
+        that do not wrap; wrapping clusters have no such position.
+    """
+    if sub_clusters is None:
+        sub_clusters = merge_open_sub_clusters(labels)
+    open_labels, union_find, merged = sub_clusters
+
+    offsets = numpy.zeros(
+        (int(open_labels.max(initial=0)) + 1, labels.ndim), dtype=numpy.int64
+    )
+    for open_label in merged:
+        offsets[open_label] = union_find.get_displacement(open_label)
+
+    coordinates = numpy.indices(labels.shape).reshape(labels.ndim, -1)
+    return coordinates + offsets[open_labels.ravel()].T
+
+
+LABELING_BACKENDS: Dict[str, Type[Labeler]] = {
+    "python": HoshenKopelmanLabeler,
+    "scipy": ScipyLabeler,
+}
+
+
+def get_labeler(backend: str) -> Labeler:
+    try:
+        return LABELING_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown labeling backend: {backend}")
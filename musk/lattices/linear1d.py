@@ -4,9 +4,11 @@ from .base import Lattice
 
 
 class Linear1DLattice(Lattice):
-    def __init__(self, size):
-        self._size = size
-        super().__init__(size)
+
+    _neighbour_offsets = ((-1,), (1,))
+
+    def _get_shape(self):
+        return (self.get_size(),)
 
     def get_neighbour_nodes(self, index):
         last_node_index = self.get_size() - 1
@@ -24,11 +26,7 @@ class Linear1DLattice(Lattice):
         return [(index,) for index in range(self.get_size())]
 
     def set_state_from_list(self, list_):
-        for index, entry in enumerate(list_):
-            self.set_state_at_node(entry, index)
-
-    def get_number_of_nodes(self):
-        return self.get_size()
+        self._state[:] = list_
 
     def get_boundaries(self):
         size = self.get_size()
@@ -0,0 +1,53 @@
+import numpy
+
+from typing import Sequence, Tuple
+
+Offset = Tuple[int, ...]
+
+# Marks a missing neighbour (outside a non periodic lattice)
+NO_NEIGHBOUR = -1
+NEIGHBOUR_DTYPE = numpy.int32
+
+
+def get_axis_offsets(dimensions: int) -> Tuple[Offset, ...]:
+    """
+        Offsets to the nearest neighbours along each axis,
+        i.e. -1 and +1 along every axis.
+    """
+    offsets = []
+    for axis in range(dimensions):
+        for step in (-1, 1):
+            offset = [0] * dimensions
+            offset[axis] = step
+            offsets.append(tuple(offset))
+    return tuple(offsets)
+
+
+def build_neighbour_table(
+    shape: Tuple[int, ...], offsets: Sequence[Offset], periodic: bool
+) -> numpy.ndarray:
+    """
+        Return an (N, k) array whose row n holds the flat indexes of the
+        neighbours of node n (in C order), one column per offset.
+        Neighbours falling outside a non periodic lattice are NO_NEIGHBOUR.
+    """
+    dimensions = len(shape)
+    number_of_nodes = int(numpy.prod(shape))
+    coordinates = numpy.indices(shape).reshape(dimensions, number_of_nodes)
+    extents = numpy.array(shape).reshape(dimensions, 1)
+
+    table = numpy.empty((number_of_nodes, len(offsets)), dtype=NEIGHBOUR_DTYPE)
+    for column, offset in enumerate(offsets):
+        neighbours = coordinates + numpy.array(offset).reshape(dimensions, 1)
+        if periodic:
+            neighbours %= extents
+            table[:, column] = numpy.ravel_multi_index(neighbours, shape)
+        else:
+            inside = ((neighbours >= 0) & (neighbours < extents)).all(axis=0)
+            table[:, column] = NO_NEIGHBOUR
+            table[inside, column] = numpy.ravel_multi_index(
+                neighbours[:, inside], shape
+            )
+
+    table.flags.writeable = False
+    return table
@@ -1,15 +1,16 @@
-from .base import Lattice
+from .base import Lattice, Seed
 import functools
-import random
+
+import numpy
 
 
 class Square2DLattice(Lattice):
 
-    _neighbours = {}
+    # Clock-wise, starting from top
+    _neighbour_offsets = ((-1, 0), (0, 1), (1, 0), (0, -1))
 
-    def __init__(self, size):
-        self._size = size
-        super().__init__(size)
+    def _get_shape(self):
+        return (self.get_size(), self.get_size())
 
     def get_all_nodes(self):
         nodes = []
@@ -18,23 +19,10 @@ class Square2DLattice(Lattice):
                 yield ((i, j))
 
     def set_state_from_matrix(self, matrix):
-
-        for i, row in enumerate(matrix):
-            for j, entry in enumerate(row):
-                self.set_state_at_node(entry, i, j)
-
-    def get_number_of_nodes(self) -> int:
-        return self.get_size() ** 2
+        self._state[:, :] = matrix
 
     def get_state_as_matrix(self):
-        matrix = [
-            [None for column in range(self.get_size())]
-            for row in range(self.get_size())
-        ]
-
-        for (i, j) in self.get_all_nodes():
-            matrix[i][j] = self.get_state_at_node(i, j)
-        return matrix
+        return self._state.tolist()
 
     def get_boundaries(self):
         size = self.get_size()
@@ -51,35 +39,32 @@ class Square2DLattice(Lattice):
             Update state so that any node with a given state
             becomes 4 nodes with the same state
         """
-        state = {}
-
-        for i in range(self.get_size()):
-            for j in range(self.get_size()):
-                previous_state = self.get_state_at_node(i, j)
-                for index in [
-                    (2 * i, 2 * j),
-                    (2 * i, 2 * j + 1),
-                    (2 * i + 1, 2 * j),
-                    (2 * i + 1, 2 * j + 1),
-                ]:
-                    node_key = self._get_node_key(*index)
-                    state[node_key] = previous_state
-
-        self._state = state
+        self._state = self._state.repeat(2, axis=0).repeat(2, axis=1)
         self._size *= 2
 
-    def change_state_with_probability(self, old_state, new_state, probability):
+    def change_state_with_probability(
+        self, old_state, new_state, probability, seed: Seed = None
+    ):
+        """
+            Change each node with old_state to new_state with the
+            given probability, drawing only for the nodes in old_state.
+        """
+        random_generator = numpy.random.default_rng(seed)
 
-        for (i, j) in self.get_all_nodes():
-            if self.get_state_at_node(i, j) == old_state:
-                if random.random() < probability:
-                    self.set_state_at_node(new_state, i, j)
+        changed = self._state == old_state
+        changed[changed] = (
+            random_generator.random(numpy.count_nonzero(changed)) < probability
+        )
+        self._state[changed] = new_state
 
     def get_neighbour_nodes(self, i, j):
         raise NotImplementedError
 
 
 class Square2DPeriodicLattice(Square2DLattice):
+
+    _periodic = True
+
     def get_neighbour_nodes(self, i, j):
 
         size = self.get_size()
@@ -0,0 +1,137 @@
+import bz2
+import lzma
+import struct
+import zlib
+
+from typing import Dict
+
+
+class Codec:
+    """
+        A compression codec for observables blobs.
+        codec_id is written in the blob header, so it must never change.
+    """
+
+    name: str
+    codec_id: int
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class NoCompressionCodec(Codec):
+    def __init__(self, name: str, codec_id: int):
+        self.name = name
+        self.codec_id = codec_id
+
+    def compress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+
+class Bz2Codec(Codec):
+    def __init__(self, name: str, codec_id: int, level: int = 9):
+        self.name = name
+        self.codec_id = codec_id
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return bz2.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return bz2.decompress(data)
+
+
+class LzmaCodec(Codec):
+    def __init__(self, name: str, codec_id: int, preset: int = 6):
+        self.name = name
+        self.codec_id = codec_id
+        self.preset = preset
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data)
+
+
+class ZlibCodec(Codec):
+    def __init__(self, name: str, codec_id: int, level: int = 6):
+        self.name = name
+        self.codec_id = codec_id
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+CODECS: Dict[str, Codec] = {
+    codec.name: codec
+    for codec in [
+        NoCompressionCodec("none", 0),
+        Bz2Codec("bz2", 1),
+        LzmaCodec("lzma", 2),
+        ZlibCodec("zlib-1", 3, level=1),
+        ZlibCodec("zlib-6", 4, level=6),
+        ZlibCodec("zlib-9", 5, level=9),
+    ]
+}
+
+
+class CompressedBlob:
+    """
+        Compressed blob with a header naming its codec:
+            magic (3 bytes), codec id (uint8), compressed data
+
+        Blobs written before codecs were selectable are plain bz2
+        streams, which always start with b"BZh" and never with MAGIC.
+    """
+
+    MAGIC = b"MKC"
+    LEGACY_CODEC = "bz2"
+
+    _HEADER = struct.Struct("<3sB")
+
+    @classmethod
+    def get_codec(cls, name: str) -> Codec:
+        try:
+            return CODECS[name]
+        except KeyError:
+            raise ValueError(f"Unknown compression codec: {name}")
+
+    @classmethod
+    def get_codec_by_id(cls, codec_id: int) -> Codec:
+        for codec in CODECS.values():
+            if codec.codec_id == codec_id:
+                return codec
+        raise ValueError(f"Unknown compression codec id: {codec_id}")
+
+    @classmethod
+    def compress(cls, data: bytes, codec_name: str) -> bytes:
+        codec = cls.get_codec(codec_name)
+        return cls._HEADER.pack(cls.MAGIC, codec.codec_id) + codec.compress(data)
+
+    @classmethod
+    def decompress(cls, blob: bytes) -> bytes:
+        blob = bytes(blob)
+        if blob[: len(cls.MAGIC)] != cls.MAGIC:
+            return cls.get_codec(cls.LEGACY_CODEC).decompress(blob)
+
+        _, codec_id = cls._HEADER.unpack_from(blob, 0)
+        codec = cls.get_codec_by_id(codec_id)
+        return codec.decompress(blob[cls._HEADER.size :])
+
+    @classmethod
+    def get_codec_name(cls, blob: bytes) -> str:
+        if blob[: len(cls.MAGIC)] != cls.MAGIC:
+            return cls.LEGACY_CODEC
+        _, codec_id = cls._HEADER.unpack_from(blob, 0)
+        return cls.get_codec_by_id(codec_id).name
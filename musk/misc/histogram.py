@@ -0,0 +1,77 @@
+import numpy
+
+from typing import Iterable, Tuple
+
+from musk.misc.observables import ObservablesFormat
+
+# Sparse histogram, as the sizes with at least one cluster and their counts
+SizeCounts = Tuple[numpy.ndarray, numpy.ndarray]
+
+
+def get_size_counts(cluster_sizes: numpy.ndarray) -> SizeCounts:
+    """
+        Count the clusters of every size, keeping only sizes that occur.
+    """
+    counts = numpy.bincount(numpy.asarray(cluster_sizes, dtype=numpy.int64))
+    sizes = numpy.flatnonzero(counts)
+    return sizes, counts[sizes]
+
+
+def get_log_binned_size_counts(
+    cluster_sizes: numpy.ndarray, base: int = 2
+) -> SizeCounts:
+    """
+        Count the clusters in logarithmic bins, bin k holding sizes in
+        [base ** k, base ** (k + 1)) and keyed by base ** k, so that
+        histograms of different rows share their bins.
+    """
+    cluster_sizes = numpy.asarray(cluster_sizes, dtype=numpy.int64)
+    cluster_sizes = cluster_sizes[cluster_sizes > 0]
+
+    bins = numpy.floor(numpy.log(cluster_sizes) / numpy.log(base)).astype(numpy.int64)
+    # Rounding may put exact powers of base in the bin below, or above
+    bins += base ** (bins + 1) <= cluster_sizes
+    bins -= base ** bins > cluster_sizes
+
+    sizes, counts = get_size_counts(base ** bins)
+    return sizes, counts
+
+
+def encode_size_counts(sizes: numpy.ndarray, counts: numpy.ndarray) -> bytes:
+    """
+        Encode a sparse histogram with ObservablesFormat, using the
+        smallest unsigned types that hold the sizes and the counts.
+    """
+    return ObservablesFormat.encode(
+        dict(sizes=_get_compact(sizes), counts=_get_compact(counts))
+    )
+
+
+def decode_size_counts(data: bytes) -> SizeCounts:
+    observables = ObservablesFormat.decode(bytes(data))
+    return observables["sizes"], observables["counts"]
+
+
+def sum_size_counts(histograms: Iterable[bytes]) -> SizeCounts:
+    """
+        Add up encoded sparse histograms, such as the rows of a stats
+        table for one (size, probability) pair.
+    """
+    all_sizes, all_counts = [], []
+    for data in histograms:
+        sizes, counts = decode_size_counts(data)
+        all_sizes.append(sizes.astype(numpy.int64))
+        all_counts.append(counts.astype(numpy.int64))
+
+    if not all_sizes:
+        return get_size_counts(numpy.zeros(0, dtype=numpy.int64))
+
+    sizes, inverse = numpy.unique(numpy.concatenate(all_sizes), return_inverse=True)
+    counts = numpy.zeros(len(sizes), dtype=numpy.int64)
+    numpy.add.at(counts, inverse, numpy.concatenate(all_counts))
+    return sizes, counts
+
+
+def _get_compact(values: numpy.ndarray) -> numpy.ndarray:
+    values = numpy.asarray(values)
+    return values.astype(numpy.min_scalar_type(int(values.max(initial=0))))
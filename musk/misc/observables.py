@@ -0,0 +1,180 @@
+import json
+import struct
+
+import numpy
+
+from typing import FrozenSet, Tuple
+
+from musk.misc.json import PythonObjectEncoder, as_python_object
+
+Clusters = FrozenSet[FrozenSet[tuple]]
+
+
+class ObservablesFormat:
+    """
+        Versioned binary format for simulation observables.
+        Arrays are stored as raw bytes, so cluster labels and
+        per-occupation observables decode without parsing.
+
+        Layout (integers are little endian):
+        header:  magic (4 bytes), version (uint8), entries (uint16)
+        entry:   name length (uint16), name (utf-8), kind (uint8)
+        array:   dtype length (uint8), dtype (ascii), ndim (uint8),
+                 shape (uint32 * ndim), data length (uint64), data
+        json:    data length (uint64), data (utf-8)
+
+        Rows written before this format are bz2 compressed JSON with
+        a frozenset of clusters; decode() turns those into labels.
+    """
+
+    MAGIC = b"MKOB"
+    VERSION = 1
+
+    ARRAY_ENTRY = 0
+    JSON_ENTRY = 1
+
+    _HEADER = struct.Struct("<4sBH")
+    _ENTRY_NAME = struct.Struct("<H")
+    _ENTRY_KIND = struct.Struct("<B")
+    _DATA_LENGTH = struct.Struct("<Q")
+
+    @classmethod
+    def is_binary(cls, data: bytes) -> bool:
+        return data[: len(cls.MAGIC)] == cls.MAGIC
+
+    @classmethod
+    def encode(cls, observables: dict) -> bytes:
+        parts = [cls._HEADER.pack(cls.MAGIC, cls.VERSION, len(observables))]
+
+        for name, value in observables.items():
+            encoded_name = name.encode("utf-8")
+            parts.append(cls._ENTRY_NAME.pack(len(encoded_name)))
+            parts.append(encoded_name)
+
+            if isinstance(value, numpy.ndarray):
+                parts.append(cls._ENTRY_KIND.pack(cls.ARRAY_ENTRY))
+                parts.append(cls._encode_array(value))
+            else:
+                data = json.dumps(value, cls=PythonObjectEncoder).encode("utf-8")
+                parts.append(cls._ENTRY_KIND.pack(cls.JSON_ENTRY))
+                parts.append(cls._DATA_LENGTH.pack(len(data)))
+                parts.append(data)
+
+        return b"".join(parts)
+
+    @classmethod
+    def _encode_array(cls, array: numpy.ndarray) -> bytes:
+        array = numpy.ascontiguousarray(array)
+        dtype = array.dtype.newbyteorder("<")
+        encoded_dtype = dtype.str.encode("ascii")
+        data = array.astype(dtype, copy=False).tobytes()
+        return b"".join(
+            [
+                struct.pack("<B", len(encoded_dtype)),
+                encoded_dtype,
+                struct.pack(f"<B{array.ndim}I", array.ndim, *array.shape),
+                cls._DATA_LENGTH.pack(len(data)),
+                data,
+            ]
+        )
+
+    @classmethod
+    def decode(cls, data: bytes, shape: tuple = None) -> dict:
+        """
+            Decode observables in any known format. The lattice shape
+            is only needed to turn legacy clusters into a label array.
+            Arrays are read-only views on data.
+        """
+        if not cls.is_binary(data):
+            return cls._decode_legacy(data, shape)
+
+        magic, version, number_of_entries = cls._HEADER.unpack_from(data, 0)
+        if version != cls.VERSION:
+            raise ValueError(f"Unsupported observables format version: {version}")
+
+        offset = cls._HEADER.size
+        observables = {}
+        for _ in range(number_of_entries):
+            (name_length,) = cls._ENTRY_NAME.unpack_from(data, offset)
+            offset += cls._ENTRY_NAME.size
+            name = data[offset : offset + name_length].decode("utf-8")
+            offset += name_length
+            (kind,) = cls._ENTRY_KIND.unpack_from(data, offset)
+            offset += cls._ENTRY_KIND.size
+
+            if kind == cls.ARRAY_ENTRY:
+                observables[name], offset = cls._decode_array(data, offset)
+            elif kind == cls.JSON_ENTRY:
+                (length,) = cls._DATA_LENGTH.unpack_from(data, offset)
+                offset += cls._DATA_LENGTH.size
+                observables[name] = json.loads(
+                    data[offset : offset + length], object_hook=as_python_object
+                )
+                offset += length
+            else:
+                raise ValueError(f"Unknown observables entry kind: {kind}")
+
+        return observables
+
+    @classmethod
+    def _decode_array(cls, data: bytes, offset: int) -> Tuple[numpy.ndarray, int]:
+        (dtype_length,) = struct.unpack_from("<B", data, offset)
+        offset += 1
+        dtype = numpy.dtype(data[offset : offset + dtype_length].decode("ascii"))
+        offset += dtype_length
+        (ndim,) = struct.unpack_from("<B", data, offset)
+        offset += 1
+        shape = struct.unpack_from(f"<{ndim}I", data, offset)
+        offset += 4 * ndim
+        (length,) = cls._DATA_LENGTH.unpack_from(data, offset)
+        offset += cls._DATA_LENGTH.size
+
+        array = numpy.frombuffer(
+            data, dtype=dtype, count=length // dtype.itemsize, offset=offset
+        )
+        return array.reshape(shape), offset + length
+
+    @classmethod
+    def _decode_legacy(cls, data: bytes, shape: tuple = None) -> dict:
+        observables = json.loads(data, object_hook=as_python_object)
+        if "clusters" in observables and shape is not None:
+            clusters = observables.pop("clusters")
+            observables["labels"] = get_labels_from_clusters(clusters, shape)
+        return observables
+
+
+def get_compact_labels(labels: numpy.ndarray) -> numpy.ndarray:
+    """
+        Return labels using the smallest unsigned type that holds them.
+    """
+    return labels.astype(numpy.min_scalar_type(int(labels.max(initial=0))))
+
+
+def get_labels_from_clusters(clusters: Clusters, shape: tuple) -> numpy.ndarray:
+    """
+        Build a label array with the lattice shape, where nodes in
+        no cluster get label 0.
+    """
+    labels = numpy.zeros(shape, dtype=numpy.int32)
+    for label, cluster in enumerate(clusters, start=1):
+        nodes = numpy.array(list(cluster)).reshape(len(cluster), len(shape))
+        labels[tuple(nodes.T)] = label
+    return get_compact_labels(labels)
+
+
+def get_clusters_from_labels(labels: numpy.ndarray) -> Clusters:
+    """
+        Return the clusters, as frozensets of node tuples, in a label array.
+    """
+    flat_labels = labels.ravel()
+    order = numpy.argsort(flat_labels, kind="stable")
+    nodes = numpy.stack(numpy.unravel_index(order, labels.shape), axis=1).tolist()
+    sizes = numpy.bincount(flat_labels).tolist()
+
+    clusters = set()
+    start = sizes[0]  # Skip label 0 (nodes in no cluster)
+    for size in sizes[1:]:
+        clusters.add(frozenset(map(tuple, nodes[start : start + size])))
+        start += size
+
+    return frozenset(clusters)
@@ -9,6 +9,10 @@ from .percolation_mandelbrot_2d import (
 
 from .percolation_square_2d import (
     P2SModel,
+    P2SNewmanZiffModel,
+    P2SNewmanZiffProcessor,
+    P2SNewmanZiffQueue,
+    P2SNewmanZiffSimulation,
     P2SProcessor,
     P2SQueue,
     P2SSimulation,
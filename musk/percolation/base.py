@@ -1,17 +1,34 @@
-import bz2
+import concurrent.futures
 import itertools
 import json
+import multiprocessing
 import numpy
 import pymysql
+import scipy.stats
+import time
 import warnings
 
 from dataclasses import asdict
 from datetime import datetime, timedelta
-from typing import Optional
-
-
-from musk.core import Message, MySQL, Processor, Simulation, SQSQueue
-from musk.misc.json import PythonObjectEncoder, as_python_object
+from typing import Iterator, List, Optional
+
+
+from musk.config import DequeuerConfig
+from musk.core import (
+    BulkWriter,
+    DetachedMessage,
+    Message,
+    Processor,
+    Simulation,
+    SQSQueue,
+)
+from musk.core.dequeuer import process_message
+from musk.core.processor import PROCESS_CONCURRENCY
+from musk.lattices.base import Seed
+from musk.lattices.labeling import DisplacementUnionFind
+from musk.lattices.neighbours import NO_NEIGHBOUR
+from musk.misc.compression import CompressedBlob
+from musk.misc.observables import ObservablesFormat, get_compact_labels
 from musk.misc.misc import Misc
 from pydantic.dataclasses import dataclass
 
@@ -31,6 +48,11 @@ class PercolationModel:
 
     id: Optional[int] = None
 
+    # Used to rebuild label arrays from rows stored as clusters
+    lattice_dimensions = 2
+    # Compression codec for new rows, see musk.misc.compression
+    observables_codec = "zlib-6"
+
     @classmethod
     def get_insert_query(cls):
         query = f"""
@@ -87,18 +109,17 @@ class PercolationModel:
     @classmethod
     def from_db(cls, row: dict):
         row = row.copy()  # Don't change original row
-        row["observables"] = bz2.decompress(row["observables"])
-        row["observables"] = json.loads(
-            row["observables"], object_hook=as_python_object
+        row["observables"] = ObservablesFormat.decode(
+            CompressedBlob.decompress(row["observables"]),
+            shape=(row["size"],) * cls.lattice_dimensions,
         )
         return cls(**row)
 
     def to_db(self):
-        observables_string = json.dumps(
-            self.observables, cls=PythonObjectEncoder
-        ).encode("utf-8")
-
-        observables_compressed = pymysql.Binary(bz2.compress(bytes(observables_string)))
+        observables_bytes = ObservablesFormat.encode(self.observables)
+        observables_compressed = pymysql.Binary(
+            CompressedBlob.compress(observables_bytes, self.observables_codec)
+        )
         model_dict = asdict(self)
         model_dict.update(dict(observables=observables_compressed))
         return model_dict
@@ -129,10 +150,10 @@ class PercolationStatsModel:
                 %(cluster_size_histogram)s, %(average_cluster_size)s, %(average_correlation_length)s,
                 %(created)s, %(took)s)
             ON DUPLICATE KEY UPDATE
-            has_percolated = %(has_percolated)s,
-            cluster_size_histogram = %(cluster_size_histogram)s,
-            average_cluster_size = %(average_cluster_size)s,
-            average_correlation_length = %(average_correlation_length)s
+            has_percolated = VALUES(has_percolated),
+            cluster_size_histogram = VALUES(cluster_size_histogram),
+            average_cluster_size = VALUES(average_cluster_size),
+            average_correlation_length = VALUES(average_correlation_length)
         """
 
     @classmethod
@@ -145,7 +166,9 @@ class PercolationStatsModel:
         column_names = "`, `".join(attributes)
         value_strings = [f"%({key})s" for key in attributes]
         value_string = ", ".join(value_strings)
-        update_strings = [f"{key} = %({key})s" for key in non_key_attributes]
+        # VALUES(column) rather than a parameter, so that the query
+        # also works with MySQL.execute_many
+        update_strings = [f"{key} = VALUES({key})" for key in non_key_attributes]
         update_string = ",\n".join(update_strings)
 
         query = f"""
@@ -175,11 +198,16 @@ class PercolationSimulation(Simulation):
     took: timedelta
     created: datetime
 
+    # Cluster labeling backend used by the lattice, see musk.lattices.labeling
+    labeling_backend: str = "python"
+    incremental_labeling: bool = False
+
     _has_run = False
 
-    def __init__(self, probability: float, size: int):
+    def __init__(self, probability: float, size: int, seed: Seed = None):
         self.probability = probability
         self.size = size
+        self.seed = seed
         self.created = datetime.now()
 
     @property
@@ -208,14 +236,23 @@ class PercolationSimulation(Simulation):
     def _get_update_query(self) -> str:
         return self._get_model_class().get_update_query()
 
-    def run(self):
+    def _get_new_lattice(self, size: int):
         LatticeClass = self._get_lattice_class()
-        lattice = LatticeClass(self.size)
+        return LatticeClass(
+            size,
+            labeling_backend=self.labeling_backend,
+            incremental_labeling=self.incremental_labeling,
+        )
+
+    def run(self):
+        lattice = self._get_new_lattice(self.size)
         lattice.fill_randomly(
-            [0, 1], state_weights=[1 - self.probability, self.probability]
+            [0, 1],
+            state_weights=[1 - self.probability, self.probability],
+            seed=self.seed,
         )
-        clusters = lattice.get_clusters_with_state(1)
-        return dict(clusters=clusters)
+        labels, _ = lattice.get_cluster_labels(1)
+        return dict(labels=get_compact_labels(labels))
 
     def execute(self):
         start = datetime.now()
@@ -225,18 +262,404 @@ class PercolationSimulation(Simulation):
         self._has_run = True
 
 
+@dataclass
+class NewmanZiffModel:
+
+    size: int
+    created: datetime
+    took: float
+    observables: dict
+
+    id: Optional[int] = None
+
+    lattice_dimensions = 2
+    # Compression codec for new rows, see musk.misc.compression
+    observables_codec = "zlib-6"
+
+    @classmethod
+    def get_insert_query(cls):
+        query = f"""
+            INSERT INTO {cls._tablename}
+            (size, observables, took, created)
+            VALUES (%(size)s, %(observables)s, %(took)s, %(created)s)
+        """
+        return query
+
+    @classmethod
+    def get_by_size_ids(cls, ids):
+        query = f"""
+            SELECT id, size, observables, took, created
+            FROM {cls._tablename}
+            WHERE
+                size = %(size)s AND
+                id IN ({", ".join(map(str, ids))})
+        """
+        return query
+
+    @classmethod
+    def from_db(cls, row: dict):
+        row = row.copy()  # Don't change original row
+        row["observables"] = ObservablesFormat.decode(
+            CompressedBlob.decompress(row["observables"]),
+            shape=(row["size"],) * cls.lattice_dimensions,
+        )
+        return cls(**row)
+
+    def to_db(self):
+        observables_bytes = ObservablesFormat.encode(self.observables)
+        observables_compressed = pymysql.Binary(
+            CompressedBlob.compress(observables_bytes, self.observables_codec)
+        )
+        model_dict = asdict(self)
+        model_dict.update(dict(observables=observables_compressed))
+        return model_dict
+
+    def get_observable_at_probabilities(
+        self, observable: str, probabilities: List[float]
+    ) -> numpy.ndarray:
+        """
+            Convolve an observable recorded at every occupation number n
+            with the binomial distribution, giving its value at each
+            occupation probability p.
+        """
+        values = numpy.asarray(self.observables[observable], dtype=float)
+        number_of_nodes = len(values) - 1
+        occupation_numbers = numpy.arange(number_of_nodes + 1)
+        weights = scipy.stats.binom.pmf(
+            occupation_numbers[numpy.newaxis, :],
+            number_of_nodes,
+            numpy.asarray(probabilities)[:, numpy.newaxis],
+        )
+        return weights @ values
+
+
+class NewmanZiffSimulation(Simulation):
+    """
+        Newman-Ziff sweep: starting from an empty lattice, occupy
+        nodes one at a time in random order, merging clusters with an
+        incremental union-find. Observables are recorded after every
+        occupation, so a single run covers every occupation number
+        n = 0..N, and therefore every occupation probability.
+
+        Percolation means wrapping around the lattice for periodic
+        lattices (tracked through node displacements), and
+        connecting the two lattice boundaries otherwise.
+    """
+
+    size: int
+
+    took: timedelta
+    created: datetime
+
+    _has_run = False
+
+    OBSERVABLES = [
+        "has_percolated",
+        "largest_cluster_size",
+        "mean_cluster_size",
+        "percolating_cluster_strength",
+    ]
+
+    def __init__(self, size: int, seed: Seed = None):
+        self.size = size
+        self.seed = seed
+        self.created = datetime.now()
+
+    @property
+    def model(self):
+        if not self._has_run:
+            raise ValueError("Simulation still did not run.")
+
+        ModelClass = self._get_model_class()
+        return ModelClass(
+            size=self.size,
+            observables=self._observables,
+            took=self.took.total_seconds(),
+            created=self.created,
+        )
+
+    def _get_model_class(self):
+        return self.model_class
+
+    def _get_lattice_class(self):
+        return self.lattice_class
+
+    def _get_insert_query(self) -> str:
+        return self._get_model_class().get_insert_query()
+
+    def _get_new_lattice(self, size: int):
+        LatticeClass = self._get_lattice_class()
+        # run() merges clusters itself, the lattice labeler is never used
+        return LatticeClass(size)
+
+    def _get_boundary_masks(self, lattice) -> List[int]:
+        """
+            For each node, a bitmask of the lattice boundaries it
+            belongs to. A cluster connects the boundaries when the
+            bitwise or over its nodes has every bit set.
+        """
+        shape = lattice.as_array().shape
+        masks = [0] * lattice.get_number_of_nodes()
+        for bit, boundary in enumerate(lattice.get_boundaries()):
+            for node in boundary:
+                masks[numpy.ravel_multi_index(node, shape)] |= 1 << bit
+        return masks
+
+    def run(self):
+        lattice = self._get_new_lattice(self.size)
+        number_of_nodes = lattice.get_number_of_nodes()
+        dimensions = lattice.as_array().ndim
+        periodic = lattice.is_periodic()
+
+        neighbours = lattice.get_neighbour_table().tolist()
+        offsets = lattice.get_neighbour_offsets()
+        boundary_masks = self._get_boundary_masks(lattice)
+        spanning_mask = (1 << len(lattice.get_boundaries())) - 1
+
+        union_find = DisplacementUnionFind(number_of_nodes, dimensions)
+        occupied = [False] * number_of_nodes
+        root_masks = list(boundary_masks)
+        percolating = [False] * number_of_nodes
+
+        random_generator = numpy.random.default_rng(self.seed)
+        order = random_generator.permutation(number_of_nodes).tolist()
+
+        number_of_clusters = 0
+        largest_cluster_size = 0
+        percolating_clusters = 0
+        percolating_nodes = 0
+
+        observables = {name: [0] for name in self.OBSERVABLES}
+
+        for occupation_number, node in enumerate(order, start=1):
+            occupied[node] = True
+            number_of_clusters += 1
+
+            if not periodic and root_masks[node] == spanning_mask:
+                # A single node connecting both boundaries
+                percolating[node] = True
+                percolating_clusters += 1
+                percolating_nodes += 1
+
+            for neighbour, displacement in zip(neighbours[node], offsets):
+                if neighbour == NO_NEIGHBOUR or not occupied[neighbour]:
+                    continue
+
+                roots = {union_find.find(node), union_find.find(neighbour)}
+                if len(roots) == 2:
+                    number_of_clusters -= 1
+
+                # Take the clusters out of the counts, and put the merged one back
+                mask, was_percolating = 0, False
+                for merged_root in roots:
+                    mask |= root_masks[merged_root]
+                    if percolating[merged_root]:
+                        was_percolating = True
+                        percolating_clusters -= 1
+                        percolating_nodes -= union_find.get_size(merged_root)
+
+                root = union_find.union(node, neighbour, displacement)
+                root_masks[root] = mask
+                if periodic:
+                    is_percolating = any(union_find.get_wrapping(root))
+                else:
+                    is_percolating = mask == spanning_mask
+
+                percolating[root] = was_percolating or is_percolating
+                if percolating[root]:
+                    percolating_clusters += 1
+                    percolating_nodes += union_find.get_size(root)
+
+            largest_cluster_size = max(largest_cluster_size, union_find.get_size(node))
+
+            finite_clusters = number_of_clusters - percolating_clusters
+            finite_nodes = occupation_number - percolating_nodes
+            mean_cluster_size = finite_nodes / finite_clusters if finite_clusters else 0
+
+            observables["has_percolated"].append(int(percolating_clusters > 0))
+            observables["largest_cluster_size"].append(largest_cluster_size)
+            observables["mean_cluster_size"].append(mean_cluster_size)
+            observables["percolating_cluster_strength"].append(
+                percolating_nodes / number_of_nodes
+            )
+
+        return {name: numpy.array(values) for name, values in observables.items()}
+
+    def execute(self):
+        start = datetime.now()
+        self._observables = self.run()
+        end = datetime.now()
+        self.took = end - start
+        self._has_run = True
+
+
+# Fan out modes of PercolationProcessor, see PercolationProcessor._fan_out
+QUEUE_FAN_OUT = "queue"
+LOCAL_FAN_OUT = "local"
+
+
 class PercolationProcessor(Processor):
+    """
+        Runs message["repeat"] simulations with message["parameters"].
+
+        With fan out enabled, messages repeating more than
+        fan_out_chunk_size simulations are split in chunks, which are
+        either written back to queue_class as sub-messages
+        (QUEUE_FAN_OUT), for any idle worker to pick up, or run on a
+        local process pool (LOCAL_FAN_OUT). Chunks draw from the same
+        seed streams as the whole message would have.
+    """
+
+    # Simulations are CPU bound
+    concurrency = PROCESS_CONCURRENCY
+
+    fan_out: Optional[str] = None
+    fan_out_chunk_size: int = 16
+
+    def __init__(
+        self,
+        fan_out: Optional[str] = None,
+        fan_out_chunk_size: Optional[int] = None,
+        fan_out_workers: Optional[int] = None,
+    ):
+        super().__init__()
+        if fan_out not in (None, QUEUE_FAN_OUT, LOCAL_FAN_OUT):
+            raise ValueError(f"Unknown fan out mode: {fan_out}")
+        self.fan_out = fan_out or self.fan_out
+        self.fan_out_chunk_size = fan_out_chunk_size or self.fan_out_chunk_size
+        self._fan_out_workers = fan_out_workers
+        # Created on first use, for LOCAL_FAN_OUT
+        self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
     def _get_simulation_class(self):
         return self.simulation_class
 
-    def process(self, message: Message):
-        parameters = message.body["parameters"]
+    def _get_queue(self) -> SQSQueue:
+        return self.queue_class(DequeuerConfig.ENV)
+
+    def _get_seed_entropy(self, message: Message) -> int:
+        seed_sequence = numpy.random.SeedSequence(message.body.get("seed"))
+        self._logger.info(
+            f"Seed entropy for message ({message.id}): {seed_sequence.entropy}"
+        )
+        return seed_sequence.entropy
+
+    def _get_seed_sequences(self, message: Message) -> List[numpy.random.SeedSequence]:
+        """
+            Return one independent seed sequence per repetition, spawned
+            from the message "seed" when present, or from fresh OS
+            entropy otherwise, so that workers never share a stream.
+            A chunk of a larger message ("seed_offset" set) gets the
+            streams at its offset, the same the whole message would get.
+        """
         repeat = message.body["repeat"]
+        offset = message.body.get("seed_offset", 0)
+        entropy = self._get_seed_entropy(message)
+        return [
+            numpy.random.SeedSequence(entropy, spawn_key=(offset + index,))
+            for index in range(repeat)
+        ]
+
+    def _should_fan_out(self, message: Message) -> bool:
+        return (
+            self.fan_out is not None
+            and "parent_id" not in message.body
+            and message.body["repeat"] > self.fan_out_chunk_size
+        )
+
+    def _get_chunk_messages(self, message: Message) -> List[DetachedMessage]:
+        body = message.body
+        entropy = self._get_seed_entropy(message)
+        offsets = range(0, body["repeat"], self.fan_out_chunk_size)
+
+        chunk_messages = []
+        for chunk, offset in enumerate(offsets):
+            chunk_body = dict(
+                body,
+                repeat=min(self.fan_out_chunk_size, body["repeat"] - offset),
+                seed=entropy,
+                seed_offset=offset,
+                parent_id=message.id,
+                chunk=chunk,
+                chunks=len(offsets),
+                fan_out=self.fan_out,
+            )
+            chunk_messages.append(DetachedMessage(f"{message.id}:{chunk}", chunk_body))
+        return chunk_messages
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self._fan_out_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def _fan_out(self, message: Message):
+        chunk_messages = self._get_chunk_messages(message)
+        self._logger.info(
+            f"Splitting message ({message.id}) in {len(chunk_messages)} chunks"
+        )
+
+        if self.fan_out == QUEUE_FAN_OUT:
+            self._get_queue().write([chunk.body for chunk in chunk_messages])
+            return
 
-        for index in range(repeat):
-            SimulationClass = self._get_simulation_class()
-            simulation = SimulationClass(**parameters)
+        executor = self._get_executor()
+        futures = {
+            executor.submit(process_message, self, chunk): chunk
+            for chunk in chunk_messages
+        }
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            chunk = futures[future]
+            try:
+                took = future.result()
+                self._log_chunk_done(chunk, took)
+            except Exception:
+                self._logger.exception(f"Exception in chunk ({chunk.id}): ")
+                failed.append(chunk.id)
+
+        if failed:
+            raise RuntimeError(f"Chunks failed: {', '.join(failed)}")
+
+    def _log_chunk_done(self, message: Message, took: float):
+        body = message.body
+        self._logger.info(
+            f"Finished chunk {body['chunk'] + 1}/{body['chunks']} "
+            f"of message ({body['parent_id']}), took {round(took, 3)}s"
+        )
+
+    def _write_simulation(self, writer: BulkWriter, simulation: Simulation):
+        for model in simulation.get_models():
+            writer.add(simulation._get_insert_query(), model.to_db())
+
+    def run_simulations(self, message: Message) -> Iterator[Simulation]:
+        """
+            Run and yield the simulations message asks for,
+            one per seed sequence, without writing them anywhere.
+        """
+        parameters = message.body["parameters"]
+        SimulationClass = self._get_simulation_class()
+        for seed_sequence in self._get_seed_sequences(message):
+            simulation = SimulationClass(**parameters, seed=seed_sequence)
             simulation.execute()
-            mysql = MySQL()
-            mysql.execute(simulation._get_insert_query(), simulation.model.to_db())
-            mysql = None
+            yield simulation
+
+    def process(self, message: Message):
+        if self._should_fan_out(message):
+            self._fan_out(message)
+            return
+
+        start = time.perf_counter()
+        with BulkWriter() as writer:
+            for simulation in self.run_simulations(message):
+                self._write_simulation(writer, simulation)
+
+        # Chunks run locally are reported by the processor that split them
+        if message.body.get("fan_out") == QUEUE_FAN_OUT:
+            self._log_chunk_done(message, time.perf_counter() - start)
@@ -0,0 +1,198 @@
+import math
+
+import numpy
+
+from typing import Optional, Tuple
+
+from musk.lattices.labeling import SubClusterMerge, get_unwrapped_coordinates
+
+# Largest number of node pairs compared at once by the pair based path
+PAIR_CHUNK_SIZE = 2 ** 22
+
+
+def get_displacement_shape(shape: Tuple[int, ...], periodic: bool) -> Tuple[int, ...]:
+    """
+        Shape of the array indexed by displacements between nodes.
+        Displacements wrap around a periodic lattice; on an open lattice
+        the array is padded so that negative displacements get their own
+        entries (d and d - (2L - 1) share an index).
+    """
+    if periodic:
+        return tuple(shape)
+    return tuple(2 * extent - 1 for extent in shape)
+
+
+def get_folded_shape(shape: Tuple[int, ...], periodic: bool) -> Tuple[int, ...]:
+    """
+        Shape of the array indexed by absolute displacements, using the
+        minimum image on a periodic lattice.
+    """
+    if periodic:
+        return tuple(extent // 2 + 1 for extent in shape)
+    return tuple(shape)
+
+
+def fold_displacements(
+    displacements: numpy.ndarray, extents: Tuple[int, ...]
+) -> numpy.ndarray:
+    """
+        Turn displacements (one row per axis), taken modulo the
+        displacement shape, into absolute displacements. On a periodic
+        lattice this is the minimum image.
+    """
+    extents = numpy.array(extents).reshape((-1,) + (1,) * (displacements.ndim - 1))
+    return numpy.minimum(displacements, extents - displacements)
+
+
+def get_same_cluster_pair_counts(
+    labels: numpy.ndarray, periodic: bool
+) -> numpy.ndarray:
+    """
+        Count, for every displacement, the ordered pairs of nodes sharing
+        a nonzero label, as an array with the displacement shape.
+        Pairs of a node with itself are counted at displacement 0.
+
+        Small clusters compare all their pairs, grouped by cluster size;
+        clusters whose s ** 2 pairs cost more than an FFT over the lattice
+        are counted with the autocorrelation of their indicator instead.
+    """
+    shape = labels.shape
+    extents = get_displacement_shape(shape, periodic)
+    number_of_displacements = int(numpy.prod(extents))
+    fft_cost = number_of_displacements * math.log2(max(number_of_displacements, 2))
+
+    flat_labels = labels.ravel()
+    sizes = numpy.bincount(flat_labels)
+    order = numpy.argsort(flat_labels, kind="stable")
+    coordinates = numpy.stack(numpy.unravel_index(order, shape))
+    starts = numpy.cumsum(sizes) - sizes
+
+    counts = numpy.zeros(number_of_displacements, dtype=numpy.int64)
+    strides = numpy.array(
+        [int(numpy.prod(extents[axis + 1 :])) for axis in range(len(shape))]
+    ).reshape(-1, 1, 1, 1)
+    moduli = numpy.array(extents).reshape(-1, 1, 1, 1)
+
+    cluster_sizes = sizes.copy()
+    cluster_sizes[0] = 0
+    for size in numpy.unique(cluster_sizes[cluster_sizes > 0]):
+        cluster_labels = numpy.flatnonzero(cluster_sizes == size)
+
+        if size * size > fft_cost:
+            for label in cluster_labels:
+                nodes = coordinates[:, starts[label] : starts[label] + size]
+                counts += _get_autocorrelation(nodes, extents)
+            continue
+
+        chunk = max(1, PAIR_CHUNK_SIZE // int(size * size))
+        for first in range(0, len(cluster_labels), chunk):
+            blocks = starts[cluster_labels[first : first + chunk]]
+            nodes = coordinates[:, blocks[:, None] + numpy.arange(size)]
+            displacements = (nodes[:, :, None, :] - nodes[:, :, :, None]) % moduli
+            indexes = (displacements * strides).sum(axis=0)
+            counts += numpy.bincount(
+                indexes.ravel(), minlength=number_of_displacements
+            )
+
+    return counts.reshape(extents)
+
+
+def _get_autocorrelation(
+    nodes: numpy.ndarray, extents: Tuple[int, ...]
+) -> numpy.ndarray:
+    indicator = numpy.zeros(extents)
+    indicator[tuple(nodes)] = 1
+    transform = numpy.fft.rfftn(indicator)
+    autocorrelation = numpy.fft.irfftn(
+        transform * transform.conj(), s=extents, axes=range(len(extents))
+    )
+    return numpy.rint(autocorrelation).astype(numpy.int64).ravel()
+
+
+def get_pair_counts(shape: Tuple[int, ...], periodic: bool) -> numpy.ndarray:
+    """
+        Count, for every displacement, the ordered pairs of lattice nodes,
+        as an array with the displacement shape.
+    """
+    extents = get_displacement_shape(shape, periodic)
+    counts = numpy.ones(extents, dtype=numpy.int64)
+    for axis, (extent, displacement_extent) in enumerate(zip(shape, extents)):
+        if periodic:
+            axis_counts = numpy.full(displacement_extent, extent)
+        else:
+            displacements = numpy.arange(displacement_extent)
+            displacements = fold_displacements(displacements, (displacement_extent,))
+            axis_counts = extent - displacements
+        view = [1] * len(shape)
+        view[axis] = displacement_extent
+        counts = counts * axis_counts.reshape(view)
+    return counts
+
+
+def fold_counts(
+    counts: numpy.ndarray, shape: Tuple[int, ...], periodic: bool
+) -> numpy.ndarray:
+    """
+        Sum counts indexed by displacement into absolute displacements.
+    """
+    extents = counts.shape
+    folded_shape = get_folded_shape(shape, periodic)
+    minlength = int(numpy.prod(folded_shape))
+
+    folded = fold_displacements(numpy.indices(extents), extents)
+    indexes = numpy.ravel_multi_index(tuple(folded), folded_shape)
+    return numpy.bincount(
+        indexes.ravel(), weights=counts.ravel(), minlength=minlength
+    ).reshape(folded_shape)
+
+
+def get_connectedness_function(
+    labels: numpy.ndarray, periodic: bool
+) -> numpy.ndarray:
+    """
+        Exact connectedness function of a label array: the fraction of
+        node pairs at each absolute displacement (minimum image on a
+        periodic lattice) that share a nonzero label, over all pairs.
+        Nodes at zero displacement are always connected.
+    """
+    shape = labels.shape
+    same_cluster = fold_counts(
+        get_same_cluster_pair_counts(labels, periodic), shape, periodic
+    )
+    pairs = fold_counts(get_pair_counts(shape, periodic), shape, periodic)
+
+    connectedness = same_cluster / pairs
+    connectedness[(0,) * labels.ndim] = 1
+    return connectedness
+
+
+def get_gyration_radii(
+    labels: numpy.ndarray,
+    periodic: bool,
+    sub_clusters: Optional[SubClusterMerge] = None,
+) -> numpy.ndarray:
+    """
+        Squared radius of gyration R_s ** 2 of every label, the mean
+        squared distance of its nodes to their center of mass, from
+        per-label sums taken with numpy.bincount (label 0 included).
+
+        On a periodic lattice, clusters crossing the boundary are first
+        unwrapped exactly (see get_unwrapped_coordinates), reusing
+        sub_clusters when given; radii of wrapping clusters are not
+        meaningful.
+    """
+    flat_labels = labels.ravel()
+    sizes = numpy.bincount(flat_labels)
+    counts = numpy.maximum(sizes, 1)
+
+    if periodic:
+        coordinates = get_unwrapped_coordinates(labels, sub_clusters)
+    else:
+        coordinates = numpy.indices(labels.shape).reshape(labels.ndim, -1)
+
+    radii = numpy.zeros(len(sizes))
+    for positions in coordinates:
+        mean = numpy.bincount(flat_labels, weights=positions) / counts
+        deviations = positions - mean[flat_labels]
+        radii += numpy.bincount(flat_labels, weights=deviations ** 2) / counts
+    return radii
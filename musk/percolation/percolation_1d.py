@@ -20,6 +20,7 @@ class P1LStatsQueue(SQSQueue):
 
 class P1LModel(PercolationModel):
     _tablename: str = "percolation_1d_linear"
+    lattice_dimensions = 1
 
 
 class P1LStatsModel(PercolationStatsModel):
@@ -40,3 +41,4 @@ class P1LStatsProcessor(PercolationStatsProcessor):
 
 class P1LProcessor(PercolationProcessor):
     simulation_class = P1LSimulation
+    queue_class = P1LQueue
@@ -1,16 +1,18 @@
-import bz2
 import itertools
 
 import math
 import json
+import numpy
 import pymysql
 from dataclasses import asdict
 from datetime import datetime
 from typing import Optional
 from pydantic.dataclasses import dataclass
-from musk.core import Message, MySQL, SQSQueue
+from musk.core import SQSQueue
 from musk.lattices import Square2DPeriodicLattice
-from musk.misc.json import PythonObjectEncoder, as_python_object
+from musk.lattices.base import Seed
+from musk.misc.compression import CompressedBlob
+from musk.misc.observables import ObservablesFormat, get_compact_labels
 from musk.percolation.base import (
     PercolationModel,
     PercolationProcessor,
@@ -43,6 +45,10 @@ class P2MModel:
 
     id: Optional[int] = None
 
+    lattice_dimensions = 2
+    # Compression codec for new rows, see musk.misc.compression
+    observables_codec = "zlib-6"
+
     @classmethod
     def get_insert_query(cls):
         query = f"""
@@ -99,18 +105,17 @@ class P2MModel:
     @classmethod
     def from_db(cls, row: dict):
         row = row.copy()  # Don't change original row
-        row["observables"] = bz2.decompress(row["observables"])
-        row["observables"] = json.loads(
-            row["observables"], object_hook=as_python_object
+        row["observables"] = ObservablesFormat.decode(
+            CompressedBlob.decompress(row["observables"]),
+            shape=(row["size"],) * cls.lattice_dimensions,
         )
         return cls(**row)
 
     def to_db(self):
-        observables_string = json.dumps(
-            self.observables, cls=PythonObjectEncoder
-        ).encode("utf-8")
-
-        observables_compressed = pymysql.Binary(bz2.compress(bytes(observables_string)))
+        observables_bytes = ObservablesFormat.encode(self.observables)
+        observables_compressed = pymysql.Binary(
+            CompressedBlob.compress(observables_bytes, self.observables_codec)
+        )
         model_dict = asdict(self)
         model_dict.update(dict(observables=observables_compressed))
         return model_dict
@@ -144,10 +149,10 @@ class P2MStatsModel:
                 %(cluster_size_histogram)s, %(average_cluster_size)s, %(average_correlation_length)s,
                 %(created)s, %(took)s)
             ON DUPLICATE KEY UPDATE
-            has_percolated = %(has_percolated)s,
-            cluster_size_histogram = %(cluster_size_histogram)s,
-            average_cluster_size = %(average_cluster_size)s,
-            average_correlation_length = %(average_correlation_length)s
+            has_percolated = VALUES(has_percolated),
+            cluster_size_histogram = VALUES(cluster_size_histogram),
+            average_cluster_size = VALUES(average_cluster_size),
+            average_correlation_length = VALUES(average_correlation_length)
         """
 
     @classmethod
@@ -160,7 +165,9 @@ class P2MStatsModel:
         column_names = "`, `".join(attributes)
         value_strings = [f"%({key})s" for key in attributes]
         value_string = ", ".join(value_strings)
-        update_strings = [f"`{key}` = %({key})s" for key in non_key_attributes]
+        # VALUES(column) rather than a parameter, so that the query
+        # also works with MySQL.execute_many
+        update_strings = [f"`{key}` = VALUES(`{key}`)" for key in non_key_attributes]
         update_string = ",\n".join(update_strings)
 
         query = f"""
@@ -186,38 +193,54 @@ class P2MSimulation(PercolationSimulation):
     model_class = P2MModel
     lattice_class = Square2DPeriodicLattice
 
-    def __init__(self, probability: float, initial_size: int, n_divisions: int):
+    # Each division only adds occupied nodes, so clusters from the
+    # previous level can be reused instead of relabeling from scratch
+    incremental_labeling = True
+
+    def __init__(
+        self,
+        probability: float,
+        initial_size: int,
+        n_divisions: int,
+        seed: Seed = None,
+    ):
 
         self.probability = probability
         self.initial_size = initial_size
         self.n_divisions = n_divisions
+        self.seed = seed
         self.created = datetime.now()
         self._models = []
 
     def _get_model_from_lattice(self, lattice):
         division_index = math.log2(lattice.get_size())
+        labels, _ = lattice.get_cluster_labels(1)
         return P2MModel(
             probability=self.probability,
             size=lattice.get_size(),
             index=division_index,
             initial_size=self.initial_size,
-            observables=dict(clusters=lattice.get_clusters_with_state(1)),
+            observables=dict(labels=get_compact_labels(labels)),
             created=self.created,
         )
 
     def run(self):
         models = []
-        LatticeClass = self._get_lattice_class()
-        lattice = LatticeClass(self.initial_size)
+        lattice = self._get_new_lattice(self.initial_size)
+        random_generator = numpy.random.default_rng(self.seed)
         lattice.fill_randomly(
-            [0, 1], state_weights=[1 - self.probability, self.probability]
+            [0, 1],
+            state_weights=[1 - self.probability, self.probability],
+            seed=random_generator,
         )
 
         models.append(self._get_model_from_lattice(lattice))
 
         for index in range(self.n_divisions):
             lattice.divide()
-            lattice.change_state_with_probability(0, 1, self.probability)
+            lattice.change_state_with_probability(
+                0, 1, self.probability, seed=random_generator
+            )
             models.append(self._get_model_from_lattice(lattice))
 
         """
@@ -250,21 +273,14 @@ class P2MSimulation(PercolationSimulation):
         # So we use .models, not .model
         raise NotImplementedError
 
+    def get_models(self) -> list:
+        # One model per division
+        return self.models
+
 
 class P2MProcessor(PercolationProcessor):
     simulation_class = P2MSimulation
-
-    def process(self, message: Message):
-        parameters = message.body["parameters"]
-        repeat = message.body["repeat"]
-        for index in range(repeat):
-            SimulationClass = self._get_simulation_class()
-            simulation = SimulationClass(**parameters)
-            simulation.execute()
-            mysql = MySQL()
-            for model in simulation.models:
-                mysql.execute(simulation._get_insert_query(), model.to_db())
-            mysql = None
+    queue_class = P2MQueue
 
 
 class P2MStatsProcessor(PercolationStatsProcessor):
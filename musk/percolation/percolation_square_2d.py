@@ -1,6 +1,8 @@
 from musk.core.sqs import SQSQueue
 from musk.lattices import Square2DPeriodicLattice
 from musk.percolation.base import (
+    NewmanZiffModel,
+    NewmanZiffSimulation,
     PercolationModel,
     PercolationProcessor,
     PercolationSimulation,
@@ -18,10 +20,18 @@ class P2SStatsQueue(SQSQueue):
     name = "percolation_2d_square_stats"
 
 
+class P2SNewmanZiffQueue(SQSQueue):
+    name = "percolation_2d_square_newman_ziff"
+
+
 class P2SModel(PercolationModel):
     _tablename: str = "p2s"
 
 
+class P2SNewmanZiffModel(NewmanZiffModel):
+    _tablename: str = "p2s_newman_ziff"
+
+
 class P2SStatsModel(PercolationStatsModel):
     _tablename: str = "percolation_2d_square_stats"
 
@@ -31,6 +41,11 @@ class P2SSimulation(PercolationSimulation):
     lattice_class = Square2DPeriodicLattice
 
 
+class P2SNewmanZiffSimulation(NewmanZiffSimulation):
+    model_class = P2SNewmanZiffModel
+    lattice_class = Square2DPeriodicLattice
+
+
 class P2SStatsProcessor(PercolationStatsProcessor):
 
     simulation_model_class = P2SModel
@@ -40,3 +55,9 @@ class P2SStatsProcessor(PercolationStatsProcessor):
 
 class P2SProcessor(PercolationProcessor):
     simulation_class = P2SSimulation
+    queue_class = P2SQueue
+
+
+class P2SNewmanZiffProcessor(PercolationProcessor):
+    simulation_class = P2SNewmanZiffSimulation
+    queue_class = P2SNewmanZiffQueue
@@ -1,62 +1,105 @@
-import itertools
 import json
 import numpy
-import random
 
-from collections import defaultdict
-from datetime import datetime
-
-from musk.core import MySQL, Processor
-
-
-class HasPercolatedHelper:
-    def __init__(self, lattice):
-        self._lattice = lattice
-        self._clusters = {}
-
-    def has_percolated(self, cluster):
-        try:
-            return self._clusters[cluster]
-        except KeyError:
-            self._clusters[cluster] = self._has_percolated(cluster)
-            return self._clusters[cluster]
-
-    def _has_percolated(self, cluster):
-        return self._has_percolated_infinite(cluster)
-
-    def _has_percolated_finite(self, cluster):
-        cluster_size = len(cluster)
-        top_boundary, bottom_boundary = self._lattice.get_boundaries()
-        has_percolated = bool(
-            cluster_size >= self._lattice.get_size()
-            and (cluster & top_boundary)
-            and (cluster & bottom_boundary)
-        )
-        return has_percolated
-
-    def _has_percolated_infinite(self, cluster):
-        # Method used to compute has_percolated in an infinite lattice.
-        # Idea is to count number of different nodes in each direction
-        # and check if this is larger than the size of the lattice.
-
-        # WARNING: 2D specific
-
-        seen_i = set([i for (i, j) in cluster])
-        if len(seen_i) >= self._lattice.get_size():
-            return True
-
-        seen_j = set([j for (i, j) in cluster])
-        if len(seen_j) >= self._lattice.get_size():
-            return True
-
-        return False
+from typing import Dict, List
+
+from musk.core import BulkWriter, MySQL, Processor
+from musk.core.processor import THREAD_CONCURRENCY
+from musk.lattices.labeling import get_wrapping, merge_open_sub_clusters
+from musk.misc.histogram import (
+    SizeCounts,
+    encode_size_counts,
+    get_log_binned_size_counts,
+    get_size_counts,
+)
+from musk.percolation.correlation import (
+    fold_displacements,
+    get_connectedness_function,
+    get_displacement_shape,
+    get_folded_shape,
+    get_gyration_radii,
+)
+
+
+class ClusterAnalysis:
+    """
+        Per-model view of the clusters in a label array, computed once
+        and shared by every StatsCalculation of the model:
+
+        labels:         label of every node, 0 for nodes in no cluster
+        sizes:          size of every label (sizes[0] counts empty nodes)
+        is_cluster:     whether a label is an actual cluster
+        wrapping:       (labels, dimensions) array telling, per axis,
+                        whether a cluster wraps around a periodic lattice
+        spanning:       (labels, dimensions) array telling, per axis,
+                        whether a cluster spans the lattice along it,
+                        which on a periodic lattice means wrapping
+        percolating:    whether a cluster spans the lattice along any axis
+        finite:         whether a label is a non percolating cluster
+        finite_labels:  labels with nodes of percolating clusters set to 0
+        sub_clusters:   open sub-clusters of a periodic lattice merged
+                        across its edges (see merge_open_sub_clusters),
+                        shared by wrapping and the gyration radii;
+                        None on an open lattice
+    """
+
+    def __init__(self, labels: numpy.ndarray, periodic: bool = False):
+        self.labels = labels
+        self.periodic = periodic
+        self.shape = labels.shape
+        self.dimensions = labels.ndim
+        self.number_of_nodes = labels.size
+
+        flat_labels = labels.ravel()
+        self.sizes = numpy.bincount(flat_labels)
+        self.is_cluster = self.sizes > 0
+        self.is_cluster[0] = False
+
+        self.sub_clusters = None
+        if periodic:
+            self.sub_clusters = merge_open_sub_clusters(labels)
+            self.wrapping = get_wrapping(labels, self.sub_clusters)
+            self.spanning = self.wrapping
+        else:
+            self.wrapping = numpy.zeros((len(self.sizes), self.dimensions), bool)
+            self.spanning = self._get_spanning(flat_labels)
+        self.percolating = self.spanning.any(axis=1)
+        self.finite = self.is_cluster & ~self.percolating
+        self.finite_labels = numpy.where(self.finite[labels], labels, 0)
+
+    @classmethod
+    def from_model(cls, model, periodic: bool = False) -> "ClusterAnalysis":
+        return cls(numpy.asarray(model.observables["labels"]), periodic)
+
+    def _get_spanning(self, flat_labels: numpy.ndarray) -> numpy.ndarray:
+        # A cluster of an open lattice spans an axis when it occupies every
+        # coordinate along it. Distinct coordinates are counted from
+        # distinct (label, coordinate) pairs, one numpy.unique per axis.
+        occupied = numpy.flatnonzero(flat_labels)
+        occupied_labels = flat_labels[occupied].astype(numpy.int64)
+        coordinates = numpy.unravel_index(occupied, self.shape)
+
+        spanning = numpy.zeros((len(self.sizes), self.dimensions), dtype=bool)
+        for axis, extent in enumerate(self.shape):
+            pairs = numpy.unique(occupied_labels * extent + coordinates[axis])
+            seen = numpy.bincount(pairs // extent, minlength=len(self.sizes))
+            spanning[:, axis] = seen >= extent
+        return spanning
+
+    def get_cluster_sizes(self) -> numpy.ndarray:
+        return self.sizes[self.is_cluster]
+
+    def get_finite_cluster_sizes(self) -> numpy.ndarray:
+        return self.sizes[self.finite]
+
+    def get_percolating_cluster_sizes(self) -> numpy.ndarray:
+        return self.sizes[self.percolating]
 
 
 class StatsCalculation:
-    def __init__(self, lattice, model, has_percolated_helper):
-        self.lattice = lattice
+    def __init__(self, analysis: ClusterAnalysis, model):
+        self.analysis = analysis
         self.model = model
-        self.has_percolated_helper = has_percolated_helper
 
     def _encode_list_as_dict(self, list_: list) -> dict:
         return {size: round(count, 4) for size, count in enumerate(list_) if count > 0}
@@ -67,109 +110,146 @@ class StatsCalculation:
 
 class HasPercolatedCalculation(StatsCalculation):
     def calculate(self) -> bool:
-        clusters = self.model.observables["clusters"]
-        has_percolated = False
-        for cluster in clusters:
-            if self.has_percolated_helper.has_percolated(cluster):
-                has_percolated = True
-                break
-        return has_percolated
+        return bool(self.analysis.percolating.any())
+
+
+class WrappingCalculation(StatsCalculation):
+    """
+        Whether any cluster wraps around a periodic lattice horizontally
+        (along the last axis), vertically (along the first axis), in
+        either direction, or in both.
+    """
+
+    def calculate(self) -> dict:
+        wrapping = self.analysis.wrapping
+        return dict(
+            horizontal=bool(wrapping[:, -1].any()),
+            vertical=bool(wrapping[:, 0].any()),
+            either=bool(wrapping.any()),
+            both=bool(wrapping.all(axis=1).any()),
+        )
+
+    def encode_for_db(self, value):
+        return json.dumps(value)
 
 
 class CorrelationFunctionCalculation(StatsCalculation):
+    """
+        Monte Carlo estimate of the connectedness function: the fraction
+        of node pairs, at each absolute displacement (minimum image on
+        a periodic lattice), that belong to the same finite cluster.
+        Node pairs are drawn samples at a time as index arrays.
+    """
 
     SAMPLES = 2 ** 17  # 128K
     BINS = 10000
 
-    def __init__(self, lattice, model, has_percolated_helper):
-        self.lattice = lattice
-        self.model = model
-        self.has_percolated_helper = has_percolated_helper
-        self.node_to_cluster_map = self._get_node_to_cluster_map()
-        self.lattice_size = self.lattice.get_size()
-        self.half_lattice_size = int(self.lattice_size / 2)
-
-    def _get_node_to_cluster_map(self) -> dict:
+    def __init__(self, analysis: ClusterAnalysis, model, samples: int = None):
+        super().__init__(analysis, model)
+        self.samples = samples or self.SAMPLES
 
-        map_ = dict()
-        clusters = self.model.observables["clusters"]
-        for index, cluster in enumerate(clusters):
+    def _get_correlation_function_dict(self, correlation_function) -> dict:
+        # Keys are displacement tuples, keys whose value is 0 are removed
+        return {
+            tuple(map(int, distance_vector)): round(float(value), 3)
+            for distance_vector, value in numpy.ndenumerate(correlation_function)
+            if round(float(value), 3) > 0
+        }
 
-            # Single node clusters are useless here
-            if len(cluster) == 1:
-                continue
-            # Only take finite clusters into account
-            if self.has_percolated_helper.has_percolated(cluster):
-                continue
-            for node in cluster:
-                map_[node] = index
+    def calculate(self):
+        analysis = self.analysis
+        random_generator = numpy.random.default_rng()
+        first_nodes, second_nodes = random_generator.integers(
+            analysis.number_of_nodes, size=(2, self.samples)
+        )
+        distinct = first_nodes != second_nodes
+        first_nodes, second_nodes = first_nodes[distinct], second_nodes[distinct]
+
+        # Single node clusters never hold two distinct nodes, so only
+        # finite clusters matter here
+        labels = analysis.finite_labels.ravel()
+        first_labels = labels[first_nodes]
+        belong_to_same_cluster = (first_labels > 0) & (
+            first_labels == labels[second_nodes]
+        )
 
-        return map_
+        extents = get_displacement_shape(analysis.shape, analysis.periodic)
+        displacements = numpy.stack(
+            numpy.unravel_index(second_nodes, analysis.shape)
+        ) - numpy.stack(numpy.unravel_index(first_nodes, analysis.shape))
+        displacements %= numpy.array(extents).reshape(-1, 1)
+        folded_shape = get_folded_shape(analysis.shape, analysis.periodic)
+        indexes = numpy.ravel_multi_index(
+            tuple(fold_displacements(displacements, extents)), folded_shape
+        )
 
-    def _nodes_belong_to_same_cluster(self, first_node, second_node) -> bool:
-        try:
-            return bool(
-                self.node_to_cluster_map[first_node]
-                == self.node_to_cluster_map[second_node]
-            )
-        except KeyError:
-            return False
+        minlength = int(numpy.prod(folded_shape))
+        observations = numpy.bincount(indexes, minlength=minlength)
+        same_cluster = numpy.bincount(
+            indexes, weights=belong_to_same_cluster, minlength=minlength
+        )
+        correlation_function = numpy.divide(
+            same_cluster,
+            observations,
+            out=numpy.zeros(minlength),
+            where=observations > 0,
+        ).reshape(folded_shape)
+        # Nodes at zero distance are always in the same cluster
+        correlation_function[(0,) * len(folded_shape)] = 1
 
-    def _compute_distance_vector(self, node1, node2):
+        return self._get_correlation_function_dict(correlation_function)
 
-        x1, y1 = node1
-        x2, y2 = node2
+    def _encode_set_keys_as_str(self, value):
+        encoded = dict()
+        for key in value:
+            strkey = "_".join(map(str, key))
+            encoded[strkey] = value[key]
+        return encoded
 
-        dx = abs(x2 - x1)
-        dy = abs(y2 - y1)
+    def encode_for_db(self, value):
+        return json.dumps(self._encode_set_keys_as_str(value))
 
-        if dx > self.half_lattice_size:
-            dx = self.lattice_size - dx
 
-        if dy > self.half_lattice_size:
-            dy = self.lattice_size - dy
+class ExactCorrelationFunctionCalculation(CorrelationFunctionCalculation):
+    """
+        Connectedness function over every node pair rather than a sample,
+        see musk.percolation.correlation.get_connectedness_function.
+        Stored in the same format as CorrelationFunctionCalculation.
+    """
 
-        return dx, dy
+    def __init__(self, analysis: ClusterAnalysis, model):
+        # Nothing is sampled, so there is no samples argument
+        StatsCalculation.__init__(self, analysis, model)
 
     def calculate(self):
-        all_nodes = list(self.lattice.get_all_nodes())
-        correlation_function = defaultdict(list)
-        correlation_function[(0, 0)] = [
-            1
-        ]  # Nodes at zero distance are always in the same cluster
-
-        for _ in range(self.SAMPLES):
-            first_node, second_node = random.choices(all_nodes, k=2)
-            if first_node == second_node:
-                continue
-            belong_to_same_cluster = self._nodes_belong_to_same_cluster(
-                first_node, second_node
-            )
-            # 2D Specific!
-            distance_vector = self._compute_distance_vector(first_node, second_node)
-            correlation_function[distance_vector].append(belong_to_same_cluster)
-
-        for distance_vector in correlation_function:
-            observations = correlation_function[distance_vector]
-            correlation_function[distance_vector] = round(
-                sum(observations) / len(observations), 3
-            )
+        correlation_function = get_connectedness_function(
+            self.analysis.finite_labels, self.analysis.periodic
+        )
+        return self._get_correlation_function_dict(correlation_function)
 
-        correlation_function = {
-            key: value for key, value in correlation_function.items() if value > 0
-        }  # Remove keys whose value is 0
 
-        return correlation_function
+class CorrelationLengthCalculation(StatsCalculation):
+    """
+        Correlation length xi over finite clusters, from their squared
+        radii of gyration R_s ** 2:
+            xi ** 2 = sum(2 * R_s ** 2 * s ** 2) / sum(s ** 2)
+        summed over clusters, which is the usual sum over sizes
+        weighted by n_s.
+    """
 
-    def _encode_set_keys_as_str(self, value):
-        encoded = dict()
-        for key in value:
-            strkey = f"{key[0]}_{key[1]}"
-            encoded[strkey] = value[key]
-        return encoded
+    def calculate(self) -> float:
+        analysis = self.analysis
+        radii = get_gyration_radii(
+            analysis.labels, analysis.periodic, analysis.sub_clusters
+        )
+        sizes = analysis.sizes[analysis.finite].astype(float)
+        if not len(sizes):
+            return 0
 
-    def encode_for_db(self, value):
-        return json.dumps(self._encode_set_keys_as_str(value))
+        weights = sizes ** 2
+        return float(
+            numpy.sqrt(2 * (radii[analysis.finite] * weights).sum() / weights.sum())
+        )
 
 
 class ClusterSizeHistogramCalculation(StatsCalculation):
@@ -178,12 +258,11 @@ class ClusterSizeHistogramCalculation(StatsCalculation):
 
     def calculate(self) -> list:
 
-        clusters = self.model.observables["clusters"]
-        number_of_nodes = self.lattice.get_number_of_nodes()
-        cluster_sizes = map(lambda cluster: len(cluster) / number_of_nodes, clusters)
-
+        cluster_sizes = (
+            self.analysis.get_cluster_sizes() / self.analysis.number_of_nodes
+        )
         hist, bin_edges = numpy.histogram(
-            list(cluster_sizes), bins=self.BIN_COUNT, range=(0, 1)
+            cluster_sizes, bins=self.BIN_COUNT, range=(0, 1)
         )
         cluster_size_histogram = hist.tolist()
         return cluster_size_histogram
@@ -192,6 +271,35 @@ class ClusterSizeHistogramCalculation(StatsCalculation):
         return json.dumps(self._encode_list_as_dict(value))
 
 
+class ClusterSizeDistributionCalculation(StatsCalculation):
+    """
+        Number of finite clusters of every integer size, stored as a
+        sparse (sizes, counts) binary, see musk.misc.histogram.
+        With a log base, sizes are grouped in logarithmic bins instead.
+        Rows add up with musk.misc.histogram.sum_size_counts.
+    """
+
+    LOG_BASE = None
+
+    def __init__(self, analysis: ClusterAnalysis, model, log_base: int = None):
+        super().__init__(analysis, model)
+        self.log_base = log_base or self.LOG_BASE
+
+    def calculate(self) -> SizeCounts:
+        cluster_sizes = self.analysis.get_finite_cluster_sizes()
+        if self.log_base:
+            return get_log_binned_size_counts(cluster_sizes, self.log_base)
+        return get_size_counts(cluster_sizes)
+
+    def encode_for_db(self, value):
+        return encode_size_counts(*value)
+
+
+class LogClusterSizeDistributionCalculation(ClusterSizeDistributionCalculation):
+
+    LOG_BASE = 2
+
+
 class MeanClusterSizeCalculation(StatsCalculation):
 
     # Warning: We're assuming that no clusters
@@ -199,44 +307,52 @@ class MeanClusterSizeCalculation(StatsCalculation):
 
     def calculate(self) -> float:
 
-        clusters = self.model.observables["clusters"]
-        clusters = filter(
-            lambda cluster: not self.has_percolated_helper.has_percolated(cluster),
-            clusters,
-        )  # Remove percolating clusters
-        cluster_sizes = list(map(lambda cluster: len(cluster), clusters))
+        # Percolating clusters are left out
+        cluster_sizes = self.analysis.get_finite_cluster_sizes()
 
         mean_size = 0
-        try:
-            mean_size = sum(cluster_sizes) / len(cluster_sizes)
-        except ZeroDivisionError:
-            pass
+        if len(cluster_sizes):
+            mean_size = float(cluster_sizes.mean())
         return mean_size
 
 
 class PercolatingClusterStrengthCalculation(StatsCalculation):
     def calculate(self) -> float:
-        clusters = self.model.observables["clusters"]
-        top_boundary, bottom_boundary = self.lattice.get_boundaries()
-        percolating_cluster_size = 0
-
-        for cluster in clusters:
-            if self.has_percolated_helper.has_percolated(cluster):
-                percolating_cluster_size += len(cluster)
-
-        return percolating_cluster_size / self.lattice.get_number_of_nodes()
+        percolating_cluster_size = int(
+            self.analysis.get_percolating_cluster_sizes().sum()
+        )
+        return percolating_cluster_size / self.analysis.number_of_nodes
 
 
 class PercolationStatsProcessor(Processor):
 
+    # Mostly waiting on MySQL and decompression, which release the GIL
+    concurrency = THREAD_CONCURRENCY
+    # One connection streams the models while BulkWriter flushes on another
+    mysql_connections = 2
+
     STATS_CLASS_MAP = {
         "has_percolated": HasPercolatedCalculation,
+        "wrapping": WrappingCalculation,
         "cluster_size_histogram": ClusterSizeHistogramCalculation,
+        "cluster_size_distribution": ClusterSizeDistributionCalculation,
+        "log_cluster_size_distribution": LogClusterSizeDistributionCalculation,
         "mean_cluster_size": MeanClusterSizeCalculation,
         "correlation_function": CorrelationFunctionCalculation,
+        "exact_correlation_function": ExactCorrelationFunctionCalculation,
         "percolating_cluster_strength": PercolatingClusterStrengthCalculation,
+        "average_correlation_length": CorrelationLengthCalculation,
     }
 
+    # Keyword arguments for the calculation of each stats, such as
+    # {"correlation_function": {"samples": 2 ** 20}}
+    stats_options: Dict[str, dict] = {}
+
+    def __init__(self, stats_options: Dict[str, dict] = None):
+        super().__init__()
+        if stats_options is not None:
+            self.stats_options = stats_options
+
     def _get_simulation_model_class(self):
         return self.simulation_model_class
 
@@ -250,13 +366,17 @@ class PercolationStatsProcessor(Processor):
         return self._get_simulation_model_class().from_db(row)
 
     def _get_stats_dict(self, message, model):
-
-        stats_to_compute = message.body["stats"]
-        size = message.body["parameters"]["size"]
-        probability = message.body["parameters"]["probability"]
-        LatticeClass = self._get_lattice_class()
-        lattice = LatticeClass(size)
-        has_percolated_helper = HasPercolatedHelper(lattice)
+        return self.get_stats_dict(model, message.body["stats"])
+
+    def get_stats_dict(self, model, stats_to_compute: List[str]) -> dict:
+        """
+            Compute stats_to_compute (keys of STATS_CLASS_MAP) for a
+            simulation model, returning the stats row to store.
+        """
+        # Every calculation reads from the same analysis of the labels
+        analysis = ClusterAnalysis.from_model(
+            model, periodic=self._get_lattice_class().is_periodic()
+        )
         result = dict(
             simulation_id=model.id, probability=model.probability, size=model.size
         )
@@ -269,7 +389,9 @@ class PercolationStatsProcessor(Processor):
 
         for stats in stats_to_compute:
             StatsClass = self.STATS_CLASS_MAP[stats]
-            stats_instance = StatsClass(lattice, model, has_percolated_helper)
+            stats_instance = StatsClass(
+                analysis, model, **self.stats_options.get(stats, {})
+            )
             stats_value = stats_instance.calculate()
             encoded_stats_value = stats_instance.encode_for_db(stats_value)
 
@@ -278,16 +400,15 @@ class PercolationStatsProcessor(Processor):
         return result
 
     def process(self, message):
-        simulation_rows = self._get_simulation_rows(message)
-        stats_dicts = []
-        for row in simulation_rows:
-            simulation_model = self._map_row_to_model(row)
-            stats_dict = self._get_stats_dict(message, simulation_model)
-            stats_dicts.append(stats_dict)
-
-        self._upsert_stats_rows(stats_dicts)
+        # Models are fetched and decoded in the background while stats
+        # are computed, and stats rows are written as they come
+        simulation_models = self._get_simulation_models(message)
+        self._upsert_stats_rows(
+            self._get_stats_dict(message, simulation_model)
+            for simulation_model in simulation_models
+        )
 
-    def _get_simulation_rows(self, message):
+    def _get_simulation_models(self, message):
 
         ids = message.body["ids"]
         size = message.body["parameters"]["size"]
@@ -295,21 +416,22 @@ class PercolationStatsProcessor(Processor):
 
         ModelClass = self._get_simulation_model_class()
         mysql = MySQL()
-        return mysql.fetch(
+        return mysql.stream(
             ModelClass.get_by_size_probability_ids(ids),
             dict(size=size, probability=probability),
+            transform=self._map_row_to_model,
         )
 
     def _upsert_stats_rows(self, stats_dicts):
-        mysql = MySQL()
-        start = datetime.now()
         StatsModelClass = self._get_stats_model_class()
-        for model_dict in stats_dicts:
-
-            key = "simulation_id"
-            key_value = model_dict[key]
-            query = StatsModelClass.get_update_query((key, key_value), model_dict)
-            mysql.execute(query, model_dict)
+        # Stats rows are upserts, so they can be written again safely
+        with BulkWriter(idempotent=True) as writer:
+            for model_dict in stats_dicts:
+
+                key = "simulation_id"
+                key_value = model_dict[key]
+                query = StatsModelClass.get_update_query((key, key_value), model_dict)
+                writer.add(query, model_dict)
 
 
 # class CorrelationFunctionCalculation(StatsCalculation):
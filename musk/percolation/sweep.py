@@ -0,0 +1,200 @@
+import concurrent.futures
+import dataclasses
+import itertools
+import logging
+import multiprocessing
+
+import numpy
+
+from typing import Dict, List, Optional, Tuple
+
+from musk.core import DetachedMessage
+from musk.core.sqlite import SQLiteStore
+from musk.percolation.base import LOCAL_FAN_OUT, PercolationProcessor
+from musk.percolation.percolation_1d import P1LProcessor, P1LStatsProcessor
+from musk.percolation.percolation_mandelbrot_2d import P2MProcessor, P2MStatsProcessor
+from musk.percolation.percolation_square_2d import (
+    P2SNewmanZiffProcessor,
+    P2SProcessor,
+    P2SStatsProcessor,
+)
+from musk.percolation.stats import PercolationStatsProcessor
+from pydantic.dataclasses import dataclass
+
+
+# Simulations a sweep can run, by the names scripts/enqueuer.py uses:
+# (simulation processor, stats processor, parameter the sweep sizes set)
+SWEEP_SIMULATIONS = {
+    "linear_1d": (P1LProcessor, P1LStatsProcessor, "size"),
+    "square_2d": (P2SProcessor, P2SStatsProcessor, "size"),
+    "square_2d_newman_ziff": (P2SNewmanZiffProcessor, None, "size"),
+    "mandelbrot_2d": (P2MProcessor, P2MStatsProcessor, "initial_size"),
+}
+
+# One (simulation row, stats row) pair per model, stats row None without stats
+SweepRows = List[Tuple[dict, Optional[dict]]]
+
+
+@dataclass
+class SweepSpec:
+    """
+        A sweep over every (probability, size) pair, running repeat
+        simulations of each. Sweeps of simulations without a
+        probability parameter (Newman-Ziff) leave probabilities empty.
+        parameters holds any other simulation parameter, such as
+        n_divisions, and stats the stats to compute for every model.
+    """
+
+    simulation: str
+    sizes: List[int]
+    repeat: int
+    probabilities: List[float] = dataclasses.field(default_factory=list)
+    seed: Optional[int] = None
+    stats: List[str] = dataclasses.field(default_factory=list)
+    parameters: Dict[str, int] = dataclasses.field(default_factory=dict)
+    chunk_size: int = PercolationProcessor.fan_out_chunk_size
+
+    def __post_init__(self):
+        if self.simulation not in SWEEP_SIMULATIONS:
+            raise ValueError(
+                f"Unknown simulation {self.simulation}, "
+                f"expected one of {', '.join(SWEEP_SIMULATIONS)}"
+            )
+
+    def get_processors(
+        self,
+    ) -> Tuple[PercolationProcessor, Optional[PercolationStatsProcessor]]:
+        ProcessorClass, StatsProcessorClass, _ = SWEEP_SIMULATIONS[self.simulation]
+        processor = ProcessorClass(
+            fan_out=LOCAL_FAN_OUT, fan_out_chunk_size=self.chunk_size
+        )
+        stats_processor = StatsProcessorClass() if StatsProcessorClass else None
+        return processor, stats_processor
+
+    def get_messages(self) -> List[DetachedMessage]:
+        """
+            One simulation message per sweep point, as scripts/enqueuer.py
+            would send it. Each point gets its own seed, spawned from
+            the sweep seed.
+        """
+        _, _, size_parameter = SWEEP_SIMULATIONS[self.simulation]
+        probabilities = self.probabilities or [None]
+        points = list(itertools.product(probabilities, self.sizes))
+        seed_sequences = numpy.random.SeedSequence(self.seed).spawn(len(points))
+
+        messages = []
+        for index, ((probability, size), seed_sequence) in enumerate(
+            zip(points, seed_sequences)
+        ):
+            parameters = dict(self.parameters, **{size_parameter: size})
+            if probability is not None:
+                parameters["probability"] = probability
+            body = dict(
+                parameters=parameters,
+                repeat=self.repeat,
+                seed=int(seed_sequence.generate_state(1, numpy.uint64)[0]),
+            )
+            messages.append(DetachedMessage(f"sweep:{index}", body))
+        return messages
+
+    def get_chunks(self) -> List[DetachedMessage]:
+        """
+            The sweep messages, split in chunks of at most chunk_size
+            simulations exactly as PercolationProcessor fans them out.
+        """
+        processor, _ = self.get_processors()
+        chunks = []
+        for message in self.get_messages():
+            if processor._should_fan_out(message):
+                chunks.extend(processor._get_chunk_messages(message))
+            else:
+                chunks.append(message)
+        return chunks
+
+
+def get_probability_range(p_min: float, p_max: float, steps: int) -> List[float]:
+    """
+        Evenly spaced probabilities, rounded as the stats queries round them.
+    """
+    return [round(float(p), 6) for p in numpy.linspace(p_min, p_max, steps)]
+
+
+def run_sweep_chunk(spec: SweepSpec, message: DetachedMessage) -> SweepRows:
+    """
+        Run the simulations of a chunk and compute their stats.
+        Module level, so it can run in a worker process.
+    """
+    processor, stats_processor = spec.get_processors()
+    rows = []
+    for simulation in processor.run_simulations(message):
+        for model in simulation.get_models():
+            stats_row = None
+            if stats_processor is not None and spec.stats:
+                stats_row = stats_processor.get_stats_dict(model, spec.stats)
+            rows.append((model.to_db(), stats_row))
+    return rows
+
+
+class SweepRunner:
+    """
+        Runs a sweep on a local process pool, storing simulation and
+        stats rows in an SQLiteStore, in the tables the MySQL pipeline
+        would use. With a single worker, chunks run in this process.
+    """
+
+    MP_CONTEXT = "spawn"
+
+    def __init__(self, spec: SweepSpec, store: SQLiteStore, workers: int = 1):
+        self._spec = spec
+        self._store = store
+        self._workers = workers
+        self._logger = logging.getLogger(__name__)
+
+    def _store_rows(self, rows: SweepRows):
+        processor, stats_processor = self._spec.get_processors()
+        simulation_table = processor._get_simulation_class().model_class._tablename
+        simulation_ids = self._store.insert_many(
+            simulation_table, [simulation_row for simulation_row, _ in rows]
+        )
+
+        stats_rows = []
+        for simulation_id, (_, stats_row) in zip(simulation_ids, rows):
+            if stats_row is not None:
+                stats_rows.append(dict(stats_row, simulation_id=simulation_id))
+        if stats_rows:
+            stats_table = stats_processor._get_stats_model_class()._tablename
+            self._store.insert_many(stats_table, stats_rows)
+
+    def run(self) -> int:
+        """
+            Run every chunk of the sweep, returning
+            the number of simulation rows stored.
+        """
+        chunks = self._spec.get_chunks()
+        self._logger.info(
+            f"Running {len(chunks)} chunks of {self._spec.simulation} "
+            f"on {self._workers} workers"
+        )
+
+        if self._workers <= 1:
+            results = (run_sweep_chunk(self._spec, chunk) for chunk in chunks)
+            return self._store_results(results, len(chunks))
+
+        with concurrent.futures.ProcessPoolExecutor(
+            self._workers, mp_context=multiprocessing.get_context(self.MP_CONTEXT)
+        ) as executor:
+            futures = [
+                executor.submit(run_sweep_chunk, self._spec, chunk) for chunk in chunks
+            ]
+            results = (
+                future.result() for future in concurrent.futures.as_completed(futures)
+            )
+            return self._store_results(results, len(chunks))
+
+    def _store_results(self, results, number_of_chunks: int) -> int:
+        number_of_rows = 0
+        for done, rows in enumerate(results, start=1):
+            self._store_rows(rows)
+            number_of_rows += len(rows)
+            self._logger.info(f"Finished chunk {done}/{number_of_chunks}")
+        return number_of_rows
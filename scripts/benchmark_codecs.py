@@ -0,0 +1,69 @@
+"""
+    Compare the observables compression codecs on real simulation
+    output: compression ratio and compress / decompress throughput
+    for P2SSimulation observables at several lattice sizes.
+
+    Usage: python scripts/benchmark_codecs.py [--sizes 64 256 1024]
+"""
+import argparse
+import time
+
+from musk.misc.compression import CODECS
+from musk.misc.observables import ObservablesFormat
+from musk.percolation import P2SSimulation
+
+
+PROBABILITIES = [0.3, 0.5927, 0.8]
+
+
+def get_observables_bytes(size, probability, seed):
+    simulation = P2SSimulation(probability=probability, size=size, seed=seed)
+    simulation.execute()
+    return ObservablesFormat.encode(simulation.model.observables)
+
+
+def time_call(function, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = function(data)
+    return (time.perf_counter() - start) / rounds, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    print(
+        f"{'size':>6} {'codec':>8} {'raw KB':>9} {'ratio':>7} "
+        f"{'comp MB/s':>10} {'decomp MB/s':>12}"
+    )
+    for size in arguments.sizes:
+        samples = [
+            get_observables_bytes(size, probability, arguments.seed)
+            for probability in PROBABILITIES
+        ]
+        raw_bytes = sum(map(len, samples))
+
+        for name, codec in CODECS.items():
+            compressed_bytes, compress_took, decompress_took = 0, 0.0, 0.0
+            for data in samples:
+                took, compressed = time_call(codec.compress, data, arguments.rounds)
+                compress_took += took
+                compressed_bytes += len(compressed)
+                took, _ = time_call(codec.decompress, compressed, arguments.rounds)
+                decompress_took += took
+
+            megabytes = raw_bytes / 1e6
+            print(
+                f"{size:>6} {name:>8} {raw_bytes / 1024:>9.1f} "
+                f"{raw_bytes / compressed_bytes:>7.2f} "
+                f"{megabytes / compress_took:>10.1f} "
+                f"{megabytes / decompress_took:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
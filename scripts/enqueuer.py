@@ -7,6 +7,8 @@ from musk.percolation import (
     P1LQueue,
     P1LStatsQueue,
     P2SModel,
+    P2SNewmanZiffModel,
+    P2SNewmanZiffQueue,
     P2SQueue,
     P2SStatsQueue,
     P2MModel,
@@ -30,6 +32,12 @@ elif model == "square_2d":
         P2SStatsQueue(env),
         P2SModel,
     )
+elif model == "square_2d_newman_ziff":
+    simulation_queue, stats_queue, simulation_model = (
+        P2SNewmanZiffQueue(env),
+        None,
+        P2SNewmanZiffModel,
+    )
 elif model == "mandelbrot_2d":
 
     simulation_queue, stats_queue, simulation_model = (
@@ -115,11 +123,23 @@ type_ = "stats"
 print(f"Environment: {env.upper()}")
 print(f"Type: {type_.upper()}")
 print(f"Model: {model.upper()}")
+if type_ == "stats" and stats_queue is None:
+    # Newman-Ziff sweeps store their observables directly, with no stats step
+    raise ValueError(f"Model {model} has no stats queue, only simulations")
 if env == "prod":
     time.sleep(2)
 
 
-if type_ == "simulation" and model is not "mandelbrot_2d":
+if type_ == "simulation" and model == "square_2d_newman_ziff":
+    # Each message covers the whole probability range for one size
+    sizes = [64, 128, 192, 256]
+    repeat = 128
+    for size in sizes:
+        template = dict(parameters=dict(size=size), repeat=repeat)
+        simulation_queue.write([template] * 10)
+        print(template)
+
+elif type_ == "simulation" and model is not "mandelbrot_2d":
     p_range = extension_p_2d_range + general_p_2d_range + detailed_p_2d_range
     # p_range = detailed_p_2d_range
     p_range = [p / 1000 for p in range(565, 595)]
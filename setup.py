@@ -12,9 +12,10 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/alansammarone/musk",
-    packages=["musk"],
+    packages=setuptools.find_packages(exclude=["tests", "tests.*"]),
     classifiers=["Programming Language :: Python :: 3"],
     python_requires=">=3.6",
+    entry_points={"console_scripts": ["musk=musk.cli:main"]},
     install_requires=[
         "Pillow",
         "matplotlib",
@@ -0,0 +1,38 @@
+import unittest
+
+import numpy
+
+from musk.misc.histogram import (
+    decode_size_counts,
+    encode_size_counts,
+    get_log_binned_size_counts,
+    get_size_counts,
+    sum_size_counts,
+)
+
+
+class TestSizeCounts(unittest.TestCase):
+    def test_size_counts(self):
+        sizes, counts = get_size_counts(numpy.array([3, 1, 1, 7, 3, 1]))
+        self.assertEqual([1, 3, 7], sizes.tolist())
+        self.assertEqual([3, 2, 1], counts.tolist())
+
+    def test_log_binned_size_counts(self):
+        sizes, counts = get_log_binned_size_counts(
+            numpy.array([1, 2, 3, 4, 7, 8, 9, 27, 81]), base=3
+        )
+        self.assertEqual([1, 3, 9, 27, 81], sizes.tolist())
+        self.assertEqual([2, 4, 1, 1, 1], counts.tolist())
+
+    def test_encoded_size_counts_add_up(self):
+        first = encode_size_counts(*get_size_counts(numpy.array([1, 1, 5])))
+        second = encode_size_counts(*get_size_counts(numpy.array([1, 300, 5])))
+
+        sizes, counts = decode_size_counts(first)
+        self.assertEqual(numpy.uint8, sizes.dtype)
+        self.assertEqual([1, 5], sizes.tolist())
+
+        sizes, counts = sum_size_counts([first, second])
+        self.assertEqual([1, 5, 300], sizes.tolist())
+        self.assertEqual([3, 2, 1], counts.tolist())
+        self.assertEqual(0, len(sum_size_counts([])[0]))
@@ -0,0 +1,133 @@
+import random
+import unittest
+
+import numpy
+
+from musk.lattices import (
+    Linear1DLattice,
+    Square2DFiniteLattice,
+    Square2DPeriodicLattice,
+)
+from musk.lattices.labeling import (
+    LABELING_BACKENDS,
+    HoshenKopelmanLabeler,
+    ScipyLabeler,
+    UnionFind,
+)
+
+
+def get_reference_clusters(lattice, state):
+    # Plain depth-first search over get_neighbour_nodes
+    clusters, visited = set(), set()
+    for node in lattice.get_nodes_with_state(state):
+        if node in visited:
+            continue
+        cluster, stack = set(), [node]
+        while stack:
+            current = stack.pop()
+            if current in cluster:
+                continue
+            cluster.add(current)
+            for neighbour in lattice.get_neighbour_nodes(*current):
+                if lattice.get_state_at_node(*neighbour) == state:
+                    stack.append(neighbour)
+        visited |= cluster
+        clusters.add(frozenset(cluster))
+    return frozenset(clusters)
+
+
+class TestUnionFind(unittest.TestCase):
+    def test_union_merges_sets_and_tracks_sizes(self):
+        union_find = UnionFind(4)
+        union_find.union(0, 1)
+        union_find.union(2, 3)
+        self.assertNotEqual(union_find.find(1), union_find.find(2))
+
+        union_find.union(1, 3)
+        self.assertEqual(union_find.find(0), union_find.find(2))
+        self.assertEqual(4, union_find.get_size(3))
+
+        element = union_find.add()
+        self.assertEqual(4, element)
+        self.assertEqual(1, union_find.get_size(element))
+
+
+class TestHoshenKopelmanLabeler(unittest.TestCase):
+
+    LATTICE_CLASSES = [Linear1DLattice, Square2DFiniteLattice, Square2DPeriodicLattice]
+
+    def test_labels_match_reference_clusters(self):
+        random.seed(0)
+        for LatticeClass in self.LATTICE_CLASSES:
+            for probability in [0.3, 0.6, 0.9]:
+                lattice = LatticeClass(16)
+                lattice.fill_randomly([0, 1], [1 - probability, probability])
+                expected = get_reference_clusters(lattice, 1)
+                for backend in LABELING_BACKENDS:
+                    lattice._labeler = LABELING_BACKENDS[backend]()
+                    actual = lattice.get_clusters_with_state(1)
+                    self.assertEqual(expected, actual, backend)
+
+    def test_labels_are_consecutive_and_sizes_match(self):
+        occupied = numpy.array(
+            [[1, 0, 1, 1], [1, 0, 0, 0], [0, 1, 1, 0], [1, 0, 1, 1]], dtype=bool
+        )
+        labels, sizes = HoshenKopelmanLabeler().label(occupied)
+
+        self.assertEqual(0, sizes[0])
+        self.assertEqual(set(range(1, len(sizes))), set(labels[occupied].tolist()))
+        self.assertEqual(
+            numpy.bincount(labels.ravel())[1:].tolist(), sizes[1:].tolist()
+        )
+        self.assertTrue((labels[~occupied] == 0).all())
+
+    def test_periodic_labeling_merges_opposite_edges(self):
+        occupied = numpy.array(
+            [[1, 0, 0, 1], [0, 0, 0, 0], [0, 0, 0, 0], [1, 0, 0, 0]], dtype=bool
+        )
+        for Labeler in [HoshenKopelmanLabeler, ScipyLabeler]:
+            labels, sizes = Labeler().label(occupied, periodic=True)
+            self.assertEqual([0, 3], sizes.tolist())
+
+            labels, sizes = Labeler().label(occupied, periodic=False)
+            self.assertEqual([0, 1, 1, 1], sizes.tolist())
+
+    def test_lattice_uses_selected_backend(self):
+        lattice = Square2DPeriodicLattice(4, labeling_backend="scipy")
+        self.assertIsInstance(lattice._labeler, ScipyLabeler)
+
+        with self.assertRaises(ValueError):
+            Square2DPeriodicLattice(4, labeling_backend="unknown")
+
+
+class TestIncrementalLabeler(unittest.TestCase):
+    def test_labels_across_divisions_match_full_labeling(self):
+        for seed in range(5):
+            incremental = Square2DPeriodicLattice(2, incremental_labeling=True)
+            incremental.fill_randomly([0, 1], [0.5, 0.5], seed=seed)
+            random_generator = numpy.random.default_rng(seed)
+
+            for _ in range(5):
+                incremental.divide()
+                incremental.change_state_with_probability(
+                    0, 1, 0.3, seed=random_generator
+                )
+                full = Square2DPeriodicLattice(incremental.get_size())
+                full.as_array()[:] = incremental.as_array()
+
+                self.assertEqual(
+                    full.get_clusters_with_state(1),
+                    incremental.get_clusters_with_state(1),
+                )
+
+    def test_other_changes_fall_back_to_full_labeling(self):
+        lattice = Square2DFiniteLattice(4, incremental_labeling=True)
+        lattice.set_state_from_matrix(
+            [[1, 1, 0, 0], [0, 0, 0, 0], [0, 0, 1, 1], [0, 0, 0, 0]]
+        )
+        lattice.get_cluster_labels(1)
+
+        # Removing an occupied node invalidates the previous labels
+        lattice.set_state_at_node(0, 0, 1)
+        _, sizes = lattice.get_cluster_labels(1)
+        self.assertEqual([0, 1, 2], sorted(sizes.tolist()))
@@ -1,9 +1,15 @@
 import unittest
+
+import numpy
+
+from musk.exceptions import InvalidStateException
+from musk.lattices.base import NEIGHBOUR_TABLE_CACHE_SIZE, _get_cached_neighbour_table
 from musk.lattices import (
     Linear1DLattice,
     Square2DFiniteLattice,
     Square2DPeriodicLattice,
 )
+from musk.percolation import P2MSimulation
 
 
 class TestLinear1DLattice(unittest.TestCase):
@@ -294,3 +300,144 @@ class TestSquare2DPeriodicLattice(unittest.TestCase):
         # for node in [(0, 1), (0, 2), (1, 0), (1, 1), (2, 1)]:
         #     actual_cluster = lattice.get_cluster(node)
         #     self.assertEqual(expected_cluster, actual_cluster)
+
+    def test_clusters_wrap_around_edges(self):
+
+        matrix_lattice_state = [
+            [1, 0, 0],
+            [0, 0, 1],
+            [1, 0, 1],
+        ]
+        lattice_size = 3
+        lattice = Square2DPeriodicLattice(lattice_size)
+        lattice.set_state_from_matrix(matrix_lattice_state)
+
+        expected_clusters = {frozenset({(0, 0), (1, 2), (2, 0), (2, 2)})}
+        actual_clusters = lattice.get_clusters_with_state(1)
+        self.assertEqual(expected_clusters, actual_clusters)
+
+        expected_cluster = {(0, 1), (0, 2), (1, 0), (1, 1), (2, 1)}
+        actual_cluster = lattice.get_cluster((1, 1))
+        self.assertEqual(expected_cluster, actual_cluster)
+
+
+class TestLatticeArrayStorage(unittest.TestCase):
+    def test_as_array_reflects_node_states(self):
+        lattice_size = 3
+        lattice = Square2DFiniteLattice(lattice_size)
+        matrix_lattice_state = [
+            [1, 0, 0],
+            [0, 0, 1],
+            [1, 0, 1],
+        ]
+        lattice.set_state_from_matrix(matrix_lattice_state)
+
+        array = lattice.as_array()
+        self.assertEqual((3, 3), array.shape)
+        self.assertEqual(matrix_lattice_state, array.tolist())
+
+        lattice.set_state_at_node(1, 0, 1)
+        self.assertEqual(1, array[0, 1])
+
+    def test_uninitialized_node_raises(self):
+        lattice = Linear1DLattice(3)
+        with self.assertRaises(InvalidStateException):
+            lattice.get_state_at_node(0)
+
+        lattice.set_state_from_list([0, 1, 0])
+        with self.assertRaises(InvalidStateException):
+            lattice.get_state_at_node(3)
+
+
+class TestNeighbourTable(unittest.TestCase):
+    def test_neighbour_table_matches_neighbour_nodes(self):
+        for LatticeClass in [
+            Linear1DLattice,
+            Square2DFiniteLattice,
+            Square2DPeriodicLattice,
+        ]:
+            lattice = LatticeClass(4)
+            shape = lattice.as_array().shape
+            table = lattice.get_neighbour_table()
+            for node in numpy.ndindex(*shape):
+                row = table[numpy.ravel_multi_index(node, shape)]
+                actual = {
+                    tuple(map(int, numpy.unravel_index(index, shape)))
+                    for index in row
+                    if index >= 0
+                }
+                self.assertEqual(lattice.get_neighbour_nodes(*node), actual)
+
+    def test_is_periodic(self):
+        self.assertTrue(Square2DPeriodicLattice.is_periodic())
+        self.assertTrue(Square2DPeriodicLattice(3).is_periodic())
+        self.assertFalse(Square2DFiniteLattice(3).is_periodic())
+
+    def test_neighbour_table_is_shared_per_class_and_size(self):
+        table = Square2DPeriodicLattice(5).get_neighbour_table()
+        self.assertIs(table, Square2DPeriodicLattice(5).get_neighbour_table())
+        self.assertIsNot(table, Square2DFiniteLattice(5).get_neighbour_table())
+        self.assertFalse(table.flags.writeable)
+
+    def test_neighbour_tables_are_built_only_when_used(self):
+        _get_cached_neighbour_table.cache_clear()
+        lattice = Square2DPeriodicLattice(6, labeling_backend="scipy")
+        lattice.fill_randomly([0, 1], seed=1)
+        lattice.get_cluster_labels(1)
+        self.assertEqual(0, _get_cached_neighbour_table.cache_info().currsize)
+
+        lattice = Square2DPeriodicLattice(6, labeling_backend="python")
+        lattice.fill_randomly([0, 1], seed=1)
+        lattice.get_cluster_labels(1)
+        self.assertEqual(1, _get_cached_neighbour_table.cache_info().currsize)
+
+    def test_neighbour_table_cache_is_bounded(self):
+        for size in range(2, 4 + NEIGHBOUR_TABLE_CACHE_SIZE):
+            Square2DPeriodicLattice(size).get_neighbour_table()
+        self.assertEqual(
+            NEIGHBOUR_TABLE_CACHE_SIZE,
+            _get_cached_neighbour_table.cache_info().currsize,
+        )
+
+    def test_mandelbrot_simulations_share_every_division_table(self):
+        _get_cached_neighbour_table.cache_clear()
+        for _ in range(2):
+            P2MSimulation(0.6, 4, 7, seed=1).run()
+        info = _get_cached_neighbour_table.cache_info()
+        # One table per division level, all reused by the second run
+        self.assertEqual(8, info.misses)
+        self.assertEqual(info.misses, info.hits)
+
+
+class TestFillRandomly(unittest.TestCase):
+    def test_same_seed_produces_same_state(self):
+        first, second = Square2DPeriodicLattice(16), Square2DPeriodicLattice(16)
+        first.fill_randomly([0, 1], [0.4, 0.6], seed=42)
+        second.fill_randomly([0, 1], [0.4, 0.6], seed=42)
+        self.assertTrue((first.as_array() == second.as_array()).all())
+
+        second.fill_randomly([0, 1], [0.4, 0.6], seed=43)
+        self.assertFalse((first.as_array() == second.as_array()).all())
+
+    def test_states_follow_weights(self):
+        lattice = Square2DPeriodicLattice(128)
+        lattice.fill_randomly([0, 1], [0.25, 0.75], seed=0)
+        self.assertAlmostEqual(0.75, lattice.as_array().mean(), places=2)
+
+        lattice.fill_randomly([0, 1], [1, 0], seed=0)
+        self.assertEqual(0, lattice.as_array().sum())
+
+    def test_change_state_with_probability_only_changes_old_state(self):
+        lattice = Square2DPeriodicLattice(64)
+        lattice.fill_randomly([0, 1], [0.5, 0.5], seed=1)
+        before = lattice.as_array().copy()
+
+        lattice.change_state_with_probability(0, 1, 0.5, seed=2)
+        after = lattice.as_array()
+
+        self.assertTrue((after[before == 1] == 1).all())
+        changed_fraction = after[before == 0].mean()
+        self.assertAlmostEqual(0.5, changed_fraction, delta=0.05)
+
+        lattice.change_state_with_probability(0, 1, 1)
+        self.assertTrue((lattice.as_array() == 1).all())
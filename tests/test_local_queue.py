@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from musk.core import Dequeuer, MultiprocessingQueue, Processor, SQLiteQueue
+from musk.core.processor import PROCESS_CONCURRENCY
+
+
+def write_from_child(queue, messages):
+    queue.write(messages)
+
+
+class RecordingProcessor(Processor):
+    def __init__(self):
+        super().__init__()
+        self.bodies = []
+
+    def process(self, message):
+        self.bodies.append(message.body)
+
+
+class CrashingProcessor(Processor):
+    """
+        Kills its worker process on the first message naming a
+        marker file that does not exist yet.
+    """
+
+    concurrency = PROCESS_CONCURRENCY
+
+    def process(self, message):
+        marker = message.body.get("crash")
+        if marker and not os.path.exists(marker):
+            open(marker, "w").close()
+            os._exit(1)
+
+
+class DequeuerConfig:
+    MESSAGES_PER_READ = 10
+    VISIBILITY_HEARTBEAT = True
+    CONCURRENCY_WORKERS = 1
+
+
+class ProcessDequeuerConfig(DequeuerConfig):
+    CONCURRENCY_WORKERS = 2
+
+
+class LocalQueueTests:
+    """
+        Semantics shared by every LocalQueue, run for each of them.
+    """
+
+    def get_queue(self, **kwargs):
+        raise NotImplementedError
+
+    def test_read_hides_messages_until_deleted_or_requeued(self):
+        queue = self.get_queue()
+        queue.write([dict(index=index) for index in range(3)])
+
+        first = list(queue.read(2))
+        self.assertEqual([0, 1], [message.body["index"] for message in first])
+        (second,) = list(queue.read(2))
+        self.assertEqual(2, second.body["index"])
+        self.assertEqual([], list(queue.read(2)))
+
+        first[0].delete()
+        first[1].requeue()
+        (again,) = list(queue.read(2))
+        self.assertEqual(first[1].id, again.id)
+        self.assertEqual(2, queue.count())
+
+    def test_messages_reappear_after_the_visibility_timeout(self):
+        queue = self.get_queue(visibility_timeout=0.2)
+        queue.write([dict(index=0)])
+
+        (message,) = list(queue.read())
+        self.assertEqual([], list(queue.read()))
+        time.sleep(0.3)
+        (again,) = list(queue.read())
+
+        # The first read lost the message, its receipt no longer works
+        message.delete()
+        self.assertEqual(1, queue.count())
+        again.delete()
+        self.assertEqual(0, queue.count())
+
+    def test_change_visibility_extends_the_timeout(self):
+        queue = self.get_queue(visibility_timeout=0.2)
+        queue.write([dict(index=0)])
+
+        (message,) = list(queue.read())
+        message.change_visibility(10)
+        time.sleep(0.3)
+        self.assertEqual([], list(queue.read()))
+
+    def test_read_waits_for_messages(self):
+        queue = self.get_queue(wait_time_seconds=0.2)
+        start = time.monotonic()
+        self.assertEqual([], list(queue.read()))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_dequeuer_processes_local_messages(self):
+        queue = self.get_queue()
+        queue.write([dict(index=index) for index in range(5)])
+        processor = RecordingProcessor()
+
+        self.assertEqual(5, Dequeuer(queue, processor, DequeuerConfig).dequeue())
+        self.assertEqual(list(range(5)), [body["index"] for body in processor.bodies])
+        self.assertEqual(0, queue.count())
+
+    def test_other_processes_share_the_queue(self):
+        queue = self.get_queue()
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=write_from_child, args=(queue, [dict(index=7)])
+        )
+        process.start()
+        process.join()
+
+        (message,) = list(queue.read())
+        self.assertEqual(dict(index=7), message.body)
+
+
+class TestMultiprocessingQueue(LocalQueueTests, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.queue = MultiprocessingQueue("test")
+        cls.manager = cls.queue._manager
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.manager.shutdown()
+
+    def get_queue(self, **kwargs):
+        return MultiprocessingQueue("test", manager=self.manager, **kwargs)
+
+
+class TestSQLiteQueue(LocalQueueTests, unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "queue.sqlite")
+
+    def get_queue(self, **kwargs):
+        return SQLiteQueue("test", self.path, **kwargs)
+
+    def test_queues_sharing_a_file_are_separate(self):
+        self.get_queue().write([dict(index=0)])
+        other = SQLiteQueue("other", self.path)
+        self.assertEqual([], list(other.read()))
+        self.assertEqual(1, self.get_queue().count())
+
+    def test_dequeuer_recovers_from_a_dead_worker(self):
+        queue = self.get_queue()
+        marker = os.path.join(os.path.dirname(self.path), "crashed")
+        queue.write([dict(crash=marker)] + [dict(index=index) for index in range(3)])
+        dequeuer = Dequeuer(queue, CrashingProcessor(), ProcessDequeuerConfig)
+        self.addCleanup(dequeuer.close)
+
+        self.assertEqual(4, dequeuer.dequeue())
+        self.assertTrue(os.path.exists(marker))
+        # Messages lost with the pool are requeued, and a new pool runs them
+        self.assertLess(0, queue.count())
+        self.assertLess(0, dequeuer.dequeue())
+        self.assertEqual(0, queue.count())
@@ -0,0 +1,87 @@
+import unittest
+
+import numpy
+
+from musk.lattices import Square2DFiniteLattice, Square2DPeriodicLattice
+from musk.percolation.base import NewmanZiffModel, NewmanZiffSimulation
+
+
+class FiniteNewmanZiffSimulation(NewmanZiffSimulation):
+    model_class = NewmanZiffModel
+    lattice_class = Square2DFiniteLattice
+
+
+class PeriodicNewmanZiffSimulation(NewmanZiffSimulation):
+    model_class = NewmanZiffModel
+    lattice_class = Square2DPeriodicLattice
+
+
+class TestNewmanZiffSimulation(unittest.TestCase):
+    def _run(self, SimulationClass, size, seed):
+        simulation = SimulationClass(size, seed=seed)
+        simulation.execute()
+
+        # Replay the same occupation order
+        order = numpy.random.default_rng(seed).permutation(size * size).tolist()
+        return simulation.model, order
+
+    def test_observables_match_direct_labeling(self):
+        size = 8
+        model, order = self._run(FiniteNewmanZiffSimulation, size, seed=3)
+        observables = model.observables
+        lattice = Square2DFiniteLattice(size)
+        lattice.as_array()[:] = 0
+        top_boundary, bottom_boundary = (
+            numpy.zeros((size, size), dtype=bool),
+            numpy.zeros((size, size), dtype=bool),
+        )
+        top_boundary[0, :], bottom_boundary[-1, :] = True, True
+
+        for occupation_number, node in enumerate(order, start=1):
+            lattice.as_array().flat[node] = 1
+            labels, sizes = lattice.get_cluster_labels(1)
+
+            spanning = set(labels[top_boundary].tolist()) & set(
+                labels[bottom_boundary].tolist()
+            )
+            spanning.discard(0)
+            finite_sizes = [
+                cluster_size
+                for label, cluster_size in enumerate(sizes)
+                if label and label not in spanning
+            ]
+            mean_cluster_size = (
+                sum(finite_sizes) / len(finite_sizes) if finite_sizes else 0
+            )
+
+            self.assertEqual(
+                sizes.max(), observables["largest_cluster_size"][occupation_number]
+            )
+            self.assertEqual(
+                int(bool(spanning)), observables["has_percolated"][occupation_number]
+            )
+            self.assertAlmostEqual(
+                mean_cluster_size, observables["mean_cluster_size"][occupation_number]
+            )
+
+    def test_periodic_lattice_percolates_by_wrapping(self):
+        size = 8
+        model, order = self._run(PeriodicNewmanZiffSimulation, size, seed=5)
+        observables = model.observables
+        has_percolated = observables["has_percolated"].tolist()
+
+        self.assertEqual(size * size + 1, len(has_percolated))
+        self.assertEqual(0, has_percolated[0])
+        self.assertEqual(1, has_percolated[-1])
+        # Once a cluster wraps, it keeps wrapping
+        first_percolated = has_percolated.index(1)
+        self.assertTrue(all(has_percolated[first_percolated:]))
+        # Wrapping needs at least size nodes
+        self.assertGreaterEqual(first_percolated, size)
+        self.assertEqual(1, observables["percolating_cluster_strength"][-1])
+
+    def test_observables_at_probabilities_interpolate_between_limits(self):
+        size = 8
+        model, _ = self._run(PeriodicNewmanZiffSimulation, size, seed=7)
+        values = model.get_observable_at_probabilities("has_percolated", [0, 1])
+        self.assertEqual([0, 1], values.round(6).tolist())
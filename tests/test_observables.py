@@ -0,0 +1,129 @@
+import bz2
+import json
+import unittest
+from datetime import datetime
+
+import numpy
+
+from musk.misc.compression import CODECS, CompressedBlob
+from musk.misc.json import PythonObjectEncoder
+from musk.misc.observables import (
+    ObservablesFormat,
+    get_clusters_from_labels,
+    get_labels_from_clusters,
+)
+from musk.percolation import P2SModel, P2SSimulation
+
+
+class TestObservablesFormat(unittest.TestCase):
+    def test_arrays_and_json_values_round_trip(self):
+        observables = dict(
+            labels=numpy.array([[1, 0, 2], [1, 0, 2]], dtype=numpy.uint16),
+            mean_cluster_size=numpy.linspace(0, 1, 5),
+            parameters={"probability": 0.5},
+        )
+        encoded = ObservablesFormat.encode(observables)
+        self.assertTrue(ObservablesFormat.is_binary(encoded))
+
+        decoded = ObservablesFormat.decode(encoded)
+        self.assertEqual(set(observables), set(decoded))
+        self.assertEqual(numpy.uint16, decoded["labels"].dtype)
+        self.assertEqual(observables["labels"].tolist(), decoded["labels"].tolist())
+        self.assertEqual(
+            observables["mean_cluster_size"].tolist(),
+            decoded["mean_cluster_size"].tolist(),
+        )
+        self.assertEqual(observables["parameters"], decoded["parameters"])
+
+    def test_legacy_clusters_decode_to_labels(self):
+        clusters = frozenset(
+            {frozenset({(0, 0), (1, 0)}), frozenset({(2, 2)}), frozenset({(0, 2)})}
+        )
+        legacy = json.dumps(dict(clusters=clusters), cls=PythonObjectEncoder)
+
+        decoded = ObservablesFormat.decode(legacy.encode("utf-8"), shape=(3, 3))
+        self.assertEqual((3, 3), decoded["labels"].shape)
+        self.assertEqual(clusters, get_clusters_from_labels(decoded["labels"]))
+
+    def test_labels_and_clusters_convert_both_ways(self):
+        labels = numpy.array([[1, 1, 0], [0, 0, 2], [3, 0, 2]])
+        clusters = get_clusters_from_labels(labels)
+        self.assertEqual(
+            frozenset(
+                {
+                    frozenset({(0, 0), (0, 1)}),
+                    frozenset({(1, 2), (2, 2)}),
+                    frozenset({(2, 0)}),
+                }
+            ),
+            clusters,
+        )
+        self.assertEqual(
+            clusters,
+            get_clusters_from_labels(get_labels_from_clusters(clusters, (3, 3))),
+        )
+
+
+class TestCompressedBlob(unittest.TestCase):
+    def test_every_codec_round_trips(self):
+        data = ObservablesFormat.encode(dict(labels=numpy.arange(64) % 5))
+        for name in CODECS:
+            blob = CompressedBlob.compress(data, name)
+            self.assertEqual(name, CompressedBlob.get_codec_name(blob))
+            self.assertEqual(data, CompressedBlob.decompress(blob))
+
+    def test_legacy_bz2_blobs_decompress(self):
+        blob = bz2.compress(b"legacy")
+        self.assertEqual("bz2", CompressedBlob.get_codec_name(blob))
+        self.assertEqual(b"legacy", CompressedBlob.decompress(blob))
+
+    def test_unknown_codec_raises(self):
+        with self.assertRaises(ValueError):
+            CompressedBlob.compress(b"", "snappy")
+
+
+class TestPercolationModelObservables(unittest.TestCase):
+    def test_model_round_trips_through_db_format(self):
+        simulation = P2SSimulation(probability=0.6, size=16, seed=3)
+        simulation.execute()
+        model = simulation.model
+
+        row = model.to_db()
+        row["observables"] = bytes(row["observables"])
+        decoded = P2SModel.from_db(row)
+        self.assertEqual(
+            model.observables["labels"].tolist(), decoded.observables["labels"].tolist()
+        )
+
+    def test_rows_with_different_codecs_decode(self):
+        simulation = P2SSimulation(probability=0.6, size=16, seed=3)
+        simulation.execute()
+        model = simulation.model
+
+        class LzmaP2SModel(P2SModel):
+            observables_codec = "lzma"
+
+        for model_class in (P2SModel, LzmaP2SModel):
+            row = model_class.to_db(model)
+            row["observables"] = bytes(row["observables"])
+            decoded = P2SModel.from_db(row)
+            self.assertEqual(
+                model.observables["labels"].tolist(),
+                decoded.observables["labels"].tolist(),
+            )
+
+    def test_legacy_rows_still_decode(self):
+        clusters = frozenset({frozenset({(0, 0), (0, 1)}), frozenset({(3, 3)})})
+        legacy = json.dumps(dict(clusters=clusters), cls=PythonObjectEncoder)
+        row = dict(
+            id=1,
+            probability=0.5,
+            size=4,
+            took=0.1,
+            created=datetime.now(),
+            observables=bz2.compress(legacy.encode("utf-8")),
+        )
+        model = P2SModel.from_db(row)
+        self.assertEqual(
+            clusters, get_clusters_from_labels(model.observables["labels"])
+        )
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy
+
+from musk.percolation import P2SProcessor, P2SSimulation
+
+
+class FakeMessage:
+    def __init__(self, body):
+        self.id = "fake"
+        self.body = body
+
+
+class TestPercolationProcessor(unittest.TestCase):
+    def test_seed_sequences_are_reproducible_and_independent(self):
+        processor = P2SProcessor()
+        message = FakeMessage(
+            dict(parameters=dict(probability=0.5, size=8), repeat=3, seed=1234)
+        )
+
+        first = processor._get_seed_sequences(message)
+        second = processor._get_seed_sequences(message)
+        self.assertEqual(3, len(first))
+
+        states = []
+        for seed_sequence, same_seed_sequence in zip(first, second):
+            first_state = numpy.random.default_rng(seed_sequence).random(4)
+            second_state = numpy.random.default_rng(same_seed_sequence).random(4)
+            self.assertEqual(first_state.tolist(), second_state.tolist())
+            states.append(tuple(first_state))
+        self.assertEqual(3, len(set(states)))
+
+    def test_messages_without_seed_get_fresh_entropy(self):
+        processor = P2SProcessor()
+        message = FakeMessage(dict(parameters=dict(probability=0.5, size=8), repeat=1))
+        first, second = (
+            processor._get_seed_sequences(message)[0],
+            processor._get_seed_sequences(message)[0],
+        )
+        self.assertNotEqual(first.entropy, second.entropy)
+
+    def test_chunks_use_the_seed_streams_of_the_whole_message(self):
+        body = dict(parameters=dict(probability=0.5, size=8), repeat=7, seed=1234)
+        whole = numpy.random.SeedSequence(1234).spawn(7)
+        processor = P2SProcessor(fan_out="local", fan_out_chunk_size=3)
+        message = FakeMessage(body)
+        self.assertTrue(processor._should_fan_out(message))
+
+        chunks = processor._get_chunk_messages(message)
+        self.assertEqual([3, 3, 1], [chunk.body["repeat"] for chunk in chunks])
+        chunked = [
+            seed_sequence
+            for chunk in chunks
+            for seed_sequence in processor._get_seed_sequences(chunk)
+        ]
+        self.assertEqual(
+            [seed_sequence.generate_state(4).tolist() for seed_sequence in whole],
+            [seed_sequence.generate_state(4).tolist() for seed_sequence in chunked],
+        )
+        self.assertFalse(processor._should_fan_out(chunks[0]))
+
+    def test_queue_fan_out_writes_chunk_messages(self):
+        written = []
+
+        class FakeQueue:
+            def write(self, messages):
+                written.extend(messages)
+
+        processor = P2SProcessor(fan_out="queue", fan_out_chunk_size=16)
+        processor._get_queue = FakeQueue
+        message = FakeMessage(dict(parameters=dict(probability=0.5, size=8), repeat=40))
+
+        processor.process(message)
+        self.assertEqual([0, 16, 32], [body["seed_offset"] for body in written])
+        self.assertEqual({written[0]["seed"]}, {body["seed"] for body in written})
+        self.assertEqual({"fake"}, {body["parent_id"] for body in written})
+
+
+class TestPercolationSimulation(unittest.TestCase):
+    def test_same_seed_produces_same_clusters(self):
+        first = P2SSimulation(probability=0.6, size=16, seed=7)
+        second = P2SSimulation(probability=0.6, size=16, seed=7)
+        self.assertEqual(
+            first.run()["labels"].tolist(), second.run()["labels"].tolist()
+        )
@@ -0,0 +1,45 @@
+import threading
+import unittest
+
+from musk.core.runner import DequeuerWorker
+
+
+class FakeDequeuer:
+    def __init__(self, messages_per_read=1, fail=False):
+        self.messages_per_read = messages_per_read
+        self.fail = fail
+        self.calls = 0
+
+    def dequeue(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("queue unavailable")
+        return self.messages_per_read
+
+    def close(self):
+        pass
+
+
+class TestDequeuerWorker(unittest.TestCase):
+    def test_worker_recycles_after_max_messages(self):
+        dequeuers = [FakeDequeuer(), FakeDequeuer(messages_per_read=2)]
+        worker = DequeuerWorker(dequeuers, threading.Event(), max_messages=7)
+
+        self.assertEqual(9, worker.run())
+        self.assertEqual([3, 3], [dequeuer.calls for dequeuer in dequeuers])
+
+    def test_worker_survives_dequeuer_exceptions(self):
+        dequeuers = [FakeDequeuer(fail=True), FakeDequeuer()]
+        worker = DequeuerWorker(dequeuers, threading.Event(), max_messages=2)
+
+        self.assertEqual(2, worker.run())
+        self.assertEqual(2, dequeuers[0].calls)
+
+    def test_worker_stops_when_asked(self):
+        stop_event = threading.Event()
+        stop_event.set()
+        dequeuer = FakeDequeuer()
+        worker = DequeuerWorker([dequeuer], stop_event)
+
+        self.assertEqual(0, worker.run())
+        self.assertEqual(0, dequeuer.calls)
@@ -0,0 +1,267 @@
+import threading
+import time
+import unittest
+
+import pymysql
+
+from musk.core.sql import BulkWriter, ConnectionPoolTimeout, MySQL, MySQLConnectionPool
+from musk.percolation.percolation_mandelbrot_2d import P2MStatsModel
+from musk.percolation.percolation_square_2d import P2SStatsModel
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._last_executed = None
+
+    def execute(self, query, parameters):
+        if self.connection.lost:
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+        self.connection.queries.append(query)
+
+    def executemany(self, query, rows):
+        self.execute(query, None)
+        self.connection.rows.extend(rows)
+
+    def fetchall_unbuffered(self):
+        yield from self.connection.result_rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.lost = False
+        self.closed = False
+        self.queries = []
+        self.rows = []
+        self.commits = 0
+        self.result_rows = [dict(id=1)]
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=False):
+        if self.lost:
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def get_fake_pool(size=2, timeout=0.1, ping_interval=0):
+    connections = []
+
+    def factory():
+        connection = FakeConnection()
+        connections.append(connection)
+        return connection
+
+    pool = MySQLConnectionPool(factory, size, timeout, ping_interval)
+    return pool, connections
+
+
+class TestMySQLConnectionPool(unittest.TestCase):
+    def test_connections_are_reused(self):
+        pool, connections = get_fake_pool()
+        mysql = MySQL(pool)
+        for _ in range(5):
+            mysql.execute("INSERT", {})
+        self.assertEqual(1, len(connections))
+        self.assertEqual(1, pool.get_idle_count())
+
+    def test_stale_connections_are_replaced_on_checkout(self):
+        pool, connections = get_fake_pool()
+        mysql = MySQL(pool)
+        mysql.execute("INSERT", {})
+        connections[0].lost = True
+
+        self.assertEqual([dict(id=1)], mysql.fetch("SELECT"))
+        self.assertEqual(2, len(connections))
+        self.assertTrue(connections[0].closed)
+
+    def test_lost_connection_is_retried_once(self):
+        pool, connections = get_fake_pool(ping_interval=60)
+        mysql = MySQL(pool)
+        mysql.execute("INSERT", {})
+        # Not pinged (returned recently), so the query itself fails
+        connections[0].lost = True
+
+        self.assertEqual([dict(id=1)], mysql.fetch("SELECT"))
+        self.assertTrue(connections[0].closed)
+        self.assertEqual(["SELECT"], connections[1].queries)
+
+    def test_writes_sent_on_a_lost_connection_are_not_retried(self):
+        pool, connections = get_fake_pool(ping_interval=60)
+        mysql = MySQL(pool)
+        mysql.execute("INSERT", {})
+        connections[0].lost = True
+
+        with self.assertRaises(pymysql.err.OperationalError):
+            mysql.execute_many("INSERT", [dict(id=1)])
+        self.assertEqual(1, len(connections))
+
+        mysql.execute("UPSERT", {}, idempotent=True)
+        self.assertEqual(["UPSERT"], connections[1].queries)
+
+    def test_pool_size_is_a_limit(self):
+        pool, _ = get_fake_pool(size=1)
+        release = threading.Event()
+        borrowed = threading.Event()
+
+        def hold():
+            with pool.connection():
+                borrowed.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        borrowed.wait()
+        with self.assertRaises(ConnectionPoolTimeout):
+            with pool.connection():
+                pass
+        release.set()
+        thread.join()
+
+    def test_reserve_grows_the_pool(self):
+        pool, _ = get_fake_pool(size=1)
+        pool.reserve(2)
+        pool.reserve(1)
+        self.assertEqual(2, pool.get_size())
+        with pool.connection(), pool.connection():
+            with self.assertRaises(ConnectionPoolTimeout):
+                with pool.connection():
+                    pass
+
+    def test_one_pool_per_process(self):
+        self.assertIs(
+            MySQLConnectionPool.get_instance(), MySQLConnectionPool.get_instance()
+        )
+
+
+class TestBulkWriter(unittest.TestCase):
+    def test_rows_are_written_in_one_transaction_on_exit(self):
+        pool, connections = get_fake_pool()
+        with BulkWriter(MySQL(pool)) as writer:
+            for index in range(3):
+                writer.add("INSERT A", dict(index=index))
+            writer.add("INSERT B", dict(index=3))
+            self.assertEqual(4, writer.get_buffered_count())
+
+        connection = connections[0]
+        self.assertEqual(["INSERT A", "INSERT B"], connection.queries)
+        self.assertEqual([0, 1, 2, 3], [row["index"] for row in connection.rows])
+        self.assertEqual(1, connection.commits)
+
+    def test_flushes_on_row_threshold(self):
+        pool, connections = get_fake_pool()
+        writer = BulkWriter(MySQL(pool), max_rows=2)
+        for index in range(5):
+            writer.add("INSERT", dict(index=index))
+        self.assertEqual(1, writer.get_buffered_count())
+        self.assertEqual(2, connections[0].commits)
+
+    def test_rows_are_dropped_when_the_block_raises(self):
+        pool, connections = get_fake_pool()
+        with self.assertRaises(RuntimeError):
+            with BulkWriter(MySQL(pool)) as writer:
+                writer.add("INSERT", dict(index=0))
+                raise RuntimeError
+        self.assertEqual([], connections)
+
+
+class TestMySQLStream(unittest.TestCase):
+    def setUp(self):
+        self.pool, self.connections = get_fake_pool()
+        self.mysql = MySQL(self.pool)
+        # Open the connection the stream will borrow
+        self.mysql.execute("SELECT 1", {})
+        self.connections[0].result_rows = [dict(id=index) for index in range(20)]
+
+    def test_rows_are_transformed_in_order(self):
+        rows = self.mysql.stream("SELECT", transform=lambda row: row["id"] * 2)
+        self.assertEqual([index * 2 for index in range(20)], list(rows))
+        self.assertEqual(1, self.pool.get_idle_count())
+
+    def test_prefetch_is_bounded(self):
+        transformed = []
+
+        def transform(row):
+            transformed.append(row["id"])
+            return row
+
+        rows = self.mysql.stream("SELECT", prefetch=3, transform=transform)
+        next(rows)
+        time.sleep(0.2)
+        # One row consumed, at most 3 queued, one blocked on the full queue
+        self.assertLessEqual(len(transformed), 5)
+        rows.close()
+        self.assertEqual(1, self.pool.get_idle_count())
+
+    def test_errors_are_raised_in_the_consumer(self):
+        def transform(row):
+            if row["id"] == 3:
+                raise ValueError("bad row")
+            return row
+
+        rows = self.mysql.stream("SELECT", transform=transform)
+        with self.assertRaises(ValueError):
+            list(rows)
+
+
+class RecordingCursor(pymysql.cursors.Cursor):
+    # Formats queries as pymysql does, recording them instead of sending
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.queries = []
+
+    def _query(self, query):
+        self.queries.append(bytes(query).decode("utf8"))
+        return 1
+
+    def nextset(self):
+        return None
+
+
+class RecordingConnection:
+    encoding = "utf8"
+
+    def literal(self, value):
+        return pymysql.converters.escape_item(value, "utf8")
+
+    def escape(self, value, mapping=None):
+        return pymysql.converters.escape_item(value, "utf8", mapping)
+
+
+class TestStatsUpsertQueries(unittest.TestCase):
+    def test_upserts_are_fully_formatted_by_executemany(self):
+        rows = [
+            dict(
+                simulation_id=index,
+                probability=0.5,
+                size=16,
+                has_percolated=True,
+                average_correlation_length=1.5,
+            )
+            for index in range(3)
+        ]
+        for StatsModelClass in [P2SStatsModel, P2MStatsModel]:
+            query = StatsModelClass.get_update_query(
+                ("simulation_id", rows[0]["simulation_id"]), rows[0]
+            )
+            cursor = RecordingCursor(RecordingConnection())
+            cursor.executemany(query, rows)
+
+            self.assertEqual(1, len(cursor.queries))
+            self.assertNotIn("%(", cursor.queries[0])
+            self.assertIn("VALUES(", cursor.queries[0])
@@ -0,0 +1,229 @@
+import json
+import time
+import unittest
+
+from unittest import mock
+
+from musk.core import Dequeuer, Processor, Queue, SQSMessage, SQSQueue
+from musk.core.dequeuer import ProcessingTimeStats
+from musk.core.processor import PROCESS_CONCURRENCY, THREAD_CONCURRENCY
+from musk.core.sql import MySQLConnectionPool
+
+
+class FakeBotoMessage:
+    def __init__(self, index):
+        self.message_id = f"message-{index}"
+        self.receipt_handle = f"receipt-{index}"
+        self.body = json.dumps(dict(index=index))
+
+
+class FakeBotoQueue:
+    """
+        Records the calls SQSQueue makes on a boto3 queue resource.
+    """
+
+    def __init__(self, number_of_messages=0):
+        self.messages = [FakeBotoMessage(index) for index in range(number_of_messages)]
+        self.calls = []
+
+    def _record(self, name, **kwargs):
+        self.calls.append((name, kwargs))
+        return dict(ResponseMetadata=dict(HTTPStatusCode=200), Successful=[])
+
+    def receive_messages(self, **kwargs):
+        self.calls.append(("receive_messages", kwargs))
+        count = kwargs["MaxNumberOfMessages"]
+        messages, self.messages = self.messages[:count], self.messages[count:]
+        return messages
+
+    def send_messages(self, **kwargs):
+        return self._record("send_messages", **kwargs)
+
+    def delete_messages(self, **kwargs):
+        return self._record("delete_messages", **kwargs)
+
+    def change_message_visibility_batch(self, **kwargs):
+        return self._record("change_message_visibility_batch", **kwargs)
+
+    def get_calls(self, name):
+        return [kwargs for call_name, kwargs in self.calls if call_name == name]
+
+
+class FakeSQSQueue(SQSQueue):
+    name = "fake"
+
+    def __init__(self, boto_queue, **kwargs):
+        super().__init__("test", **kwargs)
+        self._queue = boto_queue
+
+
+class TestSQSQueue(unittest.TestCase):
+    def test_write_is_chunked_in_batches_of_ten(self):
+        boto_queue = FakeBotoQueue()
+        FakeSQSQueue(boto_queue).write([dict(index=index) for index in range(25)])
+
+        calls = boto_queue.get_calls("send_messages")
+        self.assertEqual([10, 10, 5], [len(call["Entries"]) for call in calls])
+
+    def test_read_uses_long_polling(self):
+        boto_queue = FakeBotoQueue(number_of_messages=3)
+        queue = FakeSQSQueue(boto_queue, wait_time_seconds=15)
+
+        messages = list(queue.read(2))
+        self.assertEqual(["message-0", "message-1"], [m.id for m in messages])
+        (call,) = boto_queue.get_calls("receive_messages")
+        self.assertEqual(15, call["WaitTimeSeconds"])
+
+    def test_batch_delete_and_requeue(self):
+        boto_queue = FakeBotoQueue()
+        queue = FakeSQSQueue(boto_queue)
+        messages = [SQSMessage(FakeBotoMessage(index)) for index in range(12)]
+
+        queue.delete_messages(messages)
+        queue.requeue_messages(messages[:3])
+
+        deletes = boto_queue.get_calls("delete_messages")
+        self.assertEqual([10, 2], [len(call["Entries"]) for call in deletes])
+        self.assertEqual("receipt-11", deletes[1]["Entries"][1]["ReceiptHandle"])
+        (requeue,) = boto_queue.get_calls("change_message_visibility_batch")
+        self.assertEqual(
+            [0, 0, 0], [entry["VisibilityTimeout"] for entry in requeue["Entries"]]
+        )
+
+
+class FailingProcessor(Processor):
+    def process(self, message):
+        if message.body["index"] % 2:
+            raise ValueError("odd message")
+
+
+class SlowProcessor(Processor):
+    def process(self, message):
+        time.sleep(0.35)
+
+
+class DequeuerConfig:
+    MESSAGES_PER_READ = 4
+    VISIBILITY_HEARTBEAT = True
+    CONCURRENCY_WORKERS = 1
+
+
+class ConcurrentDequeuerConfig(DequeuerConfig):
+    CONCURRENCY_WORKERS = 2
+
+
+class ThreadFailingProcessor(FailingProcessor):
+    concurrency = THREAD_CONCURRENCY
+
+
+class ProcessFailingProcessor(FailingProcessor):
+    concurrency = PROCESS_CONCURRENCY
+
+
+class TestDequeuer(unittest.TestCase):
+    def test_read_batch_is_acknowledged_at_once(self):
+        boto_queue = FakeBotoQueue(number_of_messages=4)
+        dequeuer = Dequeuer(
+            FakeSQSQueue(boto_queue), FailingProcessor(), DequeuerConfig
+        )
+
+        self.assertEqual(4, dequeuer.dequeue())
+        (delete,) = boto_queue.get_calls("delete_messages")
+        (requeue,) = boto_queue.get_calls("change_message_visibility_batch")
+        self.assertEqual(
+            ["receipt-0", "receipt-2"],
+            [entry["ReceiptHandle"] for entry in delete["Entries"]],
+        )
+        self.assertEqual(
+            ["receipt-1", "receipt-3"],
+            [entry["ReceiptHandle"] for entry in requeue["Entries"]],
+        )
+
+    def test_base_queue_acknowledges_one_by_one(self):
+        class FakeMessage:
+            deleted = requeued = False
+
+            def delete(self):
+                self.deleted = True
+
+            def requeue(self):
+                self.requeued = True
+
+        messages = [FakeMessage(), FakeMessage()]
+        Queue().delete_messages(messages[:1])
+        Queue().requeue_messages(messages[1:])
+        self.assertEqual([True, False], [m.deleted for m in messages])
+        self.assertEqual([False, True], [m.requeued for m in messages])
+
+    def test_heartbeat_extends_visibility_while_processing(self):
+        boto_queue = FakeBotoQueue(number_of_messages=1)
+        queue = FakeSQSQueue(boto_queue)
+        queue.sqs_visibility_timeout = 0.1
+        dequeuer = Dequeuer(queue, SlowProcessor(), DequeuerConfig)
+
+        dequeuer.dequeue()
+        heartbeats = boto_queue.get_calls("change_message_visibility_batch")
+        self.assertGreaterEqual(len(heartbeats), 2)
+        self.assertEqual(
+            [dict(Id="0", ReceiptHandle="receipt-0", VisibilityTimeout=0.1)],
+            heartbeats[0]["Entries"],
+        )
+        self.assertEqual("delete_messages", boto_queue.calls[-1][0])
+        self.assertEqual(1, dequeuer.get_processing_time_stats().count)
+
+    def test_concurrent_processing_acknowledges_the_batch(self):
+        for processor in (ThreadFailingProcessor(), ProcessFailingProcessor()):
+            boto_queue = FakeBotoQueue(number_of_messages=4)
+            dequeuer = Dequeuer(
+                FakeSQSQueue(boto_queue), processor, ConcurrentDequeuerConfig
+            )
+
+            self.assertEqual(4, dequeuer.dequeue())
+            (delete,) = boto_queue.get_calls("delete_messages")
+            self.assertEqual(
+                ["receipt-0", "receipt-2"],
+                sorted(entry["ReceiptHandle"] for entry in delete["Entries"]),
+            )
+            self.assertEqual(2, dequeuer.get_processing_time_stats().count)
+            dequeuer.close()
+
+    def test_thread_workers_reserve_mysql_connections(self):
+        class StreamingProcessor(ThreadFailingProcessor):
+            mysql_connections = 2
+
+        class ManyWorkersConfig(DequeuerConfig):
+            CONCURRENCY_WORKERS = 8
+
+        pool = MySQLConnectionPool(lambda: None, 4, 0.1, 0)
+        with mock.patch.object(MySQLConnectionPool, "get_instance", return_value=pool):
+            dequeuer = Dequeuer(
+                FakeSQSQueue(FakeBotoQueue()), StreamingProcessor(), ManyWorkersConfig
+            )
+            dequeuer._get_executor()
+            dequeuer.close()
+        self.assertEqual(16, pool.get_size())
+
+    def test_reads_are_limited_by_observed_processing_time(self):
+        boto_queue = FakeBotoQueue(number_of_messages=10)
+        queue = FakeSQSQueue(boto_queue)
+        queue.sqs_visibility_timeout = 60
+        dequeuer = Dequeuer(queue, ThreadFailingProcessor(), ConcurrentDequeuerConfig)
+        self.assertEqual(4, dequeuer._get_read_size())
+
+        # 2 workers, each finishing 1 message of 40s within the timeout
+        dequeuer.get_processing_time_stats().add(40)
+        self.assertEqual(2, dequeuer._get_read_size())
+
+
+class TestProcessingTimeStats(unittest.TestCase):
+    def test_summary_and_suggested_timeout(self):
+        stats = ProcessingTimeStats(max_samples=10)
+        for seconds in range(1, 21):
+            stats.add(seconds)
+
+        self.assertEqual(20, stats.count)
+        self.assertEqual(10.5, stats.get_mean())
+        self.assertEqual(20, stats.max)
+        # Quantiles only use the latest 10 samples (11 to 20)
+        self.assertEqual(16, stats.get_quantile(0.5))
+        self.assertEqual(30, stats.get_suggested_visibility_timeout())
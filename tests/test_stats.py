@@ -0,0 +1,253 @@
+import json
+import unittest
+
+from unittest import mock
+
+import numpy
+
+from musk.lattices.labeling import get_wrapping, merge_open_sub_clusters
+from musk.misc.observables import get_clusters_from_labels
+from musk.percolation import P2SSimulation
+from musk.percolation.correlation import (
+    get_connectedness_function,
+    get_gyration_radii,
+)
+from musk.percolation.stats import (
+    ClusterAnalysis,
+    CorrelationFunctionCalculation,
+    CorrelationLengthCalculation,
+    ExactCorrelationFunctionCalculation,
+    WrappingCalculation,
+)
+
+
+def get_reference_wrapping(labels):
+    return get_reference_unwrapping(labels)[0]
+
+
+def get_reference_unwrapping(labels):
+    # Walk each cluster, giving nodes unwrapped positions; an edge
+    # between nodes whose positions disagree closes a winding loop
+    shape = labels.shape
+    wrapping = numpy.zeros((labels.max() + 1, labels.ndim), dtype=bool)
+    positions = {}
+    for start in zip(*numpy.nonzero(labels)):
+        if start in positions:
+            continue
+        positions[start] = start
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for axis in range(labels.ndim):
+                for step in (-1, 1):
+                    position = list(positions[node])
+                    position[axis] += step
+                    neighbour = tuple(p % extent for p, extent in zip(position, shape))
+                    if labels[neighbour] != labels[node]:
+                        continue
+                    if neighbour not in positions:
+                        positions[neighbour] = tuple(position)
+                        stack.append(neighbour)
+                    winding = numpy.subtract(position, positions[neighbour]) != 0
+                    wrapping[labels[node]] |= winding
+    return wrapping, positions
+
+
+class TestClusterAnalysis(unittest.TestCase):
+    def test_matches_cluster_sets(self):
+        size = 12
+        for probability in (0.3, 0.59, 0.8):
+            labels = P2SSimulation(probability, size, seed=3).run()["labels"]
+            analysis = ClusterAnalysis(labels, periodic=True)
+            clusters = get_clusters_from_labels(labels)
+            wrapping = get_reference_wrapping(labels)
+
+            def has_percolated(cluster, size):
+                return wrapping[labels[next(iter(cluster))]].any()
+
+            self.assertEqual(
+                sorted(map(len, clusters)),
+                sorted(analysis.get_cluster_sizes().tolist()),
+            )
+            finite = [c for c in clusters if not has_percolated(c, size)]
+            percolating = [c for c in clusters if has_percolated(c, size)]
+            self.assertEqual(
+                sorted(map(len, finite)),
+                sorted(analysis.get_finite_cluster_sizes().tolist()),
+            )
+            self.assertEqual(
+                sorted(map(len, percolating)),
+                sorted(analysis.get_percolating_cluster_sizes().tolist()),
+            )
+            for cluster in percolating:
+                for node in cluster:
+                    self.assertEqual(0, analysis.finite_labels[node])
+
+    def test_wrapping_is_not_spanning_every_row(self):
+        # A staircase touching every row that does not wrap, and a
+        # spiral that only closes once around both axes
+        staircase = numpy.zeros((4, 4), dtype=numpy.uint8)
+        for node in [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (3, 2)]:
+            staircase[node] = 1
+        analysis = ClusterAnalysis(staircase, periodic=True)
+        self.assertEqual([[False, False], [False, False]], analysis.wrapping.tolist())
+        self.assertEqual([True], analysis.finite[1:].tolist())
+
+        spiral = staircase.copy()
+        spiral[3, 3] = spiral[0, 3] = 1
+        analysis = ClusterAnalysis(spiral, periodic=True)
+        self.assertEqual([True, True], analysis.wrapping[1].tolist())
+        self.assertEqual(
+            dict(horizontal=True, vertical=True, either=True, both=True),
+            WrappingCalculation(analysis, None).calculate(),
+        )
+
+    def test_wrapping_matches_reference(self):
+        for probability in (0.45, 0.55, 0.6, 0.7):
+            for seed in range(5):
+                labels = P2SSimulation(probability, 10, seed=seed).run()["labels"]
+                self.assertEqual(
+                    get_reference_wrapping(labels).tolist(),
+                    get_wrapping(labels).tolist(),
+                )
+
+    def test_spanning_per_axis(self):
+        labels = numpy.array([[1, 1, 1], [0, 0, 0], [2, 0, 0]])
+        analysis = ClusterAnalysis(labels)
+        self.assertEqual([False, True], analysis.spanning[1].tolist())
+        self.assertEqual([False, False], analysis.spanning[2].tolist())
+        self.assertEqual([False, True, False], analysis.percolating.tolist())
+        self.assertEqual(
+            [[0, 0, 0], [0, 0, 0], [2, 0, 0]], analysis.finite_labels.tolist()
+        )
+
+
+def get_brute_force_connectedness(labels, periodic):
+    shape = labels.shape
+    same, pairs = {}, {}
+    for first in numpy.ndindex(*shape):
+        for second in numpy.ndindex(*shape):
+            key = []
+            for a, b, extent in zip(first, second, shape):
+                distance = abs(a - b)
+                if periodic:
+                    distance = min(distance, extent - distance)
+                key.append(distance)
+            key = tuple(key)
+            pairs[key] = pairs.get(key, 0) + 1
+            connected = labels[first] > 0 and labels[first] == labels[second]
+            same[key] = same.get(key, 0) + connected
+    return {key: same[key] / pairs[key] for key in pairs}
+
+
+class TestCorrelationFunction(unittest.TestCase):
+    def _assert_matches_brute_force(self, labels, periodic):
+        connectedness = get_connectedness_function(labels, periodic)
+        expected = get_brute_force_connectedness(labels, periodic)
+        expected[(0,) * labels.ndim] = 1
+        self.assertEqual(set(expected), set(numpy.ndindex(*connectedness.shape)))
+        for key, value in expected.items():
+            self.assertAlmostEqual(value, connectedness[key])
+
+    def test_exact_matches_brute_force(self):
+        labels = P2SSimulation(0.55, 7, seed=5).run()["labels"]
+        self._assert_matches_brute_force(labels, periodic=True)
+        self._assert_matches_brute_force(labels, periodic=False)
+
+    def test_large_clusters_use_autocorrelation(self):
+        labels = numpy.ones((6, 6), dtype=numpy.uint8)
+        labels[0, :] = 2
+        with mock.patch("musk.percolation.correlation.PAIR_CHUNK_SIZE", 7):
+            self._assert_matches_brute_force(labels, periodic=True)
+            self._assert_matches_brute_force(labels, periodic=False)
+
+    def test_monte_carlo_agrees_with_exact(self):
+        labels = P2SSimulation(0.5, 16, seed=9).run()["labels"]
+        analysis = ClusterAnalysis(labels, periodic=True)
+        exact = ExactCorrelationFunctionCalculation(analysis, None).calculate()
+        sampled = CorrelationFunctionCalculation(
+            analysis, None, samples=2**20
+        ).calculate()
+        self.assertEqual(1, exact[(0, 0)])
+        for key in [(0, 1), (1, 0), (1, 1), (2, 0)]:
+            self.assertAlmostEqual(exact[key], sampled.get(key, 0), delta=0.02)
+
+    def test_exact_calculation_takes_no_samples(self):
+        analysis = ClusterAnalysis(numpy.zeros((3, 3), dtype=numpy.uint8))
+        with self.assertRaises(TypeError):
+            ExactCorrelationFunctionCalculation(analysis, None, samples=10)
+
+    def test_encoded_keys(self):
+        analysis = ClusterAnalysis(
+            numpy.array([[1, 1, 0], [0, 0, 0], [0, 0, 0]]), periodic=True
+        )
+        calculation = ExactCorrelationFunctionCalculation(analysis, None)
+        self.assertEqual(
+            {"0_0": 1.0, "0_1": 0.111},
+            json.loads(calculation.encode_for_db(calculation.calculate())),
+        )
+
+
+class TestCorrelationLength(unittest.TestCase):
+    def test_gyration_radii_unwrap_periodic_clusters(self):
+        labels = numpy.zeros((8, 8), dtype=numpy.uint8)
+        labels[7, 7] = labels[0, 7] = labels[0, 0] = 1
+        labels[3, 2:5] = 2
+
+        radii = get_gyration_radii(labels, periodic=True)
+        # (0, 0), (1, 0), (1, 1) once unwrapped
+        self.assertAlmostEqual(4 / 9, radii[1])
+        self.assertAlmostEqual(2 / 3, radii[2])
+        self.assertGreater(get_gyration_radii(labels, periodic=False)[1], 10)
+
+    def test_gyration_radii_of_clusters_wider_than_half_the_lattice(self):
+        # 6 nodes in a row across the edge, starting far from node (3, 0)
+        labels = numpy.zeros((8, 8), dtype=numpy.uint8)
+        labels[3, [3, 4, 5, 6, 7, 0]] = 1
+        radii = get_gyration_radii(labels, periodic=True)
+        self.assertAlmostEqual(35 / 12, radii[1])
+
+        # 7 nodes in a column across the edge, and one next to its end
+        labels = numpy.zeros((8, 8), dtype=numpy.uint8)
+        labels[[5, 6, 7, 0, 1, 2, 3], 0] = 1
+        labels[3, 1] = 1
+        radii = get_gyration_radii(labels, periodic=True)
+        positions = numpy.array([[row, 0] for row in range(-3, 4)] + [[3, 1]])
+        self.assertAlmostEqual(positions.var(axis=0).sum(), radii[1])
+
+    def test_gyration_radii_match_reference_unwrapping(self):
+        for seed in range(6):
+            labels = P2SSimulation(0.585, 24, seed=seed).run()["labels"]
+            wrapping, positions = get_reference_unwrapping(labels)
+            radii = get_gyration_radii(labels, periodic=True)
+            for label in range(1, labels.max() + 1):
+                if wrapping[label].any():
+                    continue
+                nodes = numpy.array(
+                    [positions[node] for node in zip(*numpy.nonzero(labels == label))]
+                )
+                self.assertAlmostEqual(nodes.var(axis=0).sum(), radii[label])
+
+    def test_correlation_length(self):
+        labels = numpy.zeros((8, 8), dtype=numpy.uint8)
+        labels[3, 2:5] = 1
+        labels[6, 6] = 2
+        analysis = ClusterAnalysis(labels, periodic=True)
+        xi = CorrelationLengthCalculation(analysis, None).calculate()
+        self.assertAlmostEqual((2 * 2 / 3 * 9 / 10) ** 0.5, xi)
+
+        empty = ClusterAnalysis(numpy.zeros((4, 4), dtype=numpy.uint8))
+        self.assertEqual(0, CorrelationLengthCalculation(empty, None).calculate())
+
+    def test_wrapping_and_radii_share_one_sub_cluster_merge(self):
+        labels = P2SSimulation(0.55, 12, seed=2).run()["labels"]
+        with mock.patch(
+            "musk.percolation.stats.merge_open_sub_clusters",
+            wraps=merge_open_sub_clusters,
+        ) as merge, mock.patch(
+            "musk.lattices.labeling.merge_open_sub_clusters",
+            side_effect=AssertionError("merged again"),
+        ):
+            analysis = ClusterAnalysis(labels, periodic=True)
+            CorrelationLengthCalculation(analysis, None).calculate()
+        self.assertEqual(1, merge.call_count)
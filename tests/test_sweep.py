@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from musk.cli import get_parser, get_sweep_spec
+from musk.core.sqlite import SQLiteStore
+from musk.percolation.sweep import SweepRunner, SweepSpec
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "sweep.sqlite")
+
+    def _run(self, path, **spec):
+        with SQLiteStore(path) as store:
+            SweepRunner(SweepSpec(**spec), store).run()
+            return store.fetch("SELECT * FROM p2s ORDER BY id")
+
+    def test_sweep_stores_simulations_and_stats(self):
+        simulations = self._run(
+            self.path,
+            simulation="square_2d",
+            sizes=[8],
+            probabilities=[0.4, 0.7],
+            repeat=3,
+            seed=5,
+            stats=["has_percolated", "mean_cluster_size"],
+        )
+        with SQLiteStore(self.path) as store:
+            stats = store.fetch("SELECT * FROM percolation_2d_square_stats")
+        self.assertEqual(6, len(simulations))
+        self.assertEqual(
+            [row["id"] for row in simulations], [row["simulation_id"] for row in stats]
+        )
+        self.assertEqual([0.4] * 3 + [0.7] * 3, [row["probability"] for row in stats])
+
+    def test_results_do_not_depend_on_chunk_size(self):
+        spec = dict(
+            simulation="square_2d", sizes=[8], probabilities=[0.6], repeat=5, seed=9
+        )
+        whole = self._run(self.path, chunk_size=16, **spec)
+        chunked = self._run(self.path + "2", chunk_size=2, **spec)
+        self.assertEqual(
+            [row["observables"] for row in whole],
+            [row["observables"] for row in chunked],
+        )
+
+    def test_spec_from_command_line(self):
+        arguments = get_parser().parse_args(
+            "run --simulation mandelbrot_2d --sizes 2 --p-min 0.5 --p-max 0.6 "
+            "--p-steps 3 --repeat 4 --parameter n_divisions=3".split()
+        )
+        spec = get_sweep_spec(arguments)
+        self.assertEqual([0.5, 0.55, 0.6], spec.probabilities)
+        (message, *_) = spec.get_messages()
+        self.assertEqual(
+            dict(n_divisions=3, initial_size=2, probability=0.5),
+            message.body["parameters"],
+        )